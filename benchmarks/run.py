@@ -0,0 +1,129 @@
+"""
+Benchmarks of site loading, generation and preview on synthetic sites.
+
+Run from the repository root:
+
+    python3 -m benchmarks.run --pages 100 1000 10000 --output results.json
+
+Results are written as JSON, so they can be compared between commits.
+"""
+
+import argparse
+import http.client
+import json
+import os
+import platform
+import subprocess
+import sys
+from tempfile import TemporaryDirectory
+import time
+
+from oxalis.server import PreviewServer
+from oxalis.site import Site
+
+from benchmarks.synthetic_site import generate_site
+
+
+def timed(function, *args, **kwargs):
+    """Call function and return tuple (duration in seconds, result)."""
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+
+def touch_pages(site, count):
+    """Modify count Markdown pages, so they need to be rebuilt."""
+    sources = sorted(doc.path for doc in site.store.all_documents()
+                     if doc.converter is not None)
+    for path in sources[:count]:
+        with open(os.path.join(site.directory, path), 'a') as f:
+            f.write("\nChanged.\n")
+
+
+def preview_throughput(site, requests, keep_alive=False):
+    """
+    Measure number of preview server requests served per second, with a new
+    connection for every request or with one persistent connection.
+    """
+    server = PreviewServer(site)
+    server.start()
+    paths = sorted('/' + doc.converter.target()
+                   for doc in site.store.all_documents()
+                   if doc.converter is not None)
+    paths = (paths * (requests // len(paths) + 1))[:requests]
+    start = time.perf_counter()
+    connection = None
+    for path in paths:
+        if connection is None:
+            connection = http.client.HTTPConnection('127.0.0.1', server.port)
+        connection.request('GET', path)
+        response = connection.getresponse()
+        response.read()
+        if not keep_alive:
+            connection.close()
+            connection = None
+    if connection is not None:
+        connection.close()
+    result = requests / (time.perf_counter() - start)
+    server.stop()
+    return result
+
+
+def benchmark(pages, workers, requests):
+    """Run all benchmarks on a site with the specified number of pages."""
+    result = {'pages': pages, 'workers': workers}
+    with TemporaryDirectory() as tempdir:
+        path = os.path.join(tempdir, 'site')
+        result['create_site'], __ = timed(generate_site, path, pages)
+        result['load'], site = timed(Site, path)
+        result['full_generate'], __ = timed(site.generate, force=True,
+                                            workers=workers)
+        result['noop_generate'], __ = timed(site.generate, workers=workers)
+        touch_pages(site, max(1, pages // 100))
+        result['incremental_generate'], __ = timed(site.generate,
+                                                   workers=workers)
+        result['reload'], site = timed(Site, path)
+        result['preview_requests_per_second'] = preview_throughput(site,
+                                                                   requests)
+        result['preview_keep_alive_requests_per_second'] = \
+            preview_throughput(site, requests, keep_alive=True)
+    return result
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                       universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--pages', type=int, nargs='+', default=[100, 1000],
+                        help="sizes of generated sites (in pages)")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="number of build worker processes")
+    parser.add_argument('--requests', type=int, default=500,
+                        help="number of preview server requests")
+    parser.add_argument('--output', help="output file (default is stdout)")
+    args = parser.parse_args(argv)
+
+    results = {
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'benchmarks': [benchmark(pages, args.workers, args.requests)
+                       for pages in args.pages],
+    }
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
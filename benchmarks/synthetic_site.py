@@ -0,0 +1,129 @@
+"""
+Generator of synthetic Oxalis sites for benchmarks.
+
+Generated sites contain Markdown pages spread over nested directories,
+a chain of templates (extends, include, import) and static assets.
+"""
+
+import os
+import random
+
+from oxalis.site import create_site
+
+TEMPLATES = {
+    'base.html': """<!DOCTYPE html>
+{% import 'macros.html' as macros %}
+<html>
+  <head>
+    <meta charset="utf-8">
+    <title>{{ title }}</title>
+    <link rel="stylesheet" href="/css/style0.css">
+  </head>
+  <body>
+    {% include 'header.html' %}
+    {% block body %}{% endblock %}
+    {% include 'footer.html' %}
+  </body>
+</html>
+""",
+    'header.html': """<header><nav>{% for i in range(10) %}
+<a href="/section{{ i }}/">Section {{ i }}</a>{% endfor %}</nav></header>
+""",
+    'footer.html': "<footer>Generated by Oxalis benchmark</footer>\n",
+    'macros.html': """{% macro meta(title) -%}
+<p class="meta">{{ title|upper }}</p>
+{%- endmacro %}
+""",
+    'default.html': """{% extends 'base.html' %}
+{% block body %}{{ macros.meta(title) }}<main>{{ content }}</main>{% endblock %}
+""",
+    'article.html': """{% extends 'default.html' %}
+{% block body %}<article>{{ super() }}</article>{% endblock %}
+""",
+}
+
+WORDS = ("lorem ipsum dolor sit amet consectetur adipiscing elit sed do "
+         "eiusmod tempor incididunt ut labore et dolore magna aliqua").split()
+
+
+def _paragraph(rnd, words=60):
+    return " ".join(rnd.choice(WORDS) for __ in range(words)).capitalize() + "."
+
+
+def page_text(rnd, title, template):
+    """Markdown text of a page with a few typical constructs."""
+    parts = ["Title: %s" % title, "Template: %s" % template, "",
+             title, "=" * len(title), ""]
+    for section in range(rnd.randint(2, 5)):
+        parts.append("## Section %d\n" % section)
+        parts.append(_paragraph(rnd) + "\n")
+        parts.append("\n".join("* " + _paragraph(rnd, 8) for __ in range(4)))
+        parts.append("")
+    parts.append("| Key | Value |\n|-----|-------|")
+    parts.extend("| %s | %d |" % (rnd.choice(WORDS), i) for i in range(5))
+    parts.append("\n    def example():\n        return 42\n")
+    return "\n".join(parts)
+
+
+def directories(pages, depth, fanout):
+    """List of directory paths for pages, up to the specified depth."""
+    dirs = ['']
+    level = ['']
+    for __ in range(depth):
+        level = [os.path.join(parent, 'section%d' % i)
+                 for parent in level for i in range(fanout)]
+        dirs.extend(level)
+        if len(dirs) * 10 >= pages:
+            break
+    return dirs
+
+
+def generate_site(path, pages, depth=3, fanout=5, assets=None, seed=0):
+    """
+    Create synthetic site on path.
+
+    pages - number of Markdown pages
+    depth - maximal depth of directory tree
+    fanout - number of subdirectories in every directory
+    assets - number of static assets (default is a tenth of pages)
+    """
+    rnd = random.Random(seed)
+    os.makedirs(path, exist_ok=True)
+    create_site(path)
+    os.remove(os.path.join(path, 'index.md'))
+
+    templates_dir = os.path.join(path, '_templates')
+    for name, text in TEMPLATES.items():
+        with open(os.path.join(templates_dir, name), 'w') as f:
+            f.write(text)
+
+    dirs = directories(pages, depth, fanout)
+    for directory in dirs:
+        os.makedirs(os.path.join(path, directory), exist_ok=True)
+    for i in range(pages):
+        directory = dirs[i % len(dirs)]
+        name = 'index.md' if i < len(dirs) else 'page%d.md' % i
+        template = rnd.choice(['default', 'article'])
+        with open(os.path.join(path, directory, name), 'w') as f:
+            f.write(page_text(rnd, "Page %d" % i, template))
+
+    if assets is None:
+        assets = max(1, pages // 10)
+    for subdir in ('css', 'js', 'images'):
+        os.makedirs(os.path.join(path, subdir), exist_ok=True)
+    for i in range(assets):
+        kind = i % 3
+        if kind == 0:
+            name = os.path.join('css', 'style%d.css' % i)
+            data = "".join("body .c%d { margin: %dpx; }\n" % (j, j)
+                           for j in range(200)).encode()
+        elif kind == 1:
+            name = os.path.join('js', 'script%d.js' % i)
+            data = "".join("function f%d(x) { return x + %d; }\n" % (j, j)
+                           for j in range(200)).encode()
+        else:
+            name = os.path.join('images', 'image%d.jpeg' % i)
+            size = rnd.randint(10000, 100000)
+            data = rnd.getrandbits(size * 8).to_bytes(size, 'little')
+        with open(os.path.join(path, name), 'wb') as f:
+            f.write(data)
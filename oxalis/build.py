@@ -0,0 +1,397 @@
+# Oxalis -- A website building tool for Gnome
+# Copyright (C) 2014 Sergej Chodarev
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+"""
+Incremental building of site output files.
+
+The build manifest remembers content hashes of every source, its
+dependencies and its generated file from the last successful conversion, so
+only documents with changed inputs need to be converted again.
+"""
+
+from collections import defaultdict, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import json
+import multiprocessing
+import os
+import tempfile
+import threading
+from time import perf_counter
+
+from oxalis import converters
+from oxalis.signals import Signals
+
+MANIFEST_FILE = 'build-manifest.json'
+MANIFEST_VERSION = 1
+REPORT_FILE = 'build-report.json'
+# Starting of worker processes takes some time, so small builds are faster
+# without them
+MIN_PARALLEL_DOCUMENTS = 50
+
+BuildSummary = namedtuple('BuildSummary', ['rebuilt', 'skipped'])
+
+
+def worker_count(config, workers=None):
+    """
+    Get number of build worker processes. If workers is None, the number is
+    taken from site configuration. Value 0 means one worker per CPU core.
+    """
+    if workers is None:
+        workers = config.getint('build', 'workers', fallback=1)
+    if workers <= 0:
+        workers = os.cpu_count() or 1
+    return workers
+
+
+def convert_document(site_path, path, digest_cache):
+    """
+    Convert a single document using a new converter instance.
+
+    Returns tuple (path, error, dependencies, digests, stats). Digests map
+    the source, the target and the dependencies to digests of their versions
+    used by the conversion (computed using digest_cache), so a file changed
+    before the result is recorded is not taken for current by the next build.
+    """
+    converter = converters.matching_converter(site_path, path)
+    # Taken before the source is read, so a change made during the
+    # conversion is detected as well
+    source_digest = digest_cache.digest(path)
+    error = converter.convert()
+    if error is not None:
+        return path, error, [], {}, converter.stats
+    dependencies = converter.dependencies()
+    digests = {path: digest_cache.digest(path)
+               for path in [converter.target()] + dependencies}
+    digests[path] = source_digest
+    return path, error, dependencies, digests, converter.stats
+
+
+_worker_digests = {}  # site path -> DigestCache of a worker process
+
+
+def _convert(site_path, path):
+    """Convert a single document. Runs in a worker process."""
+    digest_cache = _worker_digests.get(site_path)
+    if digest_cache is None:
+        digest_cache = _worker_digests[site_path] = DigestCache(site_path)
+    return convert_document(site_path, path, digest_cache)
+
+
+def convert_parallel(site_path, paths, workers):
+    """
+    Convert documents in a pool of worker processes.
+
+    Yields tuples (path, error, dependencies, digests, stats) in the order of
+    paths, see convert_document().
+    """
+    # Workers are spawned, not forked, as forking a process with running
+    # Gtk main loop is not safe.
+    context = multiprocessing.get_context('spawn')
+    chunksize = max(1, len(paths) // (workers * 8))
+    executor = ProcessPoolExecutor(workers, mp_context=context)
+    try:
+        yield from executor.map(_convert, [site_path] * len(paths), paths,
+                                chunksize=chunksize)
+    finally:
+        # If the generator is closed early, do not wait for remaining
+        # conversions
+        executor.shutdown(cancel_futures=True)
+
+
+class BackgroundBuild(Signals):
+    """
+    Generation of site output files in a background thread, so the main
+    loop of the application is not blocked by long builds.
+
+    Documents are converted in the thread, but the results are stored into
+    the site in the main thread: run_in_main(callback, *args) must schedule
+    the callback to be called in the main loop, with the same semantics as
+    GLib.idle_add().
+
+    Signals:
+    progress (done, total) -- a document was converted
+    finished (summary) -- build finished or was cancelled, summary is
+        a BuildSummary
+    """
+
+    def __init__(self, site, run_in_main, force=False, workers=None):
+        self.site = site
+        self._run_in_main = run_in_main
+        self._workers = workers
+        self._cancelled = threading.Event()
+        self._start = perf_counter()
+        self.sources, self.pending = site.plan_build(force)
+        self.report = BuildReport()
+        self.done = 0
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        """Start conversion of documents."""
+        self._thread.start()
+
+    def cancel(self):
+        """Stop the build after conversion of the current document."""
+        self._cancelled.set()
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def join(self, timeout=None):
+        """Wait until the background thread finishes."""
+        self._thread.join(timeout)
+
+    def _run(self):
+        try:
+            for result in self.site.convert_documents(
+                    self.pending, self._workers, self._cancelled):
+                self._run_in_main(self._document_done, *result)
+        finally:
+            self._run_in_main(self._finish)
+
+    def _document_done(self, document, error, dependencies, digests, stats):
+        if self.site.store.contains_path(document.path):
+            document.conversion_done(error, dependencies, digests)
+            self.report.add(document.path, stats)
+        self.done += 1
+        self.emit('progress', self.done, len(self.pending))
+        return False
+
+    def _finish(self):
+        self.report.rebuilt = self.done
+        self.report.skipped = len(self.sources) - len(self.pending)
+        self.report.time = perf_counter() - self._start
+        # Documents may be added or removed while the build runs
+        summary = self.site.finish_build(self.site.source_paths(),
+                                         self.report)
+        self.emit('finished', summary)
+        return False
+
+
+class BuildReport:
+    """
+    Timing statistics of a site build -- ConversionStats of every converted
+    document and overall build time.
+    """
+
+    def __init__(self):
+        self.documents = {}  # source path -> ConversionStats
+        self.time = 0.0
+        self.rebuilt = 0
+        self.skipped = 0
+
+    def add(self, path, stats):
+        """Add statistics of document conversion."""
+        if stats is not None:
+            self.documents[path] = stats
+
+    def slowest(self, count=10):
+        """Get list of (path, stats) of the slowest converted documents."""
+        items = sorted(self.documents.items(),
+                       key=lambda item: item[1].total, reverse=True)
+        return items[:count]
+
+    def save(self, filename):
+        """Write report to a JSON file."""
+        documents = {path: dict(stats._asdict(), total=stats.total)
+                     for path, stats in self.documents.items()}
+        data = {'time': self.time,
+                'rebuilt': self.rebuilt,
+                'skipped': self.skipped,
+                'documents': documents}
+        write_json(filename, data, indent=1, sort_keys=True)
+
+
+def file_digest(full_path):
+    """Return SHA-1 hex digest of file contents."""
+    sha = hashlib.sha1()
+    with open(full_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def write_json(filename, data, **options):
+    """
+    Atomically replace the file with JSON representation of data. Keyword
+    options are passed to json.dump().
+
+    Data are written into a temporary file with a unique name, so concurrent
+    writers of the same file do not overwrite each other's partial output.
+    """
+    directory, name = os.path.split(filename)
+    fd, temp_filename = tempfile.mkstemp(dir=directory, prefix=name + '.',
+                                         suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f, **options)
+        os.replace(temp_filename, filename)
+    except BaseException:
+        try:
+            os.remove(temp_filename)
+        except FileNotFoundError:
+            pass  # Already gone, do not hide the original error
+        raise
+
+
+class DigestCache:
+    """
+    Digests of site files cached together with file modification time and
+    size, so checking of unchanged files needs only a stat call.
+    """
+
+    def __init__(self, site_path, entries=None):
+        self.site_path = site_path
+        self.entries = dict(entries or {})  # path -> [mtime_ns, size, digest]
+
+    def digest(self, path):
+        """
+        Return digest of the file on path (relative to the site directory),
+        or None if the file does not exist.
+        """
+        full_path = os.path.join(self.site_path, path)
+        try:
+            stat = os.stat(full_path)
+        except OSError:
+            return None
+        cached = self.entries.get(path)
+        if (cached is not None and cached[0] == stat.st_mtime_ns
+                and cached[1] == stat.st_size):
+            return cached[2]
+        digest = file_digest(full_path)
+        self.entries[path] = [stat.st_mtime_ns, stat.st_size, digest]
+        return digest
+
+    def prune(self, paths):
+        """Forget cached digests of files that are not in paths."""
+        paths = set(paths)
+        for path in self.entries.keys() - paths:
+            del self.entries[path]
+
+
+class BuildManifest:
+    """
+    Record of the last successful conversion of site documents.
+
+    For every source document the manifest stores digests of the source,
+    of its dependencies and of the generated file. Digests are cached in
+    a DigestCache, so checking of unchanged files needs only a stat call.
+    """
+
+    def __init__(self, site_path):
+        self.site_path = site_path
+        self.filename = os.path.join(site_path, '_oxalis', MANIFEST_FILE)
+        self._documents = {}  # source path -> entry dictionary
+        self._digests = DigestCache(site_path)
+        self._dependents = defaultdict(set)  # dependency -> source paths
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.filename) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return  # Missing or broken manifest -- start from scratch
+        if data.get('version') == MANIFEST_VERSION:
+            self._documents = data['documents']
+            self._digests = DigestCache(self.site_path, data['files'])
+            for source, entry in self._documents.items():
+                for dependency in entry['dependencies']:
+                    self._dependents[dependency].add(source)
+
+    def save(self):
+        """Write manifest to the site configuration directory."""
+        used = set()
+        for source, entry in self._documents.items():
+            used.add(source)
+            used.add(entry['target'][0])
+            used.update(entry['dependencies'])
+        self._digests.prune(used)
+        write_json(self.filename, {'version': MANIFEST_VERSION,
+                                   'documents': self._documents,
+                                   'files': self._digests.entries})
+
+    def digest(self, path):
+        """
+        Return digest of the file on path (relative to the site directory),
+        or None if the file does not exist.
+        """
+        return self._digests.digest(path)
+
+    def is_current(self, source):
+        """
+        Check if generated file of the source is up to date, i.e. none of
+        the source, its dependencies or the generated file itself has changed
+        since the last recorded conversion.
+        """
+        entry = self._documents.get(source)
+        if entry is None:
+            return False
+        if self.digest(source) != entry['source']:
+            return False
+        target, target_digest = entry['target']
+        if self.digest(target) != target_digest:
+            return False
+        for dependency, dependency_digest in entry['dependencies'].items():
+            if self.digest(dependency) != dependency_digest:
+                return False
+        return True
+
+    def dependents(self, path):
+        """Get a set of sources which were built using the file on path."""
+        return set(self._dependents.get(path, ()))
+
+    def record(self, source, target, dependencies, digests=None):
+        """
+        Record successful conversion of the source.
+
+        digests - dictionary of digests of files used by the conversion
+            (see convert_document()), files missing in it are digested now
+        """
+        digests = digests or {}
+
+        def digest(path):
+            if path in digests:
+                return digests[path]
+            return self.digest(path)
+
+        self.forget(source)
+        self._documents[source] = {
+            'source': digest(source),
+            'target': [target, digest(target)],
+            'dependencies': {dep: digest(dep) for dep in dependencies},
+        }
+        for dependency in dependencies:
+            self._dependents[dependency].add(source)
+
+    def forget(self, source):
+        """Remove record of the source, so it will be converted next time."""
+        entry = self._documents.pop(source, None)
+        if entry is None:
+            return
+        for dependency in entry['dependencies']:
+            self._dependents[dependency].discard(source)
+            if not self._dependents[dependency]:
+                del self._dependents[dependency]
+
+    def prune(self, sources):
+        """Forget all documents that are not in the sources collection."""
+        sources = set(sources)
+        for source in list(self._documents):
+            if source not in sources:
+                self.forget(source)
@@ -0,0 +1,212 @@
+# Oxalis -- A website building tool for Gnome
+# Copyright (C) 2014 Sergej Chodarev
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+"""
+Command line interface for working with sites without the graphical
+application. This module must not import Gtk, so it can run on servers
+without display.
+"""
+
+import argparse
+import json
+import sys
+import time
+
+from oxalis.site import Site, check_site_format
+
+# Names of deploy.ARCHIVE_FORMATS -- deploy and upload modules (and paramiko
+# used by them) are imported only by commands which need them
+ARCHIVE_FORMATS = ['tar', 'tar.gz', 'zip']
+
+
+def build(args):
+    """Generate site output files."""
+    if check_site_format(args.site) != '0.3':
+        print("%s: not an Oxalis 0.3 site" % args.site, file=sys.stderr)
+        return 2
+    site = Site(args.site)
+    summary = site.generate(force=args.force, workers=args.workers)
+    for error in site.errors:
+        print("%s: %s" % (error.file, error.message), file=sys.stderr)
+    print("%d pages rebuilt, %d skipped, %d errors in %.2f s" %
+          (summary.rebuilt, summary.skipped, len(site.errors),
+           site.build_report.time))
+    return 1 if len(site.errors) > 0 else 0
+
+
+def upload_site(args):
+    """Upload changed files to the configured server and delete removed."""
+    from oxalis import upload
+    if check_site_format(args.site) != '0.3':
+        print("%s: not an Oxalis 0.3 site" % args.site, file=sys.stderr)
+        return 2
+    site = Site(args.site)
+    if not upload.is_configured(site):
+        print("%s: uploading is not configured" % args.site, file=sys.stderr)
+        return 2
+    return run_deploy(
+        args, lambda progress: upload.upload_site(
+            site, args.connections, progress, dry_run=args.dry_run))
+
+
+def deploy_site(args):
+    """Copy publishable files into a local directory or an archive."""
+    from oxalis import deploy
+    if check_site_format(args.site) != '0.3':
+        print("%s: not an Oxalis 0.3 site" % args.site, file=sys.stderr)
+        return 2
+    site = Site(args.site)
+    format = args.format or deploy.archive_format(args.destination)
+    if args.destination == '-' and format is None:
+        print("Archive format must be specified for output to stdout",
+              file=sys.stderr)
+        return 2
+    if format is None:
+        deployer = deploy.DirectoryDeployer(site, args.destination,
+                                            args.hardlink)
+        return run_deploy(
+            args, lambda progress: deployer.deploy(progress, args.dry_run),
+            "copied")
+    if args.dry_run:
+        print("Archives are always written whole", file=sys.stderr)
+        return 2
+    if args.destination == '-':
+        # Progress is printed to stderr, stdout contains the archive
+        return run_deploy(
+            args, lambda progress: archive_plan(
+                deploy.write_archive(site, sys.stdout.buffer, format,
+                                     progress)),
+            "archived", sys.stderr)
+    with open(args.destination, 'wb') as f:
+        return run_deploy(
+            args, lambda progress: archive_plan(
+                deploy.write_archive(site, f, format, progress)),
+            "archived")
+
+
+def archive_plan(files):
+    from oxalis import upload
+    return upload.DeployPlan(files, [], [], [])
+
+
+def run_deploy(args, transfer, verb="uploaded", output=None):
+    """
+    Run transfer(progress) returning DeployPlan and print its progress and
+    summary to output (stdout by default) in format specified by arguments.
+    Returns exit code.
+    """
+    from oxalis import upload
+    json_progress = args.progress == 'json'
+    if output is None:
+        output = sys.stdout
+
+    def progress(action, path, status):
+        if json_progress:
+            print(upload.progress_event(action, path, status), file=output,
+                  flush=True)
+        elif action != 'start':
+            done = verb.capitalize() if action == 'upload' else "Deleted"
+            print("%s %s [%d/%d]" % (done, path, status.files_done,
+                                     status.files_total), file=output)
+
+    start = time.perf_counter()
+    try:
+        plan = transfer(progress)
+    except upload.UploadError as e:
+        if json_progress:
+            print(json.dumps({'event': 'error', 'message': str(e)}),
+                  file=output)
+        else:
+            print(e, file=sys.stderr)
+        return 1
+    if json_progress:
+        event = plan._asdict()
+        event.update(event='plan' if args.dry_run else 'done',
+                     time=time.perf_counter() - start)
+        print(json.dumps(event), file=output)
+    elif args.dry_run:
+        for mark, paths in [('A', plan.added), ('M', plan.changed),
+                            ('D', plan.deleted)]:
+            for path in paths:
+                print("%s %s" % (mark, path), file=output)
+        print("%d files to add, %d to change, %d to delete, %d unchanged" %
+              (len(plan.added), len(plan.changed), len(plan.deleted),
+               len(plan.unchanged)), file=output)
+    else:
+        print("%d files %s, %d deleted, %d unchanged in %.2f s" %
+              (len(plan.added) + len(plan.changed), verb, len(plan.deleted),
+               len(plan.unchanged), time.perf_counter() - start),
+              file=output)
+    return 0
+
+
+def create_parser():
+    parser = argparse.ArgumentParser(prog='oxalis')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+    build_parser = subparsers.add_parser('build',
+                                         help="generate site output files")
+    build_parser.add_argument('site', help="path to the site directory")
+    build_parser.add_argument('-f', '--force', action='store_true',
+                              help="convert all documents, even unchanged")
+    build_parser.add_argument('-j', '--workers', type=int,
+                              help="number of worker processes "
+                                   "(0 for one per CPU core)")
+    build_parser.set_defaults(func=build)
+    upload_parser = subparsers.add_parser(
+        'upload', help="synchronize the server with the site")
+    upload_parser.add_argument('site', help="path to the site directory")
+    upload_parser.add_argument('-c', '--connections', type=int,
+                               help="number of parallel connections")
+    upload_parser.add_argument('-n', '--dry-run', action='store_true',
+                               help="only show what would be changed")
+    upload_parser.add_argument('--progress', choices=['text', 'json'],
+                               default='text',
+                               help="format of progress output (json "
+                                    "prints one event per line)")
+    upload_parser.set_defaults(func=upload_site)
+    deploy_parser = subparsers.add_parser(
+        'deploy', help="copy the site into a directory or an archive")
+    deploy_parser.add_argument('site', help="path to the site directory")
+    deploy_parser.add_argument('destination',
+                               help="target directory, or archive file "
+                                    "(.tar, .tar.gz or .zip; - for stdout)")
+    deploy_parser.add_argument('-f', '--format',
+                               choices=ARCHIVE_FORMATS,
+                               help="archive format (guessed from the "
+                                    "destination file name)")
+    deploy_parser.add_argument('-l', '--hardlink', action='store_true',
+                               help="hardlink files to the site instead of "
+                                    "copying")
+    deploy_parser.add_argument('-n', '--dry-run', action='store_true',
+                               help="only show what would be changed")
+    deploy_parser.add_argument('--progress', choices=['text', 'json'],
+                               default='text',
+                               help="format of progress output (json "
+                                    "prints one event per line)")
+    deploy_parser.set_defaults(func=deploy_site)
+    return parser
+
+
+def main(argv=None):
+    """Run command specified by command line arguments. Returns exit code."""
+    args = create_parser().parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -44,6 +44,10 @@ class Configuration(ConfigParser):
         """Set an integer option value."""
         self.set(section, option, str(value))
 
+    def setboolean(self, section, option, value):
+        """Set a boolean option value."""
+        self.set(section, option, 'true' if value else 'false')
+
     def save(self):
         """Write configuration to file."""
         directory = os.path.dirname(self.filename)
@@ -20,9 +20,10 @@ Converters handle the conversion of source files to targets.
 
 They must implement the converters.Converter abstract base class.
 """
+from oxalis.converters.assets import AssetConverter
 from oxalis.converters.markdown import MarkdownConverter
 
-registry = [MarkdownConverter]
+registry = [MarkdownConverter, AssetConverter]
 
 
 def matching_converter(site_path, path):
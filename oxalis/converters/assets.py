@@ -0,0 +1,334 @@
+# Oxalis -- A website building tool for Gnome
+# Copyright (C) 2014 Sergej Chodarev
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+"""
+Bundling and minification of CSS and JavaScript assets.
+
+A bundle is a text file named after the asset it produces with suffix
+'.bundle' (like 'css/site.css.bundle'), listing files to concatenate, one
+per line, relative to the bundle directory. Lines starting with '#' are
+comments. The minified result is written next to the bundle with
+a fingerprint (content hash) in its name, like 'css/site.0123456789.css',
+so it can be cached by browsers forever. Templates refer to it by the
+logical name using the asset() function, e.g. {{ asset('css/site.css') }}.
+
+The fingerprint is computed from the sources, so the target name is known
+without running the conversion. Older versions of the target are deleted
+when a new one is written.
+"""
+
+import hashlib
+import os
+import re
+from time import perf_counter
+
+from oxalis.converters.base import (Converter, ConversionStats, ErrorMessage,
+                                   write_output)
+
+BUNDLE_SUFFIX = '.bundle'
+# Changing the version changes all fingerprints, change it together with
+# the output of minifiers
+MINIFIER_VERSION = b'1'
+FINGERPRINT_LENGTH = 10
+FINGERPRINTED = re.compile(r'\.[0-9a-f]{%d}\.(css|js)\Z' % FINGERPRINT_LENGTH)
+
+
+def is_fingerprinted(path):
+    """Check if the path looks like a fingerprinted asset."""
+    return FINGERPRINTED.search(path) is not None
+
+
+class AssetConverter(Converter):
+    """
+    Concatenates files listed in a bundle and minifies the result.
+    """
+    def __init__(self, site_path, path):
+        self.site_path = site_path
+        self.path = path
+        self.full_path = os.path.join(site_path, path)
+        self.logical_path = path[:-len(BUNDLE_SUFFIX)]
+        self._sources = None  # (bundle stat, list of component paths)
+        self._fingerprint = None  # (signature, fingerprint)
+
+    @staticmethod
+    def matches(path):
+        return path.endswith(('.css' + BUNDLE_SUFFIX, '.js' + BUNDLE_SUFFIX))
+
+    def target(self):
+        base, ext = os.path.splitext(self.logical_path)
+        return '%s.%s%s' % (base, self.fingerprint(), ext)
+
+    def dependencies(self):
+        """Paths to the bundled files."""
+        return self.components()
+
+    def components(self):
+        """Get paths (relative to the site) of files listed in the bundle."""
+        try:
+            stat = os.stat(self.full_path)
+        except OSError:
+            return []
+        key = (stat.st_mtime_ns, stat.st_size)
+        if self._sources is None or self._sources[0] != key:
+            directory = os.path.dirname(self.path)
+            with open(self.full_path) as f:
+                components = [os.path.normpath(os.path.join(directory, line))
+                              for line in (line.strip() for line in f)
+                              if line and not line.startswith('#')]
+            self._sources = (key, components)
+        return self._sources[1]
+
+    def fingerprint(self):
+        """
+        Hash of the bundle and all its components. It is cached until
+        some of the files changes.
+        """
+        paths = [self.path] + self.components()
+        signature = []
+        for path in paths:
+            try:
+                stat = os.stat(os.path.join(self.site_path, path))
+                signature.append((path, stat.st_mtime_ns, stat.st_size))
+            except OSError:
+                signature.append((path, None, None))
+        if self._fingerprint is None or self._fingerprint[0] != signature:
+            sha = hashlib.sha1(MINIFIER_VERSION)
+            for path in paths:
+                sha.update(path.encode('utf-8') + b'\0')
+                try:
+                    with open(os.path.join(self.site_path, path), 'rb') as f:
+                        sha.update(f.read())
+                except OSError:
+                    pass  # Reported as error by the conversion
+            self._fingerprint = (signature,
+                                 sha.hexdigest()[:FINGERPRINT_LENGTH])
+        return self._fingerprint[1]
+
+    def convert(self):
+        data, error = self.render()
+        if error is None:
+            start = perf_counter()
+            target = self.target()
+            write_output(os.path.join(self.site_path, target), data)
+            self._remove_old_versions(target)
+            self.stats = self.stats._replace(write=perf_counter() - start)
+        return error
+
+    def render(self):
+        read = parse = 0.0
+        size = 0
+        start = perf_counter()
+        try:
+            texts = []
+            for path in self.components():
+                if not self._inside_site(path):
+                    return None, ErrorMessage(
+                        self.path, "Asset '%s' is outside of the site" % path)
+                try:
+                    with open(os.path.join(self.site_path, path),
+                              encoding='utf-8') as f:
+                        texts.append(f.read())
+                except OSError:
+                    return None, ErrorMessage(
+                        self.path, "Asset '%s' was not found" % path)
+            read = perf_counter() - start
+
+            start = perf_counter()
+            if self.logical_path.endswith('.css'):
+                text = '\n'.join(minify_css(text) for text in texts)
+            else:
+                text = ';\n'.join(minify_js(text) for text in texts)
+            data = text.encode('utf-8')
+            parse = perf_counter() - start
+            size = len(data)
+            return data, None
+        finally:
+            self.stats = ConversionStats(read, parse, 0.0, 0.0, size)
+
+    def _inside_site(self, path):
+        """Check if the path (possibly absolute) points into the site."""
+        site_path = os.path.abspath(self.site_path)
+        full_path = os.path.normpath(os.path.join(site_path, path))
+        return full_path.startswith(os.path.join(site_path, ''))
+
+    def _remove_old_versions(self, target):
+        """Delete previous fingerprinted versions of the target."""
+        base, ext = os.path.splitext(self.logical_path)
+        directory, name = os.path.split(base)
+        pattern = re.compile(r'%s\.[0-9a-f]{%d}%s\Z' % (
+            re.escape(name), FINGERPRINT_LENGTH, re.escape(ext)))
+        full_directory = os.path.join(self.site_path, directory)
+        for entry in os.listdir(full_directory):
+            if (pattern.match(entry)
+                    and os.path.join(directory, entry) != target):
+                os.remove(os.path.join(full_directory, entry))
+
+
+CSS_TOKENS = re.compile(r'''
+    ("(?:[^"\\\n]|\\.)*"|'(?:[^'\\\n]|\\.)*')  # string
+  | (/\*.*?(?:\*/|\Z))                         # comment
+  | (\s+)                                      # whitespace
+  | ([^"'/\s{};,>:()!]+|.)                    # anything else
+''', re.VERBOSE | re.DOTALL)
+# Spaces after and before these characters are not needed
+CSS_NO_SPACE_AFTER = '{};,>:('
+CSS_NO_SPACE_BEFORE = '{};,>)!'
+
+
+def minify_css(text):
+    """
+    Remove comments (except of '/*! ... */' license comments) and
+    unnecessary whitespace from CSS.
+    """
+    output = []
+    space = False
+    for match in CSS_TOKENS.finditer(text):
+        string, comment, whitespace, other = match.groups()
+        if whitespace is not None or (comment is not None
+                                      and not comment.startswith('/*!')):
+            space = True
+            continue
+        token = string or comment or other
+        last = output[-1][-1] if output else ''
+        if (space and last and last not in CSS_NO_SPACE_AFTER
+                and token[0] not in CSS_NO_SPACE_BEFORE):
+            output.append(' ')
+        elif token[0] == '}' and last == ';' and string is None:
+            output[-1] = output[-1][:-1]  # Last semicolon is optional
+            if not output[-1]:
+                output.pop()
+        output.append(token)
+        space = False
+    return ''.join(output)
+
+
+JS_WORD = re.compile(r'[\w$\u0080-\uffff]')
+# Regular expression literal may follow these characters or keywords,
+# otherwise '/' is division
+JS_REGEX_AFTER = set('(,=:[!&|?{};+-*%<>~^')
+JS_REGEX_KEYWORDS = {'return', 'typeof', 'case', 'do', 'else', 'in',
+                     'instanceof', 'new', 'delete', 'void', 'throw', 'yield',
+                     'await'}
+
+
+def minify_js(text):
+    """
+    Remove comments (except of '/*! ... */' license comments) and
+    unnecessary whitespace from JavaScript.
+
+    The minification is conservative -- line breaks are kept, so automatic
+    semicolon insertion works as in the original code, and names are not
+    changed.
+    """
+    output = []
+    space = None  # None, ' ' or '\n' -- whitespace waiting to be written
+    i = 0
+    length = len(text)
+    while i < length:
+        char = text[i]
+        if char.isspace():
+            j = i
+            while j < length and text[j].isspace():
+                j += 1
+            space = '\n' if '\n' in text[i:j] or space == '\n' else ' '
+            i = j
+            continue
+        if text.startswith('//', i):
+            end = text.find('\n', i)
+            i = length if end < 0 else end
+            continue
+        if text.startswith('/*', i):
+            end = text.find('*/', i + 2)
+            end = length if end < 0 else end + 2
+            comment = text[i:end]
+            i = end
+            if not comment.startswith('/*!'):
+                space = '\n' if '\n' in comment or space == '\n' else \
+                    space or ' '
+                continue
+            token = comment
+        elif char in '"\'`':
+            token = text[i:_string_end(text, i)]
+            i += len(token)
+        elif char == '/' and _regex_allowed(output):
+            token = text[i:_regex_end(text, i)]
+            i += len(token)
+        else:
+            token = char
+            i += 1
+            while (i < length and JS_WORD.match(token[0])
+                   and JS_WORD.match(text[i])):
+                token += text[i]
+                i += 1
+        if space is not None and output:
+            last = output[-1][-1]
+            if space == '\n':
+                output.append('\n')
+            elif (JS_WORD.match(last) and (JS_WORD.match(token[0])
+                                           or token[0] == '.')
+                  or last in '+-' and token[0] in '+-'
+                  or last == '/' or token[0] == '/'):
+                output.append(' ')
+        space = None
+        output.append(token)
+    return ''.join(output)
+
+
+def _string_end(text, start):
+    """Index after the end of string or template literal on start."""
+    quote = text[start]
+    i = start + 1
+    while i < len(text):
+        if text[i] == '\\':
+            i += 2
+            continue
+        if text[i] == quote or (text[i] == '\n' and quote != '`'):
+            return i + 1
+        i += 1
+    return len(text)
+
+
+def _regex_end(text, start):
+    """Index after the end of regular expression literal on start."""
+    i = start + 1
+    in_class = False
+    while i < len(text) and text[i] != '\n':
+        char = text[i]
+        if char == '\\':
+            i += 2
+            continue
+        if char == '[':
+            in_class = True
+        elif char == ']':
+            in_class = False
+        elif char == '/' and not in_class:
+            i += 1
+            while i < len(text) and JS_WORD.match(text[i]):
+                i += 1  # Flags
+            return i
+        i += 1
+    return i
+
+
+def _regex_allowed(output):
+    """Check if '/' after the output starts a regular expression."""
+    if not output:
+        return True
+    last = output[-1]
+    if last in (' ', '\n'):
+        last = output[-2]  # Whitespace is never repeated
+    return last[-1] in JS_REGEX_AFTER or last in JS_REGEX_KEYWORDS
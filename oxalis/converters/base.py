@@ -2,10 +2,17 @@
 # Copyright (C) 2014 Sergej Chodarev
 from abc import ABCMeta, abstractmethod
 from collections import namedtuple
+import os
+import secrets
+import stat
 
 
 class Converter(metaclass=ABCMeta):
     """Protocol that must be implemented by all converter classes."""
+
+    stats = None
+    """Statistics of the last conversion (ConversionStats), or None."""
+
     @abstractmethod
     def __init__(self, site_path, file_path):
         pass
@@ -36,10 +43,90 @@ class Converter(metaclass=ABCMeta):
     @abstractmethod
     def convert(self):
         """
-        Do the conversion.
+        Do the conversion and store its statistics into self.stats.
         Returns an ErrorMessage if some error occurred, or None otherwise.
         """
         pass
 
+    @abstractmethod
+    def render(self):
+        """
+        Do the conversion in memory, without writing the target, and store
+        its statistics into self.stats.
+        Returns tuple (data, error) -- generated bytes and None, or None and
+        an ErrorMessage if some error occurred.
+        """
+        pass
+
 
 ErrorMessage = namedtuple('ErrorMessage', ['file', 'message'])
+
+
+class ConversionStats(namedtuple('ConversionStats',
+                                 ['read', 'parse', 'render', 'write', 'size'])):
+    """
+    Durations of conversion phases (in seconds) and size of the output (in
+    bytes). Phases not used by a converter have zero duration.
+    """
+    __slots__ = ()
+
+    @property
+    def total(self):
+        """Total duration of the conversion."""
+        return self.read + self.parse + self.render + self.write
+
+
+def _create_temp_file(full_path):
+    """
+    Create a temporary file next to full_path and open it for writing.
+
+    The file has a hidden unique name, so it is ignored by the site and
+    concurrent writers of the same target do not share it. Unlike mkstemp(),
+    the file is created with the usual mode limited by the umask.
+    Returns tuple (file descriptor, path).
+    """
+    directory, name = os.path.split(full_path)
+    while True:
+        temp_path = os.path.join(directory, '.{}.{}.tmp'.format(
+            name, secrets.token_hex(4)))
+        try:
+            fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL,
+                         0o666)
+        except FileExistsError:
+            continue
+        return fd, temp_path
+
+
+def write_output(full_path, data):
+    """
+    Write generated data (bytes) into file on full_path.
+
+    Nothing is written if the file already has the same contents, so its
+    modification time is preserved. Otherwise the text is written into
+    a temporary file which then atomically replaces the target, so readers
+    never see a partially written file.
+    Returns True if the file was written.
+    """
+    try:
+        old_stat = os.stat(full_path)
+    except OSError:
+        old_stat = None
+    if old_stat is not None and old_stat.st_size == len(data):
+        with open(full_path, 'rb') as f:
+            if f.read() == data:
+                return False
+
+    fd, temp_path = _create_temp_file(full_path)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        if old_stat is not None:
+            os.chmod(temp_path, stat.S_IMODE(old_stat.st_mode))
+        os.replace(temp_path, full_path)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except FileNotFoundError:
+            pass  # Already gone, do not hide the original error
+        raise
+    return True
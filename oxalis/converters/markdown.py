@@ -16,12 +16,142 @@
 # Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
 
 import os.path
+import posixpath
+import threading
+from time import perf_counter
+
 from markdown import Markdown
 import jinja2
+import jinja2.meta
 
-from oxalis.converters.base import Converter, ErrorMessage
+from oxalis.converters.assets import BUNDLE_SUFFIX, AssetConverter
+from oxalis.converters.base import (Converter, ConversionStats, ErrorMessage,
+                                   write_output)
 
 TEMPLATES_DIR = '_templates'
+BYTECODE_CACHE_DIR = os.path.join('_oxalis', 'jinja-cache')
+
+
+class MarkdownContext:
+    """
+    Markdown parser and Jinja environment shared by all pages of a site.
+
+    Use MarkdownContext.for_site() to get the context of a site, so the
+    templates are loaded and compiled only once for the whole site.
+    Markdown parser is not thread safe, so each thread gets its own.
+    """
+    _contexts = {}  # site path -> MarkdownContext
+    _contexts_lock = threading.Lock()
+
+    @classmethod
+    def for_site(cls, site_path):
+        """Get shared context for the site on site_path."""
+        with cls._contexts_lock:
+            context = cls._contexts.get(site_path)
+            if context is None:
+                context = cls._contexts[site_path] = cls(site_path)
+            return context
+
+    def __init__(self, site_path):
+        self.site_path = site_path
+        self.templates_dir = os.path.join(site_path, TEMPLATES_DIR)
+        self._local = threading.local()
+        self.env = jinja2.Environment(
+            loader=jinja2.FileSystemLoader(self.templates_dir),
+            bytecode_cache=self._create_bytecode_cache(site_path))
+        self._references = {}  # template name -> (uptodate, referenced names)
+        self._assets = {}  # bundle path -> AssetConverter
+
+    @staticmethod
+    def _create_bytecode_cache(site_path):
+        """
+        Create persistent cache of compiled templates inside site
+        configuration directory. Cached bytecode is stored together with
+        checksum of template source, so it is not used after template change.
+        """
+        if not os.path.isdir(os.path.join(site_path, '_oxalis')):
+            return None  # Not a complete site, do not create anything
+        cache_dir = os.path.join(site_path, BYTECODE_CACHE_DIR)
+        os.makedirs(cache_dir, exist_ok=True)
+        return jinja2.FileSystemBytecodeCache(cache_dir)
+
+    @property
+    def markdown(self):
+        """Markdown parser for the current thread."""
+        markdown = getattr(self._local, 'markdown', None)
+        if markdown is None:
+            markdown = self._local.markdown = Markdown(
+                extensions=['meta', 'extra'])
+        return markdown
+
+    def convert_markdown(self, text):
+        """Convert Markdown text into template context dictionary."""
+        html = self.markdown.convert(text)
+        context = {'content': html}
+        if hasattr(self.markdown, 'Meta'):
+            for key, value in self.markdown.Meta.items():
+                context[key] = "\n".join(value)
+        self.markdown.reset()
+        return context
+
+    def resolve_asset(self, name, page):
+        """
+        Get URL of the asset with logical name (path relative to the site,
+        like 'css/site.css') relative to the page on path page. Assets built
+        from bundles are resolved to their fingerprinted files, other names
+        are used as they are.
+        Returns tuple (url, dependencies) -- dependencies are paths to files
+        which change the URL when they change.
+        """
+        path = os.path.normpath(name.lstrip('/'))
+        bundle = path + BUNDLE_SUFFIX
+        if os.path.exists(os.path.join(self.site_path, bundle)):
+            converter = self._assets.get(bundle)
+            if converter is None:
+                converter = self._assets[bundle] = AssetConverter(
+                    self.site_path, bundle)
+            target = converter.target()
+            dependencies = [bundle] + converter.dependencies()
+        else:
+            target = path
+            dependencies = [bundle]  # Using a bundle would change the URL
+        url = posixpath.relpath(target.replace(os.sep, '/'),
+                                posixpath.dirname(page.replace(os.sep, '/'))
+                                or '.')
+        return url, dependencies
+
+    def referenced_templates(self, name):
+        """
+        Get names of the template and of all templates referenced from it,
+        directly or indirectly. Templates referenced dynamically (by a
+        variable) can not be detected.
+        """
+        names = []
+        pending = [name]
+        while pending:
+            name = pending.pop()
+            if name in names:
+                continue
+            names.append(name)
+            pending.extend(self._direct_references(name))
+        return names
+
+    def _direct_references(self, name):
+        """Names of templates referenced directly from the template."""
+        cached = self._references.get(name)
+        if cached is not None and cached[0]():
+            return cached[1]
+        try:
+            source, __, uptodate = self.env.loader.get_source(self.env, name)
+            ast = self.env.parse(source)
+        except (jinja2.TemplateNotFound, jinja2.TemplateSyntaxError):
+            return []
+        references = [referenced for referenced
+                      in jinja2.meta.find_referenced_templates(ast)
+                      if referenced is not None]
+        if uptodate is not None:
+            self._references[name] = (uptodate, references)
+        return references
 
 
 class MarkdownConverter(Converter):
@@ -34,9 +164,9 @@ class MarkdownConverter(Converter):
         base, ext = os.path.splitext(self.path)
         self.target_path = base + ".html"
         self.full_target_path = os.path.join(site_path, self.target_path)
-        self._md = Markdown(extensions=['meta', 'extra'])
-        templates_dir = os.path.join(site_path, TEMPLATES_DIR)
-        self._env = jinja2.Environment(loader=jinja2.FileSystemLoader(templates_dir))
+        self._context = MarkdownContext.for_site(site_path)
+        self._template_name = None
+        self._asset_dependencies = []
 
     @staticmethod
     def matches(path):
@@ -46,33 +176,67 @@ class MarkdownConverter(Converter):
         return self.target_path
 
     def dependencies(self):
-        return []  # Not implemented
+        """
+        Paths to the page template and all templates it extends, includes or
+        imports, and files of assets referenced in the last rendering.
+        """
+        if self._template_name is None:
+            with open(self.full_path) as f:
+                self._template_name = self._get_template_name(
+                    self._context.convert_markdown(f.read()))
+        names = self._context.referenced_templates(self._template_name)
+        return ([os.path.join(TEMPLATES_DIR, name) for name in names]
+                + self._asset_dependencies)
 
-    def _convert_markdown(self, text):
-        html = self._md.convert(text)
-        context = {'content': html}
-        if hasattr(self._md, 'Meta'):
-            for key, value in self._md.Meta.items():
-                context[key] = "\n".join(value)
-        self._md.reset()
-        return context
+    @staticmethod
+    def _get_template_name(context):
+        return context.get("template", "default") + ".html"
 
     def convert(self):
+        data, error = self.render()
+        if error is None:
+            start = perf_counter()
+            write_output(self.full_target_path, data)
+            self.stats = self.stats._replace(write=perf_counter() - start)
+        return error
+
+    def render(self):
+        render = 0.0
+        size = 0
+
+        start = perf_counter()
         with open(self.full_path) as f:
             text = f.read()
-        context = self._convert_markdown(text)
-        template_name = context.get("template", "default") + ".html"
+        read = perf_counter() - start
 
-        try:
-            template = self._env.get_template(template_name)
-            full_html = template.render(context)
+        start = perf_counter()
+        context = self._context.convert_markdown(text)
+        self._template_name = self._get_template_name(context)
+        parse = perf_counter() - start
+
+        assets = []
 
-            with open(self.full_target_path, "w") as f:
-                f.write(full_html)
+        def asset(name):
+            url, dependencies = self._context.resolve_asset(name,
+                                                            self.target_path)
+            assets.extend(path for path in dependencies if path not in assets)
+            return url
+
+        try:
+            start = perf_counter()
+            template = self._context.env.get_template(self._template_name)
+            data = template.render(context, asset=asset).encode('utf-8')
+            self._asset_dependencies = assets
+            render = perf_counter() - start
+            size = len(data)
+            return data, None
 
         except jinja2.TemplateNotFound as e:
-            return ErrorMessage(self.path, "Template '%s' was not found" % (e.name,))
+            return None, ErrorMessage(
+                self.path, "Template '%s' was not found" % (e.name,))
         except jinja2.TemplateSyntaxError as e:
-            return ErrorMessage(os.path.join(TEMPLATES_DIR, e.name),
-                                "Template syntax error: %s" % (e.message,))
-
+            return None, ErrorMessage(
+                os.path.join(TEMPLATES_DIR, e.name),
+                "Template syntax error: %s" % (e.message,))
+        finally:
+            self.stats = ConversionStats(read, parse, render, 0.0, size)
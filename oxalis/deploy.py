@@ -0,0 +1,296 @@
+# Oxalis -- A website building tool for Gnome
+# Copyright (C) 2014 Sergej Chodarev
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+"""
+Deployment of publishable site files into a local directory or an archive.
+
+A directory is updated incrementally using the same manifest as uploads:
+unchanged files are skipped and files with the same contents as an already
+deployed file are hardlinked to it. New files are reflinked from the site
+if the file system supports it, so their data are not copied.
+
+Archives (tar, compressed tar or zip) are always written whole, but can be
+streamed to a pipe. Tar archives store duplicate files as hard links.
+"""
+
+import errno
+import fcntl
+import os
+import shutil
+import tarfile
+import zipfile
+
+from oxalis.upload import (DeployManifest, ProgressTracker, UploadError,
+                           parent_directories, publishable_files)
+
+# Archive formats -- format name -> file name extensions
+ARCHIVE_FORMATS = {
+    'tar': ('.tar',),
+    'tar.gz': ('.tar.gz', '.tgz'),
+    'zip': ('.zip',),
+}
+# Files which are already compressed, so zip stores them without compression
+COMPRESSED_EXTENSIONS = {'.gif', '.gz', '.jpeg', '.jpg', '.mp3', '.mp4',
+                         '.ogg', '.pdf', '.png', '.webm', '.webp', '.woff',
+                         '.woff2', '.zip'}
+# Linux ioctl cloning contents of one file into another (a reflink)
+FICLONE = 0x40049409
+# Errors meaning that reflinks or hard links are not supported
+UNSUPPORTED_ERRORS = {errno.EOPNOTSUPP, errno.EXDEV, errno.EINVAL,
+                      errno.ENOTTY, errno.EPERM, errno.EMLINK}
+
+
+def archive_format(path):
+    """Get archive format for the file name, or None for a directory."""
+    for name, extensions in ARCHIVE_FORMATS.items():
+        if path.endswith(extensions):
+            return name
+    return None
+
+
+class DirectoryDeployer:
+    """
+    Deploys site files into a local directory.
+
+    If hardlink is True, files are hardlinked to the site files instead of
+    copying (the site and the directory must be on the same file system,
+    otherwise files are copied). Otherwise files are reflinked or copied.
+    """
+
+    def __init__(self, site, directory, hardlink=False):
+        self.site = site
+        self.directory = os.path.abspath(directory)
+        self.hardlink = hardlink
+        self.target = 'file://' + self.directory
+        self.manifest = DeployManifest(site.directory)
+        self._reflink_supported = True
+        # Hard links between directories -- ('site' or 'target') -> bool
+        self._link_supported = {'site': True, 'target': True}
+
+    def plan(self):
+        """Compute DeployPlan. Missing target files are planned as added."""
+        files = publishable_files(self.site)
+        plan = self.manifest.plan(self.target, files)
+        missing = [path for path in plan.unchanged
+                   if not os.path.exists(self._destination(path))]
+        if not missing:
+            return plan
+        return plan._replace(
+            added=sorted(plan.added + missing),
+            unchanged=[path for path in plan.unchanged if path not in missing])
+
+    def deploy(self, progress=None, dry_run=False):
+        """
+        Bring the directory up to date. progress(action, path, status) is
+        called like in upload.upload_site(). Returns DeployPlan.
+        Raises UploadError on failure.
+        """
+        site_directory = os.path.join(os.path.abspath(self.site.directory), '')
+        if os.path.join(self.directory, '').startswith(site_directory):
+            raise UploadError("Can not deploy into the site directory")
+        plan = self.plan()
+        if dry_run:
+            self.manifest.save()  # Keep computed digests
+            return plan
+        transferred = plan.added + plan.changed
+        tracker = ProgressTracker(
+            len(transferred) + len(plan.deleted),
+            sum(os.path.getsize(self._source(path)) for path in transferred))
+        if progress is not None:
+            progress('start', None, tracker.status())
+
+        # Deployed files by contents, for reuse by identical files
+        existing = {}
+        deployed = self.manifest.files(self.target)
+        for path in plan.unchanged:
+            existing.setdefault(deployed[path], path)
+        try:
+            for path in transferred:
+                digest = self.manifest.digest(path)
+                try:
+                    self._place(path, existing.get(digest))
+                except OSError as e:
+                    raise UploadError("Can not deploy %s: %s" % (path, e))
+                existing[digest] = path
+                self.manifest.deployed(self.target, path)
+                tracker.add(os.path.getsize(self._source(path)))
+                if progress is not None:
+                    progress('upload', path, tracker.status())
+            self._delete(plan.deleted, plan.added + plan.changed +
+                         plan.unchanged, tracker, progress)
+        finally:
+            self.manifest.save()
+        return plan
+
+    def _source(self, path):
+        return os.path.join(self.site.directory, path)
+
+    def _destination(self, path):
+        return os.path.join(self.directory, path)
+
+    def _place(self, path, same):
+        """
+        Write file to the directory, as a hard link to the deployed file
+        on path same if it is not None. The file is replaced atomically.
+        """
+        destination = self._destination(path)
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        temp = destination + '.oxalis-tmp'
+        if os.path.lexists(temp):
+            os.remove(temp)
+        try:
+            if not (same is not None and
+                    self._link(self._destination(same), temp, 'target')):
+                if not (self.hardlink and
+                        self._link(self._source(path), temp, 'site')):
+                    self._copy(self._source(path), temp)
+            os.replace(temp, destination)
+        except BaseException:
+            if os.path.lexists(temp):
+                os.remove(temp)
+            raise
+
+    def _link(self, source, destination, kind):
+        """
+        Try to create a hard link to a file in the site or the target
+        directory (kind is 'site' or 'target'). Returns True on success.
+        """
+        if not self._link_supported[kind]:
+            return False
+        try:
+            os.link(source, destination)
+        except OSError as e:
+            if e.errno not in UNSUPPORTED_ERRORS:
+                raise
+            if e.errno != errno.EMLINK:  # Only this file has too many links
+                self._link_supported[kind] = False
+            return False
+        return True
+
+    def _copy(self, source, destination):
+        """Copy file contents, using a reflink if possible."""
+        if self._reflink_supported:
+            with open(source, 'rb') as src, open(destination, 'wb') as dst:
+                try:
+                    fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+                    return
+                except OSError as e:
+                    if e.errno not in UNSUPPORTED_ERRORS:
+                        raise
+                    self._reflink_supported = False
+        shutil.copyfile(source, destination)
+
+    def _delete(self, files, kept, tracker, progress):
+        """Delete files and directories left empty."""
+        used = set()
+        for path in kept:
+            used.update(parent_directories(path))
+        directories = set()
+        for path in files:
+            try:
+                os.remove(self._destination(path))
+            except FileNotFoundError:
+                pass  # Already deleted
+            except OSError as e:
+                raise UploadError("Can not delete %s: %s" % (path, e))
+            self.manifest.removed(self.target, path)
+            directories.update(parent_directories(path))
+            tracker.add()
+            if progress is not None:
+                progress('delete', path, tracker.status())
+        for directory in sorted(directories - used, reverse=True):
+            try:
+                os.rmdir(self._destination(directory))
+            except OSError:
+                pass  # Not empty or already removed
+
+
+def write_archive(site, fileobj, format, progress=None):
+    """
+    Write all publishable files into an archive of given format (see
+    ARCHIVE_FORMATS) written to file object fileobj, which does not need
+    to be seekable. progress(action, path, status) is called like in
+    upload.upload_site(). Returns list of archived files.
+    """
+    files = publishable_files(site)
+    manifest = DeployManifest(site.directory)
+    sizes = {path: os.path.getsize(os.path.join(site.directory, path))
+             for path in files}
+    tracker = ProgressTracker(len(files), sum(sizes.values()))
+    if progress is not None:
+        progress('start', None, tracker.status())
+    if format == 'zip':
+        archive = _ZipWriter(fileobj)
+    else:
+        mode = 'w|gz' if format == 'tar.gz' else 'w|'
+        archive = _TarWriter(tarfile.open(fileobj=fileobj, mode=mode))
+    try:
+        first = {}  # digest -> first archived path with these contents
+        for path in files:
+            digest = manifest.digest(path)
+            archive.add(os.path.join(site.directory, path),
+                        path.replace(os.sep, '/'), first.get(digest))
+            first.setdefault(digest, path.replace(os.sep, '/'))
+            tracker.add(sizes[path])
+            if progress is not None:
+                progress('upload', path, tracker.status())
+    except OSError as e:
+        raise UploadError("Can not write archive: %s" % e)
+    finally:
+        archive.close()
+        manifest.save()
+    return files
+
+
+class _TarWriter:
+    """Tar archive storing duplicate files as hard links."""
+
+    def __init__(self, tar):
+        self.tar = tar
+
+    def add(self, full_path, name, same):
+        info = self.tar.gettarinfo(full_path, name)
+        info.uid = info.gid = 0
+        info.uname = info.gname = ''
+        if same is not None:
+            info.type = tarfile.LNKTYPE
+            info.linkname = same
+            info.size = 0
+            self.tar.addfile(info)
+        else:
+            with open(full_path, 'rb') as f:
+                self.tar.addfile(info, f)
+
+    def close(self):
+        self.tar.close()
+
+
+class _ZipWriter:
+    """Zip archive compressing only files which are not compressed already."""
+
+    def __init__(self, fileobj):
+        self.zip = zipfile.ZipFile(fileobj, 'w', zipfile.ZIP_DEFLATED)
+
+    def add(self, full_path, name, same):
+        extension = os.path.splitext(name)[1].lower()
+        compression = (zipfile.ZIP_STORED
+                       if extension in COMPRESSED_EXTENSIONS
+                       else zipfile.ZIP_DEFLATED)
+        self.zip.write(full_path, name, compression)
+
+    def close(self):
+        self.zip.close()
@@ -20,7 +20,6 @@ import mimetypes
 from gi.repository import Gio, Gtk
 from oxalis import site
 
-from oxalis.site import SiteStore
 from oxalis.util import open_editor, input_dialog
 
 
@@ -42,6 +41,65 @@ MENU = """
 """
 
 
+class FilesTreeModel:
+    """
+    Tree model of site files for the files view.
+
+    The model is a view of the site store populated lazily -- contents of a
+    directory are added only when the directory is expanded for the first
+    time. Unpopulated directories contain a placeholder row, so they can be
+    expanded.
+    """
+
+    # Constants for column numbers
+    OBJECT_COL, PATH_COL, NAME_COL = list(range(3))
+
+    def __init__(self, store):
+        # Model fields: Document, path, name
+        self.tree_model = Gtk.TreeStore(object, str, str)
+        self.store = store
+        self._iters = {}  # document path -> tree iter
+        self._populated = {""}  # paths of directories with loaded children
+        self._populate(store.get_by_path(""))
+        store.connect('added', self._on_document_added)
+        store.connect('removed', self._on_document_removed)
+
+    def populate(self, tree_iter):
+        """Load children of directory on tree_iter, if not loaded yet."""
+        document = self.tree_model[tree_iter][self.OBJECT_COL]
+        if document.path in self._populated:
+            return
+        placeholder = self.tree_model.iter_children(tree_iter)
+        self._populate(document)
+        if placeholder is not None:
+            self.tree_model.remove(placeholder)
+
+    def _populate(self, directory):
+        self._populated.add(directory.path)
+        for document in self.store.get_children(directory):
+            self._insert(document)
+
+    def _insert(self, document, position=-1):
+        parent = self.store.get_parent(document)
+        tree_iter = self.tree_model.insert(
+            self._iters.get(parent.path), position,
+            [document, document.path, document.name])
+        self._iters[document.path] = tree_iter
+        if document.is_directory():
+            self.tree_model.append(tree_iter, [None, "", ""])  # Placeholder
+
+    def _on_document_added(self, store, document):
+        if store.get_parent(document).path in self._populated:
+            self._insert(document, store.index_of(document))
+        # Otherwise it will be added when the parent is expanded
+
+    def _on_document_removed(self, store, document):
+        self._populated.discard(document.path)
+        tree_iter = self._iters.pop(document.path, None)
+        if tree_iter is not None:
+            self.tree_model.remove(tree_iter)
+
+
 class FilesBrowser:
     """Side panel with list of files and templates"""
 
@@ -62,8 +120,9 @@ class FilesBrowser:
         self.menu = self._setup_menu(self.files_view, self.actions)
 
         # Fill views with data
-        files_model = self.site.get_tree_model()
-        self.files_view.set_model(files_model)
+        self.files_model = FilesTreeModel(self.site.store)
+        self.files_view.set_model(self.files_model.tree_model)
+        self.files_view.connect('test-expand-row', self._on_test_expand_row)
         self.files_view.set_reorderable(True)
 
     def get_selected(self):
@@ -81,7 +140,7 @@ class FilesBrowser:
         Returned object is subclass of site.File.
         """
         model, itr = self.get_selected()
-        return model.get_value(itr, SiteStore.OBJECT_COL)
+        return self._document_row(model, itr)[1]
 
     def get_target_dir(self, position=Gtk.TreeViewDropPosition.INTO_OR_AFTER):
         """
@@ -95,12 +154,12 @@ class FilesBrowser:
         if treeiter is None:
             return self.site.store.get_by_path("")
         else:
-            doc = model.get_value(treeiter, SiteStore.OBJECT_COL)
+            treeiter, doc = self._document_row(model, treeiter)
             if (position == Gtk.TreeViewDropPosition.BEFORE or
                     position == Gtk.TreeViewDropPosition.AFTER or
                     not doc.is_directory()):
                 treeiter = model.iter_parent(treeiter)
-            return model.get_value(treeiter, SiteStore.OBJECT_COL)
+            return model.get_value(treeiter, FilesTreeModel.OBJECT_COL)
 
     ### Helpers ###
 
@@ -115,8 +174,8 @@ class FilesBrowser:
         column.set_cell_data_func(icon_cell, self._set_file_icon_cb)
         cell = Gtk.CellRendererText()
         column.pack_start(cell, True)
-        column.add_attribute(cell, 'text', SiteStore.NAME_COL)
-        view.set_search_column(SiteStore.NAME_COL)
+        column.add_attribute(cell, 'text', FilesTreeModel.NAME_COL)
+        view.set_search_column(FilesTreeModel.NAME_COL)
         view.connect('row-activated', self._on_file_activated)
         selection = view.get_selection()
         selection.connect('changed', self._on_selection_changed, name)
@@ -145,6 +204,18 @@ class FilesBrowser:
         files_view.connect('popup-menu', self.display_menu)
         return menu
 
+    @staticmethod
+    def _document_row(model, treeiter):
+        """
+        Get (iter, document) of the row on treeiter. Placeholder row of
+        unexpanded directory is replaced by its directory.
+        """
+        doc = model.get_value(treeiter, FilesTreeModel.OBJECT_COL)
+        if doc is None:
+            treeiter = model.iter_parent(treeiter)
+            doc = model.get_value(treeiter, FilesTreeModel.OBJECT_COL)
+        return treeiter, doc
+
     def _enable_selection_actions(self, enabled):
         for name in ['rename', 'delete']:
             self.actions.lookup_action(name).set_enabled(enabled)
@@ -152,7 +223,10 @@ class FilesBrowser:
     ### Callbacks ###
 
     def _set_file_icon_cb(self, column, cell, model, iter, __):
-        doc = model.get_value(iter, SiteStore.OBJECT_COL)
+        doc = model.get_value(iter, FilesTreeModel.OBJECT_COL)
+        if doc is None:  # Placeholder of unexpanded directory
+            cell.set_property('pixbuf', None)
+            return
         icon_theme = Gtk.IconTheme.get_default()
         if doc.is_directory():
             content_type = 'inode/directory'
@@ -173,10 +247,16 @@ class FilesBrowser:
         store = tree_view.get_model()
 
         itr = store.get_iter(path)
-        doc = store.get_value(itr, SiteStore.OBJECT_COL)
+        doc = store.get_value(itr, FilesTreeModel.OBJECT_COL)
+        if doc is None:  # Placeholder of unexpanded directory
+            return
 
         open_editor(doc.full_path)
 
+    def _on_test_expand_row(self, tree_view, tree_iter, path):
+        self.files_model.populate(tree_iter)
+        return False  # Allow expansion
+
     def _on_selection_changed(self, selection, name):
         count = selection.count_selected_rows()
         if count == 0:
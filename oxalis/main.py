@@ -19,8 +19,10 @@ import os
 from gi.repository import Gio, GLib, Gtk
 
 from oxalis import files_browser, site, upload, util
+from oxalis.build import BackgroundBuild
 from oxalis.config import Configuration
 from oxalis.format_conversion import convert_01_to_03
+from oxalis.monitor import SiteMonitor
 from oxalis.server import PreviewServer
 from oxalis.site_settings import SiteSettingsDialog
 from oxalis.util import open_browser, open_terminal
@@ -60,6 +62,7 @@ class MainWindow(Gtk.ApplicationWindow):
         new_file_action = Gio.SimpleAction(name=name)
         new_file_action.connect('activate', callback)
         self.add_action(new_file_action)
+        return new_file_action
 
     def load_site(self, site, file_browser):
         self.start_panel.destroy()
@@ -68,8 +71,12 @@ class MainWindow(Gtk.ApplicationWindow):
         self.box.pack_start(file_browser, True, True, 0)
         file_browser.show_all()
 
+        self.progress_bar = BuildProgressBar()
+        self.box.pack_start(self.progress_bar, False, False, 0)
         errors_bar = ErrorsBar(site)
         self.box.pack_start(errors_bar, False, False, 0)
+        self.report_bar = BuildReportBar()
+        self.box.pack_start(self.report_bar, False, False, 0)
 
     def _setup_site_header(self, site):
         # Set window title to site name
@@ -111,6 +118,11 @@ class MainWindow(Gtk.ApplicationWindow):
         return gear_menu
 
     def on_quit(self, *args):
+        if self.controller.build is not None:
+            self.controller.build.cancel()
+            self.controller.build.join()
+        if self.controller.site is not None:
+            self.controller.site.close()
         width, height = self.get_size()
         settings.setint('state', 'width', width)
         settings.setint('state', 'height', height)
@@ -211,12 +223,17 @@ class SiteWindowController:
     def __init__(self, main):
         self.window = main
         self.site = None
+        self.monitor = None
         self.file_browser = None
         self.server = None
         self.settings_dialog = None
+        self.build = None
+        self.generate_action = None
+        self.upload_action = None
 
     def load_site(self, site_path):
         self.site = site.Site(site_path)
+        self.monitor = SiteMonitor(self.site)
 
         self._init_actions()
         self.file_browser = files_browser.FilesBrowser(self.window,
@@ -232,8 +249,10 @@ class SiteWindowController:
         self.window.add_simple_action('add-file', self.on_add_file)
         self.window.add_simple_action('preview', self.display_preview)
         self.window.add_simple_action('terminal', self.display_terminal)
-        self.window.add_simple_action('generate', self.on_generate)
-        self.window.add_simple_action('upload', self.on_upload)
+        self.generate_action = self.window.add_simple_action(
+            'generate', self.on_generate)
+        self.upload_action = self.window.add_simple_action(
+            'upload', self.on_upload)
         self.window.add_simple_action('settings', self.show_site_settings)
 
     # Actions handlers #
@@ -274,7 +293,39 @@ class SiteWindowController:
         open_terminal(path)
 
     def on_generate(self, action, param):
-        self.site.generate()
+        self.generate()
+
+    def generate(self, on_finished=None):
+        """
+        Start generation of the site in background.
+        on_finished() is called if the build was not cancelled.
+        """
+        if self.build is not None:
+            return
+        # Changes are processed after the build, so the same documents are
+        # not converted by two threads at once
+        self.monitor.scheduler.pause()
+        self.build = BackgroundBuild(self.site, GLib.idle_add)
+        self.build.connect('progress', self._on_build_progress)
+        self.build.connect('finished', self._on_build_finished, on_finished)
+        # Upload started during the build would send half generated files
+        self.generate_action.set_enabled(False)
+        self.upload_action.set_enabled(False)
+        self.window.progress_bar.show_build(self.build)
+        self.build.start()
+
+    def _on_build_progress(self, build, done, total):
+        self.window.progress_bar.set_progress(done, total)
+
+    def _on_build_finished(self, build, summary, on_finished):
+        self.build = None
+        self.monitor.scheduler.resume()
+        self.generate_action.set_enabled(True)
+        self.upload_action.set_enabled(True)
+        self.window.progress_bar.hide()
+        self.window.report_bar.show_report(build.report)
+        if on_finished is not None and not build.cancelled:
+            on_finished()
 
     def on_upload(self, action, param):
         dlg = Gtk.MessageDialog(self.window, 0, Gtk.MessageType.QUESTION, 0,
@@ -286,9 +337,11 @@ class SiteWindowController:
         dlg.destroy()
 
         if response == Gtk.ResponseType.YES:
-            self.on_generate(None, None)
+            self.generate(self.start_upload)
+        else:
+            self.start_upload()
 
-        # Start uploading
+    def start_upload(self):
         process = upload.start_upload(self.site)
 
         if not process:
@@ -310,6 +363,8 @@ class SiteWindowController:
         vbox.set_spacing(6)
 
         self.progress_bar = Gtk.ProgressBar()
+        self.progress_bar.set_show_text(True)
+        self.progress_bar.set_text('Connecting')
         vbox.pack_start(self.progress_bar, False, False, 0)
 
         self.upload_output = Gtk.TextView()
@@ -321,25 +376,51 @@ class SiteWindowController:
         self.upload_dlg.vbox.pack_start(vbox, True, True, 0)
         self.upload_dlg.show_all()
 
-        GLib.timeout_add(100, self.check_upload, process)
+        GLib.io_add_watch(process.fileno(), GLib.PRIORITY_DEFAULT,
+                          GLib.IO_IN | GLib.IO_HUP, self.on_upload_output,
+                          process)
 
         self.upload_dlg.run()
         self.upload_dlg.destroy()
 
-    def check_upload(self, process):
-        """Check upload status and move progressbar
-
-        This function is called periodically by gobject timer
-        """
-        returncode, output = upload.check_upload(process)
-        self.upload_output.get_buffer().insert_at_cursor(output)
-        if returncode is None:
-            self.progress_bar.pulse()
+    def on_upload_output(self, fd, condition, process):
+        """Show upload progress events -- called when the output is readable."""
+        buffer = self.upload_output.get_buffer()
+        for event in process.read_events():
+            kind = event['event']
+            if kind == 'upload':
+                buffer.insert_at_cursor('Uploaded %s\n' % event['path'])
+            elif kind == 'delete':
+                buffer.insert_at_cursor('Deleted %s\n' % event['path'])
+            elif kind == 'error':
+                buffer.insert_at_cursor('%s\n' % event['message'])
+            elif kind == 'output':
+                buffer.insert_at_cursor('%s\n' % event['text'])
+            if kind in ('start', 'upload', 'delete'):
+                self.show_upload_status(event)
+        if not process.finished:
             return True
-        else:
+        if process.returncode == 0:
             self.progress_bar.set_fraction(1.0)
-            self.upload_dlg.set_response_sensitive(Gtk.ResponseType.CLOSE, True)
-            return False
+            self.progress_bar.set_text('Finished')
+        else:
+            self.progress_bar.set_text('Failed')
+        self.upload_dlg.set_response_sensitive(Gtk.ResponseType.CLOSE, True)
+        return False
+
+    def show_upload_status(self, status):
+        if status['bytes_total'] > 0:
+            fraction = status['bytes_done'] / status['bytes_total']
+        elif status['files_total'] > 0:
+            fraction = status['files_done'] / status['files_total']
+        else:
+            fraction = 1.0
+        self.progress_bar.set_fraction(fraction)
+        text = '%d of %d files' % (status['files_done'], status['files_total'])
+        if status['rate'] is not None:
+            text += ', %s/s, %d s left' % (
+                GLib.format_size(int(status['rate'])), round(status['eta']))
+        self.progress_bar.set_text(text)
 
     def show_site_settings(self, action, param):
         if self.settings_dialog is None:
@@ -348,6 +429,40 @@ class SiteWindowController:
         self.settings_dialog.run()
 
 
+class BuildProgressBar(Gtk.InfoBar):
+    """An info bar displaying progress of a running site build."""
+
+    def __init__(self):
+        super().__init__(message_type=Gtk.MessageType.INFO)
+        box = Gtk.Box.new(Gtk.Orientation.VERTICAL, 6)
+        self.label = Gtk.Label(xalign=0)
+        box.pack_start(self.label, False, False, 0)
+        self.progress = Gtk.ProgressBar()
+        box.pack_start(self.progress, False, False, 0)
+        self.get_content_area().pack_start(box, True, True, 0)
+        self.cancel_button = self.add_button("Cancel",
+                                             Gtk.ResponseType.CANCEL)
+        self.connect('response', self._on_response)
+        self.build = None
+
+    def show_build(self, build):
+        self.build = build
+        self.cancel_button.set_sensitive(True)
+        self.set_progress(0, len(build.pending))
+        self.show_all()
+
+    def set_progress(self, done, total):
+        self.label.set_text("Generating pages: {done} of {total}".format(
+            done=done, total=total))
+        self.progress.set_fraction(done / total if total else 1.0)
+
+    def _on_response(self, info_bar, response_id):
+        if response_id == Gtk.ResponseType.CANCEL and self.build is not None:
+            self.build.cancel()
+            self.cancel_button.set_sensitive(False)
+            self.label.set_text("Cancelling...")
+
+
 class ErrorsBar(Gtk.InfoBar):
     """An info bar displaying error messages for a site."""
     RESPONSE_EDIT = 1
@@ -412,3 +527,60 @@ class ErrorsBar(Gtk.InfoBar):
             util.open_editor(os.path.join(self.base_path, error.file))
         elif response_id == self.RESPONSE_SHOW_ALL:
             self.show_all_errors(self.errors)
+
+
+class BuildReportBar(Gtk.InfoBar):
+    """An info bar displaying summary of the last site build."""
+    RESPONSE_SHOW_DETAILS = 1
+    SLOWEST_COUNT = 20
+
+    def __init__(self):
+        super().__init__(message_type=Gtk.MessageType.INFO, show_close_button=True)
+        self.label = Gtk.Label()
+        self.get_content_area().add(self.label)
+        self.details_button = self.add_button("Show Details",
+                                              self.RESPONSE_SHOW_DETAILS)
+        self.connect('close', self._on_response)
+        self.connect('response', self._on_response)
+        self.report = None
+
+    def show_report(self, report):
+        self.report = report
+        text = "Generated {rebuilt} pages in {time:.2f} s ({skipped} unchanged).".format(
+            rebuilt=report.rebuilt, skipped=report.skipped, time=report.time)
+        slowest = report.slowest(1)
+        if slowest:
+            path, stats = slowest[0]
+            text += " Slowest: {path} ({time:.2f} s).".format(
+                path=path, time=stats.total)
+        self.label.set_text(text)
+        self.show_all()
+        self.details_button.set_visible(bool(slowest))
+
+    def show_details(self, report):
+        dialog = Gtk.Dialog("Build report", self.get_toplevel(),
+                            Gtk.DialogFlags.DESTROY_WITH_PARENT,
+                            ("Close", Gtk.ResponseType.CLOSE),
+                            use_header_bar=1)
+        dialog.set_default_size(600, 400)
+        model = Gtk.ListStore(str, str, str, str, str, str, int)
+        for path, stats in report.slowest(self.SLOWEST_COUNT):
+            times = [stats.total, stats.read, stats.parse, stats.render,
+                     stats.write]
+            model.append([path] + ["%.3f" % t for t in times] + [stats.size])
+        view = Gtk.TreeView(model=model)
+        for i, title in enumerate(["Page", "Total (s)", "Read", "Parse",
+                                   "Render", "Write", "Size (B)"]):
+            view.append_column(Gtk.TreeViewColumn(
+                title, Gtk.CellRendererText(), text=i))
+        scrolling = Gtk.ScrolledWindow()
+        scrolling.add(view)
+        dialog.get_content_area().pack_start(scrolling, True, True, 0)
+        dialog.show_all()
+        dialog.connect('response', lambda dlg, rsp: dlg.destroy())
+
+    def _on_response(self, info_bar, response_id=Gtk.ResponseType.CLOSE):
+        if response_id == Gtk.ResponseType.CLOSE:
+            info_bar.hide()
+        elif response_id == self.RESPONSE_SHOW_DETAILS:
+            self.show_details(self.report)
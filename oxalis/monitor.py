@@ -0,0 +1,123 @@
+# Oxalis -- A website building tool for Gnome
+# Copyright (C) 2014 Sergej Chodarev
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+"""
+Monitoring of site files for changes, used by the graphical application.
+"""
+
+import os
+
+from gi.repository import Gio, GLib
+
+from oxalis.scheduler import CHANGED, CREATED, DELETED, RebuildScheduler
+
+# Interval of checking directories which could not be monitored
+POLL_INTERVAL = 5  # seconds
+
+
+class SiteMonitor:
+    """
+    Watches the whole site and passes changes to the site through
+    a RebuildScheduler.
+
+    Only directories are monitored -- a directory monitor reports also
+    changes of files inside the directory, so number of watches depends on
+    number of directories, not files. If a directory can not be monitored
+    (for example because the system limit of watches was reached), it is
+    periodically polled instead.
+    """
+
+    def __init__(self, site):
+        self.site = site
+        self.scheduler = RebuildScheduler(site, GLib.timeout_add,
+                                          GLib.source_remove)
+        self._monitors = {}  # directory path -> Gio.FileMonitor
+        self._polled = {}    # directory path -> {name: mtime}
+        self._poll_source = None
+        for document in list(site.store.all_documents()):
+            if document.is_directory():
+                self._watch(document.path)
+        site.store.connect('added', self._on_document_added)
+        site.store.connect('removed', self._on_document_removed)
+
+    def _watch(self, path):
+        full_path = os.path.join(self.site.directory, path)
+        try:
+            monitor = Gio.File.new_for_path(full_path)\
+                .monitor_directory(Gio.FileMonitorFlags.NONE)
+        except GLib.Error:
+            self._poll(path)
+            return
+        monitor.connect('changed', self._on_directory_changed)
+        self._monitors[path] = monitor
+
+    def _poll(self, path):
+        """Check directory periodically instead of monitoring it."""
+        self._polled[path] = self._directory_state(path)
+        if self._poll_source is None:
+            self._poll_source = GLib.timeout_add_seconds(POLL_INTERVAL,
+                                                         self._check_polled)
+
+    def _directory_state(self, path):
+        """Get modification times of directory entries."""
+        state = {}
+        full_path = os.path.join(self.site.directory, path)
+        try:
+            with os.scandir(full_path) as entries:
+                for entry in entries:
+                    try:
+                        state[entry.name] = entry.stat().st_mtime_ns
+                    except OSError:
+                        pass  # Deleted in the meantime
+        except OSError:
+            pass  # Directory was deleted
+        return state
+
+    def _check_polled(self):
+        for path, old_state in list(self._polled.items()):
+            new_state = self._directory_state(path)
+            self._polled[path] = new_state
+            for name in old_state.keys() - new_state.keys():
+                self.scheduler.add(os.path.join(path, name), DELETED)
+            for name in new_state.keys() - old_state.keys():
+                self.scheduler.add(os.path.join(path, name), CREATED)
+            for name in new_state.keys() & old_state.keys():
+                if new_state[name] != old_state[name]:
+                    self.scheduler.add(os.path.join(path, name), CHANGED)
+        if self._polled:
+            return True
+        self._poll_source = None
+        return False
+
+    def _on_document_added(self, store, document):
+        if document.is_directory():
+            self._watch(document.path)
+
+    def _on_document_removed(self, store, document):
+        monitor = self._monitors.pop(document.path, None)
+        if monitor is not None:
+            monitor.cancel()
+        self._polled.pop(document.path, None)
+
+    def _on_directory_changed(self, monitor, file, other_file, event_type):
+        path = os.path.relpath(file.get_path(), self.site.directory)
+        if event_type == Gio.FileMonitorEvent.CREATED:
+            self.scheduler.add(path, CREATED)
+        elif event_type == Gio.FileMonitorEvent.DELETED:
+            self.scheduler.add(path, DELETED)
+        elif event_type == Gio.FileMonitorEvent.CHANGED:
+            self.scheduler.add(path, CHANGED)
@@ -0,0 +1,135 @@
+# Oxalis -- A website building tool for Gnome
+# Copyright (C) 2014 Sergej Chodarev
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+"""
+Scheduling of site rebuilds after file changes.
+"""
+
+import os
+import time
+
+CREATED, DELETED, CHANGED = 'created', 'deleted', 'changed'
+
+# Events are processed after this period without new events
+QUIET_PERIOD = 300  # milliseconds
+# but no later than this after the first unprocessed event
+MAX_DELAY = 3000    # milliseconds
+
+
+class RebuildScheduler:
+    """
+    Collects file change events and processes them together.
+
+    Events are coalesced per path and processed after a short quiet period
+    as one incremental rebuild, so a burst of events (an editor saving a
+    file in several steps, or a checkout changing thousands of files) costs
+    a single rebuild.
+
+    The scheduler does not depend on a particular main loop -- timeouts are
+    created by the add_timeout(milliseconds, callback) function and removed
+    by remove_timeout(timeout_id), with the same semantics as
+    GLib.timeout_add() and GLib.source_remove().
+    """
+
+    def __init__(self, site, add_timeout, remove_timeout, clock=time.monotonic):
+        self.site = site
+        self._add_timeout = add_timeout
+        self._remove_timeout = remove_timeout
+        self._clock = clock
+        self._events = {}  # path -> event type
+        self._timeout_id = None
+        self._first_event_time = None
+        self._paused = False
+
+    def add(self, path, event):
+        """
+        Add event (CREATED, DELETED or CHANGED) for file on path.
+
+        Events of generated files and hidden files (like temporary files
+        used to write the generated files) are ignored -- they are results
+        of a rebuild, not changes which need one.
+        """
+        if (os.path.basename(path).startswith('.')
+                or self.site.store.is_generated(path)):
+            return
+        previous = self._events.get(path)
+        if previous == CREATED and event == CHANGED:
+            event = CREATED  # File still needs to be added to the site
+        self._events[path] = event
+        if self._paused:
+            return  # Processed after resume()
+
+        now = self._clock()
+        if self._timeout_id is None:
+            self._first_event_time = now
+        elif (now - self._first_event_time) * 1000 < MAX_DELAY:
+            self._remove_timeout(self._timeout_id)
+        else:
+            return  # Waiting too long already, do not postpone processing
+        self._timeout_id = self._add_timeout(QUIET_PERIOD, self._on_timeout)
+
+    def pause(self):
+        """
+        Collect events without processing them until resume() is called --
+        for example while the whole site is being built in the background.
+        """
+        self._paused = True
+        if self._timeout_id is not None:
+            self._remove_timeout(self._timeout_id)
+            self._timeout_id = None
+
+    def resume(self):
+        """Process events collected while paused after the quiet period."""
+        self._paused = False
+        if self._events and self._timeout_id is None:
+            self._first_event_time = self._clock()
+            self._timeout_id = self._add_timeout(QUIET_PERIOD,
+                                                 self._on_timeout)
+
+    def flush(self):
+        """
+        Process all collected events immediately.
+        Returns BuildSummary of the rebuild, or None if there were no events.
+        """
+        if self._timeout_id is not None:
+            self._remove_timeout(self._timeout_id)
+            self._timeout_id = None
+        return self._process()
+
+    def _on_timeout(self):
+        self._timeout_id = None
+        self._process()
+        return False  # Do not repeat
+
+    def _process(self):
+        events = self._events
+        self._events = {}
+        if not events:
+            return None
+        # Update site structure first, so rebuild sees the final state
+        for path in sorted(events, reverse=True):
+            if events[path] == DELETED:
+                self.site.remove_path(path)
+        for path in sorted(events):
+            if events[path] == CREATED:
+                self.site.add_path(path)
+        if self.site.config.getboolean('preview', 'render_on_request',
+                                       fallback=False):
+            # Preview renders pages from sources, so nothing is converted,
+            # the changes only invalidate cached pages and reload the browser
+            return self.site.notify_changes(sorted(events))
+        return self.site.rebuild(sorted(events))
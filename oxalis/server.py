@@ -15,53 +15,619 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
 
+"""
+Preview server, which serves site files over HTTP.
+"""
+
+import hashlib
+import html
+import json
 import os
+from collections import OrderedDict, namedtuple
 from http.server import HTTPServer, BaseHTTPRequestHandler
 import mimetypes
-import shutil
-from threading import Thread
+import queue
+import socket
+from email.utils import parsedate_to_datetime
+from threading import Lock, Thread
+from urllib.parse import unquote, urlsplit
+
+from oxalis import converters
+from oxalis.converters.assets import is_fingerprinted
+
+# Number of threads handling connections -- every connection occupies
+# a thread for its whole lifetime
+WORKER_THREADS = 16
+# Idle persistent connections are closed after this time, so they do not
+# block the workers
+KEEP_ALIVE_TIMEOUT = 5  # seconds
+# Limits of the response cache
+CACHE_SIZE = 32 * 1024 * 1024        # bytes
+CACHE_MAX_ENTRY = 1024 * 1024        # bytes, larger files are not cached
+
+# Browsers are notified about site changes through this URL
+LIVE_RELOAD_PATH = '/_oxalis/live-reload'
+# Script inserted into served pages, which reloads the page (or only changed
+# style sheets) when notified
+LIVE_RELOAD_SCRIPT = b"""<script>
+(function () {
+  var source = new EventSource('/_oxalis/live-reload');
+  source.addEventListener('reload', function () { location.reload(); });
+  source.addEventListener('css', function (event) {
+    var paths = JSON.parse(event.data);
+    var links = document.querySelectorAll('link[rel="stylesheet"]');
+    for (var i = 0; i < links.length; i++) {
+      var url = new URL(links[i].href);
+      if (paths.indexOf(url.pathname) >= 0) {
+        url.searchParams.set('oxalis-reload', Date.now());
+        links[i].href = url.href;
+      }
+    }
+  });
+})();
+</script>
+"""
+
+# Cached file -- path is relative to the site directory; rendered pages
+# also depend on other files (templates)
+CachedResponse = namedtuple('CachedResponse',
+                            ['path', 'content_type', 'etag', 'mtime', 'body',
+                             'dependencies'],
+                            defaults=[()])
+
+
+def inject_live_reload(body):
+    """Insert live reload script into HTML page (bytes)."""
+    index = body.lower().rfind(b'</body>')
+    if index < 0:
+        return body + LIVE_RELOAD_SCRIPT
+    return body[:index] + LIVE_RELOAD_SCRIPT + body[index:]
+
+
+def entity_tag(stat):
+    """Get HTTP entity tag of a file from its stat result."""
+    return '"%x-%x"' % (stat.st_mtime_ns, stat.st_size)
+
+
+class RangeNotSatisfiable(Exception):
+    """Requested byte range is outside of the file."""
+
+
+def byte_range(header, size):
+    """
+    Parse value of HTTP Range header for a file of the specified size.
+
+    Returns tuple (start, end) of the requested byte range (end is
+    exclusive) or None if the whole file should be sent -- when the header
+    is missing, invalid or requests several ranges. Raises
+    RangeNotSatisfiable if the range starts after the end of the file.
+    """
+    if header is None:
+        return None
+    unit, __, ranges = header.partition('=')
+    if unit.strip().lower() != 'bytes' or ',' in ranges:
+        return None
+    first, separator, last = ranges.strip().partition('-')
+    if not separator:
+        return None
+    try:
+        if first == '':  # Last bytes of the file
+            suffix = int(last)
+            if suffix < 0:
+                return None
+            if suffix == 0 or size == 0:
+                raise RangeNotSatisfiable()
+            return max(0, size - suffix), size
+        start = int(first)
+        end = int(last) + 1 if last else None
+    except ValueError:
+        return None
+    if start < 0 or (end is not None and end <= start):
+        return None
+    if start >= size:
+        raise RangeNotSatisfiable()
+    return start, size if end is None else min(end, size)
+
+
+class ResponseCache:
+    """
+    Bounded LRU cache of served files, keyed by request path.
+
+    Entries are not checked against the file system when they are used --
+    they must be invalidated when files change. The cache is used from
+    several threads.
+    """
+
+    def __init__(self, max_size=CACHE_SIZE, max_entry_size=CACHE_MAX_ENTRY):
+        self.max_size = max_size
+        self.max_entry_size = max_entry_size
+        self.size = 0
+        self._entries = OrderedDict()  # key -> CachedResponse
+        self._lock = Lock()
+        # Counter of invalidations, used to detect responses which were read
+        # before an invalidation and could be outdated
+        self.generation = 0
+
+    def get(self, key):
+        """Get cached response, or None if it is not cached."""
+        with self._lock:
+            response = self._entries.get(key)
+            if response is not None:
+                self._entries.move_to_end(key)
+            return response
+
+    def put(self, key, response, generation):
+        """
+        Store response. generation is the value of self.generation before
+        the file was read -- if the cache was invalidated since then,
+        the response is not stored.
+        """
+        size = len(response.body)
+        if size > self.max_entry_size:
+            return
+        with self._lock:
+            if generation != self.generation:
+                return
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old.body)
+            self._entries[key] = response
+            self.size += size
+            while self.size > self.max_size:
+                __, removed = self._entries.popitem(last=False)
+                self.size -= len(removed.body)
+
+    def invalidate(self, path):
+        """
+        Remove responses of the file on path, of files inside it and of
+        pages depending on it.
+        """
+        prefix = path + os.sep
+        with self._lock:
+            self.generation += 1
+            for key, response in list(self._entries.items()):
+                used = (response.path,) + response.dependencies
+                if any(used_path == path or used_path.startswith(prefix)
+                       for used_path in used):
+                    del self._entries[key]
+                    self.size -= len(response.body)
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+            self.size = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class LiveReload:
+    """
+    Pushes reload events to browsers using Server-Sent Events.
+
+    Event streams do not occupy the server's worker threads -- after
+    the response headers are sent, the connection is passed to this object
+    and events are written by its own thread.
+    """
+
+    def __init__(self):
+        self._clients = []
+        self._lock = Lock()
+        self._events = queue.Queue()
+        self._thread = None
+
+    def start(self):
+        """Start the thread sending events."""
+        self._thread = Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def add_client(self, connection):
+        """Add socket of a client waiting for events."""
+        with self._lock:
+            try:
+                # Reconnect soon if the connection is lost
+                connection.sendall(b"retry: 1000\n\n")
+            except OSError:
+                connection.close()
+                return
+            self._clients.append(connection)
+
+    def send(self, event, data=''):
+        """Send event to all clients."""
+        self._events.put((event, data))
+
+    def stop(self):
+        """Stop the thread and close connections of all clients."""
+        if self._thread is not None:
+            self._events.put(None)
+            self._thread.join()
+            self._thread = None
+        with self._lock:
+            clients, self._clients = self._clients, []
+        for connection in clients:
+            connection.close()
+
+    def __len__(self):
+        return len(self._clients)
+
+    def _run(self):
+        while True:
+            item = self._events.get()
+            if item is None:  # Stopped
+                return
+            event, data = item
+            message = "event: {}\ndata: {}\n\n".format(event, data).encode()
+            with self._lock:
+                clients = list(self._clients)
+            for connection in clients:
+                try:
+                    connection.sendall(message)
+                except OSError:  # Page was closed
+                    with self._lock:
+                        if connection in self._clients:
+                            self._clients.remove(connection)
+                    connection.close()
+
+
+class PreviewHTTPServer(HTTPServer):
+    """
+    HTTP server handling connections in a bounded pool of threads.
+    Connections waiting for a free thread are queued.
+    """
+    request_queue_size = 64
+
+    def __init__(self, server_address, handler_class, site, cache,
+                 live_reload, workers=WORKER_THREADS):
+        # Set before binding, server_close() is called if binding fails
+        self._active = set()  # Requests handled by workers
+        self._lock = Lock()
+        self._closed = False
+        self._workers = []
+        super().__init__(server_address, handler_class)
+        # Make site object, cache and live reload available to the handler
+        self.site = site
+        self.cache = cache
+        self.live_reload = live_reload
+        self._detached = set()
+        self._requests = queue.Queue()
+        self._workers = [Thread(target=self._worker, daemon=True)
+                         for __ in range(workers)]
+        for thread in self._workers:
+            thread.start()
+
+    def process_request(self, request, client_address):
+        self._requests.put((request, client_address))
+
+    def detach(self, request):
+        """Keep connection of the request open after it is handled."""
+        self._detached.add(request)
+
+    def shutdown_request(self, request):
+        if request in self._detached:
+            self._detached.discard(request)
+        else:
+            super().shutdown_request(request)
+
+    def server_close(self):
+        """
+        Close the socket, end connections being handled and stop worker
+        threads. Connections still waiting in the queue are closed.
+        """
+        super().server_close()
+        with self._lock:
+            self._closed = True
+            active = list(self._active)
+        for request in active:
+            try:
+                # Worker waiting for the next request on a persistent
+                # connection gets end of file
+                request.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        for __ in self._workers:
+            self._requests.put(None)
+        for thread in self._workers:
+            thread.join()
+
+    def _worker(self):
+        while True:
+            item = self._requests.get()
+            if item is None:  # Server was closed
+                return
+            request, client_address = item
+            with self._lock:
+                closed = self._closed
+                if not closed:
+                    self._active.add(request)
+            if closed:
+                super().shutdown_request(request)
+                continue
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                with self._lock:
+                    self._active.discard(request)
+                self.shutdown_request(request)
 
 
 class PreviewServer:
     def __init__(self, site):
         self.site = site
         self.port = 0
+        self.httpd = None
+        self._thread = None
+        self.cache = ResponseCache()
+        self.live_reload = LiveReload()
+        self._changed = []  # Paths changed since the last rebuild
+        site.connect('changed', self._on_site_changed)
+        site.connect('rebuilt', self._on_site_rebuilt)
 
     def start(self):
-        server_thread = Thread(target=self.run)
-        server_thread.setDaemon(True)
-        server_thread.start()
-
-    def run(self):
         try:
             server_address = ('0.0.0.0', 8000)  # Use port 8000 by default.
-            httpd = HTTPServer(server_address, PreviewServer.RequestHandler)
+            self.httpd = PreviewHTTPServer(server_address,
+                                           PreviewServer.RequestHandler,
+                                           self.site, self.cache,
+                                           self.live_reload)
         except OSError:                         # If port is not available,
             server_address = ('0.0.0.0', 0)     # use random free port number.
-            httpd = HTTPServer(server_address, PreviewServer.RequestHandler)
-        httpd.site = self.site  # Make site object available to the handler
-        self.port = httpd.server_port
-        httpd.serve_forever()
+            self.httpd = PreviewHTTPServer(server_address,
+                                           PreviewServer.RequestHandler,
+                                           self.site, self.cache,
+                                           self.live_reload)
+        self.port = self.httpd.server_port
+        self.live_reload.start()
+        self._thread = Thread(target=self.run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def run(self):
+        self.httpd.serve_forever()
+
+    def stop(self):
+        """
+        Stop the server, close its socket and all connections and wait for
+        its threads to finish.
+        """
+        self.httpd.shutdown()
+        self._thread.join()
+        self.httpd.server_close()
+        self.live_reload.stop()
+
+    def _on_site_changed(self, site, path):
+        self.cache.invalidate(path)
+        if not os.path.basename(path).startswith('.'):  # Ignore hidden files
+            self._changed.append(path)
+
+    def _on_site_rebuilt(self, site):
+        changed = self._changed
+        self._changed = []
+        if not changed:
+            return
+        if all(path.endswith('.css') for path in changed):
+            # Only style sheets changed, they can be replaced without reload
+            urls = sorted(set('/' + site.get_url_path()
+                              + path.replace(os.sep, '/') for path in changed))
+            self.live_reload.send('css', json.dumps(urls))
+        else:
+            self.live_reload.send('reload')
 
     class RequestHandler(BaseHTTPRequestHandler):
+        # Allow persistent connections
+        protocol_version = 'HTTP/1.1'
+        timeout = KEEP_ALIVE_TIMEOUT
+        # Headers and body are written separately, with Nagle's algorithm
+        # the body would wait for acknowledgement of the headers
+        disable_nagle_algorithm = True
+
         def do_GET(self):
-                base_path = self.server.site.get_url_path()
-                request_path = self.path[1:]
-                request_path = request_path[len(base_path):]
-                full_path = os.path.join(self.server.site.directory, request_path)
-                if os.path.isdir(full_path):
-                    full_path = os.path.join(full_path, 'index.html')
-
-                if os.path.exists(full_path):  # Other files
-                    mime = mimetypes.guess_type(full_path)
-
-                    self.send_response(200)
-                    self.send_header('Content-Type', mime[0])
-                    self.end_headers()
-
-                    f = open(full_path, 'rb')
-                    shutil.copyfileobj(f, self.wfile)
-                    f.close()
-
-                else:  # File not found
-                    self.send_error(404, 'Not Found')
+            if urlsplit(self.path).path == LIVE_RELOAD_PATH:
+                self.send_event_stream()
+            else:
+                self.send_file(head_only=False)
+
+        def do_HEAD(self):
+            self.send_file(head_only=True)
+
+        def send_file(self, head_only):
+            cache = self.server.cache
+            site = self.server.site
+            render = site.config.getboolean('preview', 'render_on_request',
+                                            fallback=False)
+            key = (site.get_url_path(), render, urlsplit(self.path).path)
+            response = cache.get(key)
+            if response is not None:
+                self.send_cached(response, head_only)
+                return
+
+            full_path = self.translate_path()
+            if full_path is None:
+                self.send_message(404, "Not Found", head_only)
+                return
+            if render:
+                document = site.document_for_target(
+                    os.path.relpath(full_path, site.directory))
+                if document is not None:
+                    self.send_rendered(key, document, head_only)
+                    return
+            if not os.path.isfile(full_path):
+                self.send_message(404, "Not Found", head_only)
+                return
+
+            generation = cache.generation
+            mime = mimetypes.guess_type(full_path)[0] \
+                or 'application/octet-stream'
+            with open(full_path, 'rb') as f:
+                stat = os.fstat(f.fileno())
+                if stat.st_size <= cache.max_entry_size:
+                    body = f.read()
+                    if mime == 'text/html':
+                        body = inject_live_reload(body)
+                    response = CachedResponse(
+                        os.path.relpath(full_path, site.directory), mime,
+                        entity_tag(stat), stat.st_mtime, body)
+                    cache.put(key, response, generation)
+                    self.send_cached(response, head_only)
+                    return
+                body = self.send_head(mime, stat.st_size, entity_tag(stat),
+                                      stat.st_mtime)
+                if body is not None and not head_only:
+                    # Large file -- let the kernel copy it to the socket
+                    start, end = body
+                    self.connection.sendfile(f, start, end - start)
+
+        def send_event_stream(self):
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.send_header('Cache-Control', 'no-cache')
+            self.end_headers()
+            self.close_connection = True
+            self.server.detach(self.request)
+            self.server.live_reload.add_client(self.request)
+
+        def send_rendered(self, key, document, head_only):
+            """Convert document in memory and send the result."""
+            cache = self.server.cache
+            site = self.server.site
+            generation = cache.generation
+            # A new converter, as the document's one may be used by a build
+            converter = converters.matching_converter(site.directory,
+                                                      document.path)
+            data, error = converter.render()
+            if error is not None:
+                self.send_message(500, "{message} in {file}".format(
+                    **error._asdict()), head_only)
+                return
+            dependencies = tuple(converter.dependencies())
+            mtime = 0
+            for path in (document.path,) + dependencies:
+                try:
+                    mtime = max(mtime, os.stat(
+                        os.path.join(site.directory, path)).st_mtime)
+                except OSError:
+                    pass
+            content_type = mimetypes.guess_type(converter.target())[0] \
+                or 'application/octet-stream'
+            if content_type == 'text/html':
+                data = inject_live_reload(data)
+            etag = '"%s"' % hashlib.sha1(data).hexdigest()
+            response = CachedResponse(document.path, content_type, etag,
+                                      mtime, data, dependencies)
+            cache.put(key, response, generation)
+            self.send_cached(response, head_only)
+
+        def send_cached(self, response, head_only):
+            body = self.send_head(response.content_type, len(response.body),
+                                  response.etag, response.mtime)
+            if body is not None and not head_only:
+                start, end = body
+                self.wfile.write(memoryview(response.body)[start:end])
+
+        def send_head(self, content_type, size, etag, mtime):
+            """
+            Send response status and headers. Returns range (start, end) of
+            the file which should be sent as the body, or None if the body
+            should not be sent.
+            """
+            if self.not_modified(etag, mtime):
+                self.send_response(304)
+                self.send_validators(etag, mtime)
+                self.end_headers()
+                return None
+            try:
+                requested = self.requested_range(size, etag, mtime)
+            except RangeNotSatisfiable:
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */%d' % size)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return None
+            if requested is None:
+                start, end = 0, size
+                self.send_response(200)
+            else:
+                start, end = requested
+                self.send_response(206)
+                self.send_header('Content-Range', 'bytes %d-%d/%d'
+                                 % (start, end - 1, size))
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(end - start))
+            self.send_header('Accept-Ranges', 'bytes')
+            self.send_validators(etag, mtime)
+            self.end_headers()
+            return start, end
+
+        def requested_range(self, size, etag, mtime):
+            """
+            Get byte range requested by the client, or None if the whole file
+            should be sent.
+            """
+            if_range = self.headers.get('If-Range')
+            if if_range is not None and if_range.strip() not in (
+                    etag, self.date_time_string(mtime)):
+                return None  # File changed, send all of it
+            return byte_range(self.headers.get('Range'), size)
+
+        def send_validators(self, etag, mtime):
+            self.send_header('ETag', etag)
+            self.send_header('Last-Modified', self.date_time_string(mtime))
+            if is_fingerprinted(urlsplit(self.path).path):
+                # Changed asset gets a new name, so it can be kept forever
+                self.send_header('Cache-Control',
+                                 'public, max-age=31536000, immutable')
+            else:
+                # Browser may keep the file, but must check that it is
+                # still valid -- preview has to show current version
+                self.send_header('Cache-Control', 'no-cache')
+
+        def not_modified(self, etag, mtime):
+            """Check if the client's cached copy of the file is valid."""
+            if_none_match = self.headers.get('If-None-Match')
+            if if_none_match is not None:
+                # If-Modified-Since is ignored if If-None-Match is present
+                tags = [tag.strip() for tag in if_none_match.split(',')]
+                return '*' in tags or etag in tags or 'W/' + etag in tags
+            if_modified_since = self.headers.get('If-Modified-Since')
+            if if_modified_since is not None:
+                try:
+                    since = parsedate_to_datetime(if_modified_since)
+                except (TypeError, ValueError):
+                    return False  # Invalid date
+                if since.tzinfo is None:
+                    return False
+                return int(mtime) <= since.timestamp()
+            return False
+
+        def send_message(self, code, message, head_only):
+            # Unlike send_error(), this keeps the connection open
+            body = "<h1>{code} {message}</h1>".format(
+                code=code, message=html.escape(message)).encode('utf-8')
+            self.send_response(code)
+            self.send_header('Content-Type', 'text/html')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            if not head_only:
+                self.wfile.write(body)
+
+        def translate_path(self):
+            """
+            Get full path of the requested file, or None if the request
+            points outside of the site.
+            """
+            site = self.server.site
+            base_path = site.get_url_path()
+            request_path = unquote(urlsplit(self.path).path)[1:]
+            if not request_path.startswith(base_path):
+                return None
+            request_path = os.path.normpath(request_path[len(base_path):])
+            if (request_path == os.pardir or os.path.isabs(request_path)
+                    or request_path.startswith(os.pardir + os.sep)
+                    or request_path.split(os.sep)[0] == '_oxalis'):
+                return None  # Outside of the site or its configuration
+            full_path = os.path.join(site.directory, request_path)
+            if os.path.isdir(full_path):
+                full_path = os.path.join(full_path, 'index.html')
+            return full_path
@@ -0,0 +1,50 @@
+# Oxalis -- A website building tool for Gnome
+# Copyright (C) 2014 Sergej Chodarev
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+"""
+Signals for site objects, which must be usable without GObject (for example
+in command line builds).
+"""
+
+
+class Signals:
+    """
+    Mixin providing signals with interface similar to GObject.
+
+    Callbacks are called with the emitting object as the first argument,
+    followed by signal arguments and user data passed to connect().
+    """
+
+    def connect(self, name, callback, *user_data):
+        """Connect callback to the signal. Returns handler ID."""
+        if not hasattr(self, '_handlers'):
+            self._handlers = {}
+            self._last_handler_id = 0
+        self._last_handler_id += 1
+        self._handlers[self._last_handler_id] = (name, callback, user_data)
+        return self._last_handler_id
+
+    def disconnect(self, handler_id):
+        """Disconnect signal handler with specified ID."""
+        del self._handlers[handler_id]
+
+    def emit(self, name, *args):
+        """Call all callbacks connected to the signal."""
+        handlers = getattr(self, '_handlers', {})
+        for signal, callback, user_data in list(handlers.values()):
+            if signal == name:
+                callback(self, *(args + user_data))
@@ -23,13 +23,18 @@ directories.
 
 import os
 from codecs import open
+from bisect import bisect_left
 import shutil
+from time import perf_counter
 
-from gi.repository import GObject, Gio, Gtk
-
+from oxalis.build import (MIN_PARALLEL_DOCUMENTS, REPORT_FILE, BuildManifest,
+                          BuildReport, BuildSummary, DigestCache,
+                          convert_document, convert_parallel, worker_count)
 from oxalis.config import Configuration
 from oxalis import converters
 from oxalis.converters.markdown import TEMPLATES_DIR
+from oxalis.signals import Signals
+from oxalis.snapshot import TreeSnapshot, list_directory
 
 default_template = """
 <!DOCTYPE html>
@@ -84,15 +89,6 @@ def create_site(path):
     f.write(default_template)
     f.close()
 
-    # Create sitecopy configuration file
-    f = open(os.path.join(oxalis_dir, 'sitecopyrc'), 'w')
-    f.close()
-    os.chmod(os.path.join(oxalis_dir, 'sitecopyrc'), 0o600)
-
-    # Sitecopy storepath
-    os.mkdir(os.path.join(oxalis_dir, 'sitecopy'))
-    os.chmod(os.path.join(oxalis_dir, 'sitecopy'), 0o700)
-
 
 def check_site_format(path):
     """
@@ -107,26 +103,20 @@ def check_site_format(path):
     return config.get('project', 'format')
 
 
-def compare_files(x, y):
-    """Compare files for sorting."""
-    # Directories first
-    xdir = isinstance(x, Directory)
-    ydir = isinstance(y, Directory)
-    if xdir and not ydir:
-        return -1
-    elif not xdir and ydir:
-        return 1
-    else:
-        if x.name < y.name:
-            return -1
-        elif x.name == y.name:
-            return 0
-        else:
-            return 1
+def sort_key(document):
+    """Key for sorting files: directories first, then by name."""
+    return (not document.is_directory(), document.name)
+
 
+class Site(Signals):
+    """
+    Oxalis site.
 
-class Site:
-    """Oxalis site."""
+    Signals:
+    changed (path) -- file or directory on path was changed, created or
+        deleted, or a generated file was written
+    rebuilt -- rebuild after changes or site generation finished
+    """
     def __init__(self, directory):
         self.directory = directory
         self.config_dir = os.path.join(self.directory, "_oxalis")
@@ -140,6 +130,8 @@ class Site:
         self._load_files_tree()
 
         self.errors = ErrorMessages()
+        self.manifest = BuildManifest(self.directory)
+        self.build_report = None
 
     def get_url_path(self):
         """Return path part of site preview URL."""
@@ -154,50 +146,126 @@ class Site:
         """Preview URL of the site."""
         return 'http://127.0.0.1:8000/' + self.get_url_path()
 
-    def get_tree_model(self):
-        return self.store.tree_model
-
     def _load_files_tree(self):
         """Loads tree of site files"""
-        self._load_dir('')
+        snapshot = TreeSnapshot(self.directory)
+        listings = snapshot.scan()
+        snapshot.save()
+        self._load_dir('', listings)
 
-    def _load_dir(self, dirpath):
+    def _load_dir(self, dirpath, listings=None):
         """Loads directory to files tree store
 
         dirpath - directory to load, path relative to self.directory
+        listings - directory listings from TreeSnapshot.scan(), directories
+            missing in it are listed directly
         """
         document = Directory(dirpath, self)
         self.store.add(document)
 
-        full_dir_path = os.path.join(self.directory, dirpath)
-        for filename in os.listdir(full_dir_path):
+        if listings is not None and dirpath in listings:
+            entries = listings[dirpath]
+        else:
+            entries = list_directory(os.path.join(self.directory, dirpath))
+        for filename, is_dir in entries:
             if filename != '_oxalis':
                 path = os.path.join(dirpath, filename)
-                full_path = os.path.join(self.directory, path)
-                if os.path.isdir(full_path):
-                    self._load_dir(path)
+                if is_dir:
+                    self._load_dir(path, listings)
                 else:
                     self._load_file(filename, path)
 
-        document.file_monitor = Gio.File.new_for_path(full_dir_path)\
-            .monitor_directory(Gio.FileMonitorFlags.NONE)
-        document.file_monitor.connect('changed', self.on_file_changed)
-
-    def on_file_changed(self, monitor, file, other_file, event_type):
-        full_path = file.get_path()
-        path = os.path.relpath(full_path, self.directory)
-        if (event_type == Gio.FileMonitorEvent.CREATED
-                and not self.store.contains_path(path)):
-            if os.path.isdir(full_path):
-                self._load_dir(path)
+    def file_created(self, path):
+        """Add newly created file or directory on path to the site."""
+        self.add_path(path)
+        self.rebuild([path])
+
+    def file_deleted(self, path):
+        """Remove deleted file or directory on path from the site."""
+        self.remove_path(path)
+        self.rebuild([path])
+
+    def file_changed(self, path):
+        """Convert changed file on path and documents which depend on it."""
+        self.rebuild([path])
+
+    def add_path(self, path):
+        """Add file or directory on path to the site, if it is not there."""
+        if (path.split(os.sep)[0] == '_oxalis'
+                or self.store.contains_path(path)):
+            return
+        full_path = os.path.join(self.directory, path)
+        if os.path.isdir(full_path):
+            self._load_dir(path)
+        elif os.path.exists(full_path):
+            self._load_file(os.path.basename(path), path)
+
+    def remove_path(self, path):
+        """Remove file or directory on path from the site."""
+        if self.store.contains_path(path):
+            self.store.remove(self.store.get_by_path(path))
+
+    def rebuild(self, paths):
+        """
+        Convert documents affected by changes of files on paths -- changed
+        documents (or documents inside changed directories) and documents
+        depending on changed files. Documents whose inputs did not change
+        since the last conversion are skipped.
+
+        Documents that failed to convert are tried again after a template
+        change, as the template may have been the cause of the failure.
+        Signal 'changed' is emitted for every path and signal 'rebuilt' when
+        the rebuild is finished.
+        Returns BuildSummary with counts of rebuilt and skipped documents.
+        """
+        sources = set()
+        for path in paths:
+            self.emit('changed', path)
+            if self.store.contains_path(path):
+                document = self.store.get_by_path(path)
+                sources.update(doc.path for doc
+                               in self.store.get_descendants(document))
+                sources.add(path)
+            sources.update(self.manifest.dependents(path))
+            if path.startswith(TEMPLATES_DIR + os.sep):
+                sources.update(doc.path for doc in self.errors.files())
+
+        rebuilt = skipped = 0
+        for source in sorted(sources):
+            if not self.store.contains_path(source):
+                continue
+            document = self.store.get_by_path(source)
+            if document.converter is None:
+                continue
+            if self.manifest.is_current(source):
+                skipped += 1
             else:
-                self._load_file(os.path.basename(path), path)
-        elif (event_type == Gio.FileMonitorEvent.DELETED
-                and self.store.contains_path(path)):
-            document = self.store.get_by_path(path)
-            self.store.remove(document)             # Remove from store
-            if hasattr(document, 'file_monitor'):   # Stop a monitor
-                document.file_monitor.cancel()
+                document.convert()
+                rebuilt += 1
+        self.emit('rebuilt')
+        return BuildSummary(rebuilt, skipped)
+
+    def notify_changes(self, paths):
+        """
+        Report changes of files on paths without converting any documents --
+        emit signal 'changed' for every path and then signal 'rebuilt'. Used
+        instead of rebuild() when the preview renders pages on request.
+
+        Generated paths of documents are updated, as names of some targets
+        (fingerprinted assets) depend on contents of the sources.
+        Returns BuildSummary with no rebuilt or skipped documents.
+        """
+        for document in list(self.store.all_documents()):
+            if document.converter is not None:
+                self.store.update_generated(document)
+        for path in paths:
+            self.emit('changed', path)
+        self.emit('rebuilt')
+        return BuildSummary(0, 0)
+
+    def document_for_target(self, path):
+        """Get document which is converted into file on path, or None."""
+        return self.store.get_source(path)
 
     def _load_file(self, filename, path):
         """Append file
@@ -213,6 +281,7 @@ class Site:
         """Close site and save its state"""
         self.config.save()
         self.upload_config.save()
+        self.manifest.save()
 
     def new_file(self, name, parent):
         """Create new file."""
@@ -230,56 +299,193 @@ class Site:
         full_path = os.path.join(self.directory, parent.path, name)
         shutil.copyfile(filename, full_path)
 
-    def generate(self):
-        """Generate site output files"""
-        for item in self.store.all_documents():
-            item.convert()
+    def generate(self, force=False, workers=None):
+        """
+        Generate site output files.
+
+        Only documents whose source, dependencies or generated file changed
+        since the last build are converted, unless force is True. If more
+        than one build worker is configured (or requested by the workers
+        argument) and there are enough documents to convert, they are
+        converted in parallel by a pool of worker processes.
+        Returns BuildSummary with counts of rebuilt and skipped documents.
+        Timing of the build is stored into self.build_report and saved into
+        the site configuration directory.
+        """
+        start = perf_counter()
+        sources, pending = self.plan_build(force)
+        report = BuildReport()
+        for document, error, dependencies, digests, stats in \
+                self.convert_documents(pending, workers):
+            document.conversion_done(error, dependencies, digests)
+            report.add(document.path, stats)
+        report.rebuilt = len(pending)
+        report.skipped = len(sources) - len(pending)
+        report.time = perf_counter() - start
+        return self.finish_build(sources, report)
+
+    def plan_build(self, force=False):
+        """
+        Find documents which need to be converted.
+        Returns tuple (sources, pending) -- paths of all convertible documents
+        and list of documents which are not up to date (or all of them if
+        force is True).
+        """
+        sources = self.source_paths()
+        pending = [self.store.get_by_path(path) for path in sources
+                   if force or not self.manifest.is_current(path)]
+        return sources, pending
 
+    def source_paths(self):
+        """Get paths of all documents which are converted."""
+        return [document.path for document in self.store.all_documents()
+                if document.converter is not None]
 
-class SiteStore:
-    """
-    Tree store containing site files and directories (with exception of
-    generated and hidden files).
+    def convert_documents(self, documents, workers=None, cancelled=None):
+        """
+        Convert documents and yield tuples
+        (document, error, dependencies, digests, stats) in the order of
+        documents, see convert_document().
+
+        Results are not stored into the site, so this can run in
+        a background thread; pass every result to conversion_done() of the
+        document in the main thread. Documents are converted by new
+        converter instances, so the converters of the documents can be used
+        by the main thread in the meantime. Conversion stops early when the
+        cancelled event (threading.Event) is set.
+        """
+        workers = worker_count(self.config, workers)
+        if workers > 1 and len(documents) >= MIN_PARALLEL_DOCUMENTS:
+            by_path = {document.path: document for document in documents}
+            results = convert_parallel(self.directory, list(by_path),
+                                       min(workers, len(documents)))
+            try:
+                for path, error, dependencies, digests, stats in results:
+                    yield by_path[path], error, dependencies, digests, stats
+                    if cancelled is not None and cancelled.is_set():
+                        break
+            finally:
+                results.close()
+        else:
+            # Own cache, as the manifest may be used by the main thread
+            digest_cache = DigestCache(self.directory)
+            for document in documents:
+                if cancelled is not None and cancelled.is_set():
+                    break
+                path, error, dependencies, digests, stats = \
+                    convert_document(self.directory, document.path,
+                                     digest_cache)
+                yield document, error, dependencies, digests, stats
+
+    def finish_build(self, sources, report):
+        """
+        Save state of the site after a build -- the build manifest (without
+        documents which are not in sources any more) and the build report.
+        Returns BuildSummary of the report.
+        """
+        self.manifest.prune(sources)
+        self.manifest.save()
+        report.save(os.path.join(self.config_dir, REPORT_FILE))
+        self.build_report = report
+        self.emit('rebuilt')
+        return BuildSummary(report.rebuilt, report.skipped)
+
+
+class SiteStore(Signals):
     """
+    Index of site files and directories (with exception of generated and
+    hidden files).
+
+    Besides the index of documents by path, the store keeps children of every
+    directory sorted by sort_key(), so the tree can be traversed in display
+    order without any further sorting.
 
-    # Constants for column numbers
-    OBJECT_COL, PATH_COL, NAME_COL = list(range(3))
+    Signals 'added' and 'removed' are emitted with a document as an argument
+    when the document is added to or removed from the store.
+    """
 
     def __init__(self):
-        # Model fields: Document, path, name
-        self.tree_model = Gtk.TreeStore(object, str, str)
-        self.tree_model.set_sort_func(self.OBJECT_COL, self._model_sort_func)
-        self.tree_model.set_sort_column_id(self.OBJECT_COL,
-                                           Gtk.SortType.ASCENDING)
         self.index = {}
-        self._generated = set()
+        # directory path -> (sorted list of children keys, list of children)
+        self._children = {}
+        self._targets = {}  # source path -> generated path
+        self._sources = {}  # generated path -> source path
 
     def contains_path(self, path):
         return path in self.index
 
+    def is_generated(self, path):
+        """Check if the file on path is generated from another document."""
+        return path in self._sources
+
+    def get_source(self, path):
+        """
+        Get document which is converted into file on path, or None if the
+        file is not generated.
+        """
+        source = self._sources.get(path)
+        if source is None:
+            return None
+        return self.index.get(source)
+
     def add(self, document):
         # Handle generated files
-        if document.path in self._generated:
+        if document.path in self._sources:
             return  # Ignore it
-        generated_path = document.generated_path()
-        self._generated.add(generated_path)
-        if generated_path in self.index:
-            self.remove(self.index[generated_path])
+        self._add_generated(document)
 
         # Store into index
         self.index[document.path] = document
-        # Store into tree
+        if document.is_directory():
+            self._children[document.path] = ([], [])
         if document.path == "":
-            return  # Do not store root dir into tree model
-        tree_iter = self.tree_model.append(self.get_parent(document).tree_iter,
-                [document, document.path, document.name])
-        document.tree_iter = tree_iter
+            return  # Root dir has no parent
+        keys, children = self._children[os.path.dirname(document.path)]
+        key = sort_key(document)
+        position = bisect_left(keys, key)
+        keys.insert(position, key)
+        children.insert(position, document)
+        self.emit('added', document)
 
     def remove(self, document):
+        """Remove document (and all its children) from the store."""
+        if document.path in self._children:
+            for child in self._children[document.path][1][:]:
+                self.remove(child)
+            del self._children[document.path]
         del self.index[document.path]
-        self.tree_model.remove(document.tree_iter)
-        if document.generated_path() is not None:
-            self._generated.remove(document.generated_path())
+        if document.path != "":
+            keys, children = self._children[os.path.dirname(document.path)]
+            position = bisect_left(keys, sort_key(document))
+            del keys[position]
+            del children[position]
+        self._remove_generated(document)
+        self.emit('removed', document)
+
+    def update_generated(self, document):
+        """
+        Update the generated path of the document, if it changed (for
+        example name of a fingerprinted asset changes with its content).
+        """
+        if self._targets.get(document.path) == document.generated_path():
+            return
+        self._remove_generated(document)
+        self._add_generated(document)
+
+    def _add_generated(self, document):
+        """Hide file generated from the document."""
+        generated_path = document.generated_path()
+        if generated_path is not None:
+            self._targets[document.path] = generated_path
+            self._sources[generated_path] = document.path
+            if generated_path in self.index:
+                self.remove(self.index[generated_path])
+
+    def _remove_generated(self, document):
+        """Forget file generated from the document."""
+        generated_path = self._targets.pop(document.path, None)
+        if self._sources.get(generated_path) == document.path:
+            del self._sources[generated_path]
 
     def get_by_path(self, path):
         return self.index[path]
@@ -296,26 +502,33 @@ class SiteStore:
         return self.index[parent_path]
 
     def get_children(self, document):
-        """Document children in tree structure."""
-        children = []
-        child_iter = self.tree_model.iter_children(document.tree_iter)
-        while child_iter:
-            children.append(self.tree_model[child_iter][self.OBJECT_COL])
-            child_iter = self.tree_model.iter_next(child_iter)
-        return children
-
-    def _model_sort_func(self, model, iter_x, iter_y, data):
-        x = self.tree_model[iter_x][self.OBJECT_COL]
-        y = self.tree_model[iter_y][self.OBJECT_COL]
-        return compare_files(x, y)
-
+        """Document children in tree structure, in display order."""
+        if document.path not in self._children:
+            return []
+        return list(self._children[document.path][1])
+
+    def get_descendants(self, document):
+        """All documents inside the directory, recursively."""
+        descendants = []
+        for child in self.get_children(document):
+            descendants.append(child)
+            descendants.extend(self.get_descendants(child))
+        return descendants
+
+    def index_of(self, document):
+        """Position of the document among children of its parent."""
+        keys, __ = self._children[os.path.dirname(document.path)]
+        return bisect_left(keys, sort_key(document))
+
+
+class ErrorMessages(Signals):
+    """
+    A collection of conversion error messages.
 
-class ErrorMessages(GObject.GObject):
-    """A collection of conversion error messages."""
-    __gsignals__ = {'update': (GObject.SIGNAL_RUN_FIRST, None, ())}
+    Signal 'update' is emitted after every change.
+    """
 
     def __init__(self):
-        super().__init__()
         self._errors = {}
 
     def set(self, file, message):
@@ -329,6 +542,10 @@ class ErrorMessages(GObject.GObject):
             del self._errors[file]
         self.emit('update')
 
+    def files(self):
+        """Get a list of files which have an error message."""
+        return list(self._errors.keys())
+
     def __len__(self):
         return len(self._errors)
 
@@ -341,6 +558,7 @@ class ErrorMessages(GObject.GObject):
 
 class File(object):
     """File inside Oxalis site."""
+    __slots__ = ('site', 'path', 'converter')
 
     convertible = False
     """Is the document used as a source to generate another file?"""
@@ -350,14 +568,8 @@ class File(object):
     def __init__(self, path, site):
         self.site = site
         self.path = path
-        self.tree_iter = None
         self.converter = converters.matching_converter(site.directory, path)
 
-        if self.converter is not None:
-            self.file_monitor = Gio.File.new_for_path(self.full_path)\
-                .monitor(Gio.FileMonitorFlags.NONE)
-            self.file_monitor.connect('changed', self._on_file_changed)
-
     ## Properties ##
 
     @property
@@ -388,8 +600,31 @@ class File(object):
 
     def convert(self):
         if self.converter is not None:
+            # Taken before the conversion reads the source
+            digests = {self.path: self.site.manifest.digest(self.path)}
             error = self.converter.convert()
-            self.site.errors.set(self, error)
+            self.conversion_done(error, digests=digests)
+
+    def conversion_done(self, error, dependencies=None, digests=None):
+        """
+        Store result of the document conversion.
+
+        error - ErrorMessage or None if conversion was successful
+        dependencies - list of dependencies used by the conversion (they are
+            taken from the converter if not specified)
+        digests - digests of files used by the conversion, see
+            BuildManifest.record()
+        """
+        self.site.errors.set(self, error)
+        if error is None:
+            if dependencies is None:
+                dependencies = self.converter.dependencies()
+            self.site.manifest.record(self.path, self.converter.target(),
+                                      dependencies, digests)
+            self.site.store.update_generated(self)
+            self.site.emit('changed', self.converter.target())
+        else:
+            self.site.manifest.forget(self.path)
 
     ## File operations ##
 
@@ -422,13 +657,10 @@ class File(object):
         if self.convertible and os.path.exists(self.target_full_path):
             pass  # FIXME: Use converters system
 
-    def _on_file_changed(self, monitor, file, other_file, event_type):
-        if event_type in [Gio.FileMonitorEvent.CHANGED, Gio.FileMonitorEvent.CREATED]:
-            self.convert()
-
 
 class Directory(File):
     """Directory in Oxalis site."""
+    __slots__ = ()
 
     @staticmethod
     def is_directory():
@@ -45,6 +45,7 @@ class SiteSettingsDialog:
         self.dialog.get_content_area().add(box)
 
         self.preview_url_entry = builder.get_object('preview_url')
+        self.preview_render_check = builder.get_object('preview_render')
         self.entries = {}
         for entry in self.upload_entries.keys():
             self.entries[entry] = builder.get_object(entry)
@@ -62,12 +63,16 @@ class SiteSettingsDialog:
     def fill_settings(self, site):
         self.preview_url_entry.set_text(
             site.config.get('preview', 'url_path', fallback=''))
+        self.preview_render_check.set_active(site.config.getboolean(
+            'preview', 'render_on_request', fallback=False))
         for entry, option in self.upload_entries.items():
             value = site.upload_config.get('upload', option, fallback="")
             self.entries[entry].set_text(value)
 
     def save_settings(self, site):
         site.config.set('preview', 'url_path', self.preview_url_entry.get_text())
+        site.config.setboolean('preview', 'render_on_request',
+                               self.preview_render_check.get_active())
         for entry, option in self.upload_entries.items():
             site.upload_config.set('upload', option,
                                    self.entries[entry].get_text())
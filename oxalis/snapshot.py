@@ -0,0 +1,114 @@
+# Oxalis -- A website building tool for Gnome
+# Copyright (C) 2014 Sergej Chodarev
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+"""
+Fast scanning of the site files tree.
+
+A snapshot of directory listings is stored in the site configuration
+directory. When the site is opened again, only directories whose
+modification time changed are listed, others are taken from the snapshot.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+import time
+
+from oxalis.build import write_json
+
+SNAPSHOT_FILE = 'tree-snapshot.json'
+SNAPSHOT_VERSION = 1
+# Number of threads listing directories in parallel (helps on network file
+# systems, where every directory listing waits for the server)
+SCAN_WORKERS = 8
+# Directories modified less than this before the scan can be modified again
+# without change of their (coarse) modification time, so they are not trusted
+MTIME_GRANULARITY = 2 * 10**9
+
+
+def list_directory(full_path):
+    """Get list of directory entries as [name, is_directory] pairs."""
+    with os.scandir(full_path) as entries:
+        return [[entry.name, entry.is_dir()] for entry in entries]
+
+
+class TreeSnapshot:
+    """Cached listings of all site directories."""
+
+    def __init__(self, site_path):
+        self.site_path = site_path
+        self.filename = os.path.join(site_path, '_oxalis', SNAPSHOT_FILE)
+        self._directories = {}  # path -> [mtime_ns, entries]
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.filename) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return  # Missing or broken snapshot -- scan everything
+        if data.get('version') == SNAPSHOT_VERSION:
+            self._directories = data['directories']
+
+    def save(self):
+        """Write snapshot into the site configuration directory."""
+        data = {'version': SNAPSHOT_VERSION,
+                'directories': self._directories}
+        try:
+            write_json(self.filename, data)
+        except OSError:
+            pass  # Snapshot is only an optimization
+
+    def scan(self):
+        """
+        Get listings of all site directories (except of '_oxalis'
+        configuration directories) as a dictionary mapping directory path
+        (relative to the site) to a list of [name, is_directory] pairs.
+
+        Directories on the same level of the tree are scanned in parallel.
+        """
+        scan_time = time.time_ns()
+        directories = {}
+        level = ['']
+        with ThreadPoolExecutor(SCAN_WORKERS) as executor:
+            while level:
+                listings = executor.map(self._scan_directory, level,
+                                        [scan_time] * len(level))
+                next_level = []
+                for path, (mtime, entries) in zip(level, listings):
+                    directories[path] = [mtime, entries]
+                    next_level.extend(
+                        os.path.join(path, name) for name, is_dir in entries
+                        if is_dir and name != '_oxalis')
+                level = next_level
+        self._directories = directories
+        return {path: entries for path, (__, entries) in directories.items()}
+
+    def _scan_directory(self, path, scan_time):
+        """
+        List directory, or take its listing from the snapshot if it was not
+        modified. Returns tuple (mtime, entries); mtime is None if the
+        listing can not be trusted next time.
+        """
+        full_path = os.path.join(self.site_path, path)
+        mtime = os.stat(full_path).st_mtime_ns
+        if mtime > scan_time - MTIME_GRANULARITY:
+            mtime = None  # Too recent
+        cached = self._directories.get(path)
+        if mtime is not None and cached is not None and cached[0] == mtime:
+            return mtime, cached[1]
+        return mtime, list_directory(full_path)
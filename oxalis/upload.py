@@ -16,86 +16,581 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
 
+"""
+Uploading of generated site files to a server over FTP or SFTP.
+
+Files are uploaded over several connections in parallel, and every
+connection is reused for many files. The upload itself runs in a separate
+process (the 'oxalis upload' command), the graphical application only reads
+its output -- a stream of JSON progress events, one per line.
+"""
+
+import ftplib
+import json
 import os
-import fcntl
-import string
+import posixpath
+import queue
 import subprocess
+import sys
+import threading
+import time
+from collections import namedtuple
+from urllib.parse import urlsplit
 
-SITECOPYRC_TPL = """site $name
-    server $host
-    username $user
-    password $passwd
-    local $local
-    remote $remotedir
-    exclude *.text
-    exclude _oxalis
-"""
+try:
+    import paramiko
+except ImportError:  # SFTP is optional
+    paramiko = None
 
-SITENAME = "project"
+from oxalis.build import DigestCache, write_json
+from oxalis.converters.markdown import TEMPLATES_DIR
+
+MANIFEST_FILE = 'deploy-manifest.json'
+MANIFEST_VERSION = 1
+# Exceptions raised by failed transfers
+TRANSFER_ERRORS = (OSError, ftplib.Error)
+if paramiko is not None:
+    TRANSFER_ERRORS += (paramiko.SSHException,)
+# Number of parallel connections to the server
+DEFAULT_CONNECTIONS = 4
+# Timeout of connecting to the server and of every operation, so an
+# unresponsive server does not block the upload forever
+DEFAULT_TIMEOUT = 30  # seconds
+# Files smaller than this are uploaded in batches, so a connection takes
+# several of them from the queue at once
+SMALL_FILE_SIZE = 64 * 1024
+SMALL_FILES_BATCH = 16
+# Maximal size of upload process output read at once
+READ_SIZE = 64 * 1024
+
+
+# Changes needed to bring a target up to date -- sorted lists of paths
+DeployPlan = namedtuple('DeployPlan',
+                        ['added', 'changed', 'deleted', 'unchanged'])
+# Progress of an upload -- rate is in bytes per second and eta in seconds,
+# both are None until they can be estimated
+UploadStatus = namedtuple('UploadStatus',
+                          ['files_done', 'files_total', 'bytes_done',
+                           'bytes_total', 'rate', 'eta'])
+
+
+class UploadError(Exception):
+    """Error of connection to the server or of a file transfer."""
+
+
+def is_configured(site):
+    """Check if uploading of the site is configured."""
+    return all(site.upload_config.has_option('upload', key)
+               for key in ('host', 'remotedir', 'user', 'passwd'))
 
-def start_upload(site):
-    """Start uploading site files to server.
 
-    Returns uploading process or False if uploading was not configured.
-    Process of uploading can be monitored using check_upload function.
-    """
-    for key in ('host', 'remotedir', 'user', 'passwd'):
-        if not site.upload_config.has_option('upload', key):
-            return False
-
-    rcfile = os.path.join(site.config_dir, "sitecopyrc")
-    storepath = os.path.join(site.config_dir, "sitecopy")
-
-    # Check if we need to initialize sitecopy
-    # It is needed if we upload to given location for the first time
-    need_init = False
-    for key in ('host', 'remotedir'):
-        if site.upload_config.has_option('upload', 'last_'+key):
-            last = site.upload_config.get('upload', 'last_'+key)
-            current = site.upload_config.get('upload', key)
-            if current != last:
-                need_init = True
-    if not os.path.exists(os.path.join(storepath, SITENAME)):
-        need_init = True
-
-    # Update sitecopyrc file
-    f = open(rcfile, 'w')
-    tpl = string.Template(SITECOPYRC_TPL)
-    f.write(tpl.substitute(dict(site.upload_config.items('upload')),
-        name=SITENAME, local=site.directory))
-    f.close()
-
-    if need_init:
-        sitecopy = subprocess.Popen(('sitecopy',
-            '--rcfile='+rcfile, '--storepath='+storepath, '--init', SITENAME))
-        code = sitecopy.wait()
-    process = subprocess.Popen(('sitecopy',
-        '--rcfile='+rcfile, '--storepath='+storepath, '--update', SITENAME),
-        stdout=subprocess.PIPE)
-
-    for key in ('host', 'remotedir'):
-        site.upload_config.set('upload', 'last_'+key,
-                               site.upload_config.get('upload', key))
-
-    return process
-
-def check_upload(process):
-    """Check if uploading process is completed.
-
-    Returns tuple:
-      - return code, or None if upload is not completed
-      - string containing output of the sitecopy
-    """
-    returncode = process.poll()
-    output = ''
-
-    # Set up asynchronous reading of sitecopy output
-    fd = process.stdout.fileno()
-    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
-    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+def _server(config):
+    """
+    Parse configured host of the server. Host can be specified with
+    a scheme ('sftp://host:port'), otherwise FTP is used.
+    """
+    host = config.get('upload', 'host')
+    if '://' not in host:
+        host = 'ftp://' + host
+    return urlsplit(host)
+
+
+def target_name(site):
+    """
+    Name identifying the upload target, like 'host/remotedir'. Protocol,
+    port and user are not part of the name, so changing them does not cause
+    upload of all files.
+    """
+    config = site.upload_config
+    remote_dir = config.get('upload', 'remotedir')
+    return '{host}/{path}'.format(host=_server(config).hostname,
+                                  path=remote_dir.strip('/'))
+
+
+def publishable_files(site):
+    """
+    Get sorted list of paths of files which should be published -- files
+    generated from documents and all other files except of document sources
+    and templates.
+    """
+    files = []
+    for document in site.store.all_documents():
+        if document.is_directory():
+            continue
+        if document.converter is not None:
+            target = document.converter.target()
+            if os.path.exists(os.path.join(site.directory, target)):
+                files.append(target)
+        elif document.path.split(os.sep)[0] != TEMPLATES_DIR:
+            files.append(document.path)
+    return sorted(files)
+
+
+def connection_factory(site):
+    """
+    Get function creating new connections to the upload target of the site.
+    """
+    config = site.upload_config
+    parts = _server(config)
+    args = (parts.hostname, parts.port, config.get('upload', 'user'),
+            config.get('upload', 'passwd'), config.get('upload', 'remotedir'),
+            config.getfloat('upload', 'timeout', fallback=DEFAULT_TIMEOUT))
+    if parts.scheme == 'ftp':
+        return lambda: FTPConnection(*args)
+    elif parts.scheme == 'sftp':
+        return lambda: SFTPConnection(*args)
+    else:
+        raise UploadError("Unsupported upload protocol '%s'" % parts.scheme)
+
+
+class FTPConnection:
+    """Connection to a FTP server."""
+
+    def __init__(self, host, port, user, password, remote_dir,
+                 timeout=DEFAULT_TIMEOUT):
+        self.remote_dir = remote_dir
+        self.ftp = ftplib.FTP(timeout=timeout)
+        try:
+            self.ftp.connect(host, port or 21)
+            self.ftp.login(user, password)
+        except TRANSFER_ERRORS as e:
+            self.ftp.close()
+            raise UploadError("Can not connect to %s: %s" % (host, e))
+
+    def _remote(self, path):
+        return posixpath.join(self.remote_dir, path.replace(os.sep, '/'))
+
+    def make_directory(self, path):
+        """Create remote directory, if it does not exist."""
+        try:
+            self.ftp.mkd(self._remote(path))
+        except ftplib.error_perm:
+            pass  # Already exists
+
+    def upload(self, path, full_path):
+        """Upload local file from full_path to path on the server."""
+        with open(full_path, 'rb') as f:
+            self.ftp.storbinary('STOR ' + self._remote(path), f)
+
+    def delete(self, path):
+        """Delete remote file, if it exists."""
+        try:
+            self.ftp.delete(self._remote(path))
+        except ftplib.error_perm:
+            pass  # Already deleted
+
+    def remove_directory(self, path):
+        """Remove remote directory, if it is empty."""
+        try:
+            self.ftp.rmd(self._remote(path))
+        except ftplib.error_perm:
+            pass  # Not empty or already removed
+
+    def close(self):
+        try:
+            self.ftp.quit()
+        except (OSError, ftplib.Error):
+            self.ftp.close()
+
+
+class SFTPConnection:
+    """Connection to a SFTP server. Requires paramiko."""
+
+    def __init__(self, host, port, user, password, remote_dir,
+                 timeout=DEFAULT_TIMEOUT):
+        if paramiko is None:
+            raise UploadError("SFTP upload requires the paramiko module")
+        self.remote_dir = remote_dir
+        self.client = paramiko.SSHClient()
+        # Only hosts known to SSH are accepted
+        self.client.load_system_host_keys()
+        try:
+            self.client.connect(host, port or 22, user, password,
+                                timeout=timeout)
+            self.sftp = self.client.open_sftp()
+            self.sftp.get_channel().settimeout(timeout)
+        except TRANSFER_ERRORS as e:
+            self.client.close()
+            raise UploadError("Can not connect to %s: %s" % (host, e))
+
+    def _remote(self, path):
+        return posixpath.join(self.remote_dir, path.replace(os.sep, '/'))
+
+    def make_directory(self, path):
+        """Create remote directory, if it does not exist."""
+        try:
+            self.sftp.mkdir(self._remote(path))
+        except IOError:
+            pass  # Already exists
+
+    def upload(self, path, full_path):
+        """Upload local file from full_path to path on the server."""
+        # putfo() pipelines writes, so it does not wait for every block
+        with open(full_path, 'rb') as f:
+            self.sftp.putfo(f, self._remote(path), confirm=False)
+
+    def delete(self, path):
+        """Delete remote file, if it exists."""
+        try:
+            self.sftp.remove(self._remote(path))
+        except IOError:
+            pass  # Already deleted
+
+    def remove_directory(self, path):
+        """Remove remote directory, if it is empty."""
+        try:
+            self.sftp.rmdir(self._remote(path))
+        except IOError:
+            pass  # Not empty or already removed
+
+    def close(self):
+        self.client.close()
+
+
+def parent_directories(path):
+    """List of all parent directories of the path."""
+    parents = []
+    directory = os.path.dirname(path)
+    while directory:
+        parents.append(directory)
+        directory = os.path.dirname(directory)
+    return parents
+
+
+class Uploader:
+    """
+    Uploads files using a pool of parallel connections.
+
+    connect - function returning a new connection (like FTPConnection)
+    connections - maximal number of parallel connections
+    """
 
+    def __init__(self, connect, connections=DEFAULT_CONNECTIONS):
+        self.connect = connect
+        self.connections = connections
+        self._lock = threading.Lock()
+
+    def upload(self, site_path, files, progress=None):
+        """
+        Upload files (paths relative to site_path) with their directories.
+        progress(path, size) is called after every uploaded file, from
+        the uploading threads (but never concurrently).
+        Raises UploadError if some file could not be uploaded.
+        """
+        if not files:
+            return
+        first = self.connect()
+        try:
+            directories = set()
+            for path in files:
+                directories.update(parent_directories(path))
+            for directory in sorted(directories):  # Parents first
+                first.make_directory(directory)
+        except BaseException:
+            first.close()
+            raise
+
+        tasks = queue.Queue()
+        for batch in self._batches(site_path, files):
+            tasks.put(batch)
+        errors = []
+        workers = [threading.Thread(
+            target=self._work,
+            args=(first if i == 0 else None, site_path, tasks, errors,
+                  progress))
+            for i in range(min(self.connections, tasks.qsize()))]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        if errors:
+            raise errors[0]
+
+    def delete(self, files, kept, progress=None):
+        """
+        Delete files (paths relative to the site) from the server and remove
+        their directories which do not contain any of the kept files.
+        progress(path) is called after every deleted file.
+        """
+        if not files:
+            return
+        used = set()
+        for path in kept:
+            used.update(parent_directories(path))
+        connection = self.connect()
+        try:
+            directories = set()
+            for path in files:
+                try:
+                    connection.delete(path)
+                except TRANSFER_ERRORS as e:
+                    raise UploadError("Can not delete %s: %s" % (path, e))
+                if progress is not None:
+                    progress(path)
+                directories.update(parent_directories(path))
+            for directory in sorted(directories - used, reverse=True):
+                connection.remove_directory(directory)
+        finally:
+            connection.close()
+
+    def _batches(self, site_path, files):
+        """
+        Split files into tasks -- large files are uploaded one by one, small
+        files in batches. Largest files go first, so uploads finish at
+        about the same time on all connections.
+        """
+        sizes = {path: os.path.getsize(os.path.join(site_path, path))
+                 for path in files}
+        ordered = sorted(files, key=lambda path: sizes[path], reverse=True)
+        batch = []
+        for path in ordered:
+            if sizes[path] >= SMALL_FILE_SIZE:
+                yield [(path, sizes[path])]
+            else:
+                batch.append((path, sizes[path]))
+                if len(batch) == SMALL_FILES_BATCH:
+                    yield batch
+                    batch = []
+        if batch:
+            yield batch
+
+    def _work(self, connection, site_path, tasks, errors, progress):
+        try:
+            if connection is None:
+                connection = self.connect()
+            while not errors:
+                try:
+                    batch = tasks.get_nowait()
+                except queue.Empty:
+                    break
+                for path, size in batch:
+                    try:
+                        connection.upload(path, os.path.join(site_path, path))
+                    except TRANSFER_ERRORS as e:
+                        raise UploadError("Can not upload %s: %s" % (path, e))
+                    if progress is not None:
+                        with self._lock:
+                            progress(path, size)
+        except UploadError as e:
+            errors.append(e)
+        finally:
+            if connection is not None:
+                connection.close()
+
+
+class DeployManifest:
+    """
+    Digests of files deployed to every target.
+
+    The plan of changes is computed by comparison of the deployed digests
+    with digests of local files, without looking at the target. Digests of
+    local files are cached in a DigestCache, so only changed files need to be
+    read.
+    """
+
+    def __init__(self, site_path):
+        self.site_path = site_path
+        self.filename = os.path.join(site_path, '_oxalis', MANIFEST_FILE)
+        self._targets = {}  # target name -> {path: digest}
+        self._digests = DigestCache(site_path)
+        try:
+            with open(self.filename) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return  # Missing or broken manifest -- upload everything
+        if data.get('version') == MANIFEST_VERSION:
+            self._targets = data['targets']
+            self._digests = DigestCache(site_path, data['files'])
+
+    def save(self):
+        """Write manifest to the site configuration directory."""
+        write_json(self.filename, {'version': MANIFEST_VERSION,
+                                   'targets': self._targets,
+                                   'files': self._digests.entries})
+
+    def digest(self, path):
+        """Return digest of the local file on path."""
+        return self._digests.digest(path)
+
+    def plan(self, target, files):
+        """Compute DeployPlan for deploying files to the target."""
+        deployed = self._targets.get(target, {})
+        added, changed, unchanged = [], [], []
+        for path in sorted(files):
+            if path not in deployed:
+                added.append(path)
+            elif deployed[path] != self.digest(path):
+                changed.append(path)
+            else:
+                unchanged.append(path)
+        deleted = sorted(set(deployed) - set(files))
+        self._digests.prune(files)  # Other digests are not needed any more
+        return DeployPlan(added, changed, deleted, unchanged)
+
+    def files(self, target):
+        """Get files deployed to the target as dictionary path -> digest."""
+        return dict(self._targets.get(target, {}))
+
+    def deployed(self, target, path):
+        """Record that the current version of the file was deployed."""
+        self._targets.setdefault(target, {})[path] = self.digest(path)
+
+    def removed(self, target, path):
+        """Record that the file was deleted from the target."""
+        self._targets.get(target, {}).pop(path, None)
+
+
+class ProgressTracker:
+    """Counts transferred files and bytes against the planned totals."""
+
+    def __init__(self, files_total, bytes_total, clock=time.monotonic):
+        self.files_total = files_total
+        self.bytes_total = bytes_total
+        self.files_done = 0
+        self.bytes_done = 0
+        self._clock = clock
+        self._start = clock()
+
+    def add(self, size=0):
+        """Record transfer of one file of given size."""
+        self.files_done += 1
+        self.bytes_done += size
+
+    def status(self):
+        """Get current UploadStatus."""
+        elapsed = self._clock() - self._start
+        rate = eta = None
+        if self.bytes_done > 0 and elapsed > 0:
+            rate = self.bytes_done / elapsed
+            eta = (self.bytes_total - self.bytes_done) / rate
+        return UploadStatus(self.files_done, self.files_total,
+                            self.bytes_done, self.bytes_total, rate, eta)
+
+
+def upload_site(site, connections=None, progress=None, dry_run=False):
+    """
+    Upload new and changed files to the configured target and delete files
+    which are not in the site any more.
+
+    progress(action, path, status) is called with action 'start' (and path
+    None) before the transfer and then after every uploaded ('upload') or
+    deleted ('delete') file; status is an UploadStatus. If dry_run is True,
+    nothing is changed. Returns DeployPlan. Raises UploadError on failure --
+    files transferred before the failure are recorded, so they are not
+    uploaded again.
+    """
+    if connections is None:
+        connections = site.upload_config.getint(
+            'upload', 'connections', fallback=DEFAULT_CONNECTIONS)
+    target = target_name(site)
+    manifest = DeployManifest(site.directory)
+    files = publishable_files(site)
+    plan = manifest.plan(target, files)
+    if dry_run:
+        manifest.save()  # Keep computed digests
+        return plan
+
+    transferred = plan.added + plan.changed
+    tracker = ProgressTracker(
+        len(transferred) + len(plan.deleted),
+        sum(os.path.getsize(os.path.join(site.directory, path))
+            for path in transferred))
+    if progress is not None:
+        progress('start', None, tracker.status())
+
+    def uploaded(path, size):
+        manifest.deployed(target, path)
+        tracker.add(size)
+        if progress is not None:
+            progress('upload', path, tracker.status())
+
+    def deleted(path):
+        manifest.removed(target, path)
+        tracker.add()
+        if progress is not None:
+            progress('delete', path, tracker.status())
+
+    uploader = Uploader(connection_factory(site), connections)
     try:
-        output = process.stdout.read()
+        uploader.upload(site.directory, transferred, uploaded)
+        uploader.delete(plan.deleted, files, deleted)
     finally:
-        return returncode, output
+        manifest.save()
+    return plan
+
+
+def progress_event(action, path, status):
+    """Encode upload progress as a line of JSON for the upload process."""
+    event = status._asdict()
+    event.update(event=action, path=path)
+    return json.dumps(event)
+
+
+def parse_event(line):
+    """
+    Decode line of the upload process output into a dictionary with key
+    'event'. Lines which are not progress events (like error messages) are
+    returned as {'event': 'output', 'text': line}.
+    """
+    try:
+        event = json.loads(line)
+    except ValueError:
+        event = None
+    if not isinstance(event, dict) or 'event' not in event:
+        event = {'event': 'output', 'text': line}
+    return event
+
 
+class UploadProcess:
+    """
+    Upload running in a separate process, started by start_upload().
+
+    The process output should be read by read_events() whenever the pipe
+    (see fileno()) is readable -- for example from a main loop I/O watch,
+    so no polling is needed.
+    """
+
+    def __init__(self, args):
+        self.process = subprocess.Popen(args, stdout=subprocess.PIPE,
+                                        stderr=subprocess.STDOUT)
+        self.returncode = None
+        self._buffer = b''
+
+    def fileno(self):
+        """File descriptor of the output pipe."""
+        return self.process.stdout.fileno()
+
+    def read_events(self):
+        """
+        Read available output of the process and return list of complete
+        events in it. At the end of output, waits for the process and sets
+        returncode. Blocks if the pipe is not readable.
+        """
+        data = os.read(self.fileno(), READ_SIZE)
+        if data:
+            self._buffer += data
+            *lines, self._buffer = self._buffer.split(b'\n')
+        else:  # End of output
+            lines = [self._buffer] if self._buffer else []
+            self._buffer = b''
+            self.process.stdout.close()
+            self.returncode = self.process.wait()
+        return [parse_event(line.decode('utf-8', 'replace'))
+                for line in lines if line.strip()]
+
+    @property
+    def finished(self):
+        return self.returncode is not None
+
+
+def start_upload(site):
+    """Start uploading site files to server.
+
+    Returns UploadProcess or False if uploading was not configured.
+    """
+    if not is_configured(site):
+        return False
+    site.upload_config.save()  # The upload process reads it from the file
+    return UploadProcess(
+        (sys.executable, '-u', '-m', 'oxalis.cli', 'upload',
+         '--progress', 'json', site.directory))
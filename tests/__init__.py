@@ -0,0 +1,18 @@
+import os
+import shutil
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+
+from oxalis.site import Site
+
+TESTDIR = os.path.join(os.path.dirname(__file__), "test-site")
+
+
+class SiteTestCase(TestCase):
+    """Test case working with a temporary copy of the test site."""
+    def setUp(self):
+        self._tempdir = TemporaryDirectory()
+        self.addCleanup(self._tempdir.cleanup)
+        self.site_path = os.path.join(self._tempdir.name, "site")
+        shutil.copytree(TESTDIR, self.site_path)
+        self.site = Site(self.site_path)
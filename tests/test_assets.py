@@ -0,0 +1,167 @@
+import os
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+
+from oxalis import upload
+from oxalis.converters.assets import AssetConverter, minify_css, minify_js
+from oxalis.converters.markdown import MarkdownConverter
+from oxalis.site import Site
+from tests import SiteTestCase
+
+
+class TestMinify(TestCase):
+    def test_css(self):
+        self.assertEqual(
+            minify_css("/* comment */\n"
+                       "h1 > a,\np:hover {\n  color : red ;\n"
+                       "  margin: 0 auto !important;\n"
+                       "  width: calc(1px + 2px);\n}\n"
+                       "@media screen and (max-width: 10px) {\n"
+                       "  p { content: \"a  ;  }\"; }\n}\n"
+                       "/*! License */\n"),
+            "h1>a,p:hover{color :red;margin:0 auto!important;"
+            "width:calc(1px + 2px)}"
+            "@media screen and (max-width:10px){p{content:\"a  ;  }\"}}"
+            "/*! License */")
+        # Space before a pseudo-class selects descendants
+        self.assertEqual(minify_css("div  :first-child {}"),
+                         "div :first-child{}")
+
+    def test_js(self):
+        self.assertEqual(
+            minify_js("// comment\n"
+                      "var a = 1 ,  b = 2; /* x */\n\n"
+                      "function f ( x ) {\n"
+                      "    return x / 2;   // half\n"
+                      "}\n"
+                      "var re = /a+[/]\\//g, s = \"a // b\", t = `x\n  y`;\n"
+                      "b = a - -b; c = a + ++b; d = 1 .toString()\n"),
+            "var a=1,b=2;\n"
+            "function f(x){\n"
+            "return x / 2;\n"
+            "}\n"
+            "var re= /a+[/]\\//g,s=\"a // b\",t=`x\n  y`;\n"
+            "b=a- -b;c=a+ ++b;d=1 .toString()")
+
+    def test_js_line_breaks(self):
+        # Line breaks are kept for automatic semicolon insertion
+        self.assertEqual(minify_js("a = b\n/* multi\nline */(c)"),
+                         "a=b\n(c)")
+
+
+class TestAssetConverter(TestCase):
+    def setUp(self):
+        self._tempdir = TemporaryDirectory()
+        self.site_path = self._tempdir.name
+        os.mkdir(os.path.join(self.site_path, "css"))
+        self.write("css/site.css.bundle", "# Styles\nbase.css\n\nlayout.css\n")
+        self.write("css/base.css", "body {\n  margin: 0;\n}\n")
+        self.write("css/layout.css", "p { color: red; }\n")
+
+    def tearDown(self):
+        self._tempdir.cleanup()
+
+    def write(self, path, text):
+        with open(os.path.join(self.site_path, path), 'w') as f:
+            f.write(text)
+
+    def read(self, path):
+        with open(os.path.join(self.site_path, path)) as f:
+            return f.read()
+
+    def test_match(self):
+        self.assertTrue(AssetConverter.matches("site.css.bundle"))
+        self.assertTrue(AssetConverter.matches("js/site.js.bundle"))
+        self.assertFalse(AssetConverter.matches("site.css"))
+        self.assertFalse(AssetConverter.matches("site.bundle"))
+
+    def test_convert(self):
+        converter = AssetConverter(self.site_path, "css/site.css.bundle")
+        self.assertEqual(converter.dependencies(),
+                         ["css/base.css", "css/layout.css"])
+        target = converter.target()
+        self.assertRegex(target, r"^css/site\.[0-9a-f]{10}\.css$")
+        self.assertIsNone(converter.convert())
+        self.assertEqual(self.read(target), "body{margin:0}\np{color:red}")
+        self.assertEqual(converter.stats.size, 27)
+
+        # New version gets a new name and replaces the old one
+        self.write("css/layout.css", "p { color: blue; }\n")
+        new_target = converter.target()
+        self.assertNotEqual(new_target, target)
+        self.assertIsNone(converter.convert())
+        self.assertFalse(os.path.exists(os.path.join(self.site_path, target)))
+        self.assertIn("blue", self.read(new_target))
+        css_files = os.listdir(os.path.join(self.site_path, "css"))
+        self.assertEqual(sorted(css_files),
+                         sorted(["base.css", "layout.css", "site.css.bundle",
+                                 os.path.basename(new_target)]))
+
+    def test_missing(self):
+        os.remove(os.path.join(self.site_path, "css/layout.css"))
+        converter = AssetConverter(self.site_path, "css/site.css.bundle")
+        error = converter.convert()
+        self.assertEqual(error.file, "css/site.css.bundle")
+        self.assertIn("css/layout.css", error.message)
+
+    def test_outside_of_site(self):
+        for line in ["../../outside.css", "/etc/passwd"]:
+            self.write("css/site.css.bundle", "base.css\n" + line + "\n")
+            converter = AssetConverter(self.site_path, "css/site.css.bundle")
+            error = converter.convert()
+            self.assertEqual(error.file, "css/site.css.bundle")
+            self.assertIn("outside of the site", error.message)
+        # Names starting with dots are fine
+        self.write("css/..dots.css", "a { color: red; }\n")
+        self.write("css/site.css.bundle", "..dots.css\n")
+        converter = AssetConverter(self.site_path, "css/site.css.bundle")
+        self.assertIsNone(converter.convert())
+
+class TestAssetHelper(SiteTestCase):
+    def setUp(self):
+        super().setUp()
+        with open(os.path.join(self.site_path, "_templates", "default.html"),
+                  'w') as f:
+            f.write("{{ asset('test.css') }} {{ asset('app.js') }}")
+        with open(os.path.join(self.site_path, "app.js.bundle"), 'w') as f:
+            f.write("subdir/app.js\n")
+        with open(os.path.join(self.site_path, "subdir", "app.js"), 'w') as f:
+            f.write("var x = 1;\n")
+
+    def read(self, path):
+        with open(os.path.join(self.site_path, path)) as f:
+            return f.read()
+
+    def test_resolve(self):
+        bundle = AssetConverter(self.site_path, "app.js.bundle")
+        converter = MarkdownConverter(self.site_path, "subdir/index.md")
+        self.assertIsNone(converter.convert())
+        self.assertEqual(self.read("subdir/index.html"),
+                         "../test.css ../" + bundle.target())
+        self.assertCountEqual(converter.dependencies(),
+                              ["_templates/default.html", "test.css.bundle",
+                               "app.js.bundle", "subdir/app.js"])
+
+    def test_site(self):
+        site = Site(self.site_path)
+        site.generate()
+        self.assertEqual(site.errors.files(), [])
+        bundle = site.store.get_by_path("app.js.bundle")
+        target = bundle.converter.target()
+        self.assertIn(target, upload.publishable_files(site))
+        self.assertNotIn("app.js.bundle", upload.publishable_files(site))
+        self.assertEqual(self.read("index.html"), "test.css " + target)
+
+        # Change of a bundled file changes the URL in pages
+        with open(os.path.join(self.site_path, "subdir", "app.js"), 'a') as f:
+            f.write("var y = 2;\n")
+        site.file_changed(os.path.join("subdir", "app.js"))
+        new_target = bundle.converter.target()
+        self.assertNotEqual(new_target, target)
+        self.assertEqual(self.read("index.html"), "test.css " + new_target)
+        self.assertEqual(self.read(os.path.join("subdir", "index.html")),
+                         "../test.css ../" + new_target)
+        self.assertFalse(os.path.exists(os.path.join(self.site_path, target)))
+        # The new file is hidden like other generated files
+        site.add_path(new_target)
+        self.assertFalse(site.store.contains_path(new_target))
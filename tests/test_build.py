@@ -0,0 +1,178 @@
+import json
+import os
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+
+from oxalis.build import (BuildManifest, BuildReport, DigestCache,
+                          convert_parallel, write_json)
+from oxalis.converters.base import ConversionStats
+from oxalis.converters.markdown import MarkdownConverter
+
+
+class TestBuildManifest(TestCase):
+    def setUp(self):
+        self._tempdir = TemporaryDirectory()
+        self.site_path = self._tempdir.name
+        os.mkdir(os.path.join(self.site_path, "_oxalis"))
+        os.mkdir(os.path.join(self.site_path, "_templates"))
+        self.write("_templates/default.html", "Default: {{ content }}")
+        self.write("test.md", "# Hello\n")
+
+    def tearDown(self):
+        self._tempdir.cleanup()
+
+    def write(self, path, text):
+        with open(os.path.join(self.site_path, path), 'w') as f:
+            f.write(text)
+        # Make sure the change is visible even on coarse timestamps
+        stat = os.stat(os.path.join(self.site_path, path))
+        os.utime(os.path.join(self.site_path, path),
+                 ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000000))
+
+    def build(self, manifest):
+        mc = MarkdownConverter(self.site_path, "test.md")
+        mc.convert()
+        manifest.record("test.md", mc.target(), mc.dependencies())
+
+    def test_unknown_source(self):
+        manifest = BuildManifest(self.site_path)
+        self.assertFalse(manifest.is_current("test.md"))
+
+    def test_current_after_record(self):
+        manifest = BuildManifest(self.site_path)
+        self.build(manifest)
+        self.assertTrue(manifest.is_current("test.md"))
+
+    def test_persistence(self):
+        manifest = BuildManifest(self.site_path)
+        self.build(manifest)
+        manifest.save()
+        self.assertTrue(BuildManifest(self.site_path).is_current("test.md"))
+
+    def test_source_changed(self):
+        manifest = BuildManifest(self.site_path)
+        self.build(manifest)
+        self.write("test.md", "# Changed\n")
+        self.assertFalse(manifest.is_current("test.md"))
+
+    def test_template_changed(self):
+        manifest = BuildManifest(self.site_path)
+        self.build(manifest)
+        self.write("_templates/default.html", "Changed: {{ content }}")
+        self.assertFalse(manifest.is_current("test.md"))
+
+    def test_target_changed(self):
+        manifest = BuildManifest(self.site_path)
+        self.build(manifest)
+        os.remove(os.path.join(self.site_path, "test.html"))
+        self.assertFalse(manifest.is_current("test.md"))
+
+    def test_touch_without_change(self):
+        manifest = BuildManifest(self.site_path)
+        self.build(manifest)
+        self.write("test.md", "# Hello\n")
+        self.assertTrue(manifest.is_current("test.md"))
+
+    def test_forget_and_prune(self):
+        manifest = BuildManifest(self.site_path)
+        self.build(manifest)
+        manifest.forget("test.md")
+        self.assertFalse(manifest.is_current("test.md"))
+        self.build(manifest)
+        manifest.prune([])
+        self.assertFalse(manifest.is_current("test.md"))
+
+    def test_dependents(self):
+        self.write("_templates/other.html", "Other: {{ content }}")
+        self.write("other.md", "Template: other\n\n# Other\n")
+        manifest = BuildManifest(self.site_path)
+        self.build(manifest)
+        mc = MarkdownConverter(self.site_path, "other.md")
+        mc.convert()
+        manifest.record("other.md", mc.target(), mc.dependencies())
+        self.assertEqual(manifest.dependents("_templates/default.html"),
+                         {"test.md"})
+        self.assertEqual(manifest.dependents("_templates/other.html"),
+                         {"other.md"})
+        manifest.forget("other.md")
+        self.assertEqual(manifest.dependents("_templates/other.html"), set())
+
+
+class TestDigestCache(TestCase):
+    def test_digest(self):
+        with TemporaryDirectory() as site_path:
+            with open(os.path.join(site_path, "a.txt"), 'w') as f:
+                f.write("a")
+            cache = DigestCache(site_path)
+            digest = cache.digest("a.txt")
+            self.assertEqual(digest,
+                             "86f7e437faa5a7fce15d1ddcb9eaeaea377667b8")
+            self.assertIsNone(cache.digest("missing.txt"))
+            # Cached digest is used while the file is not modified
+            cache.entries["a.txt"][2] = "cached"
+            self.assertEqual(DigestCache(site_path,
+                                         cache.entries).digest("a.txt"),
+                             "cached")
+            cache.prune([])
+            self.assertEqual(cache.entries, {})
+            self.assertEqual(cache.digest("a.txt"), digest)
+
+
+class TestWriteJson(TestCase):
+    def test_write_json(self):
+        with TemporaryDirectory() as tempdir:
+            filename = os.path.join(tempdir, "data.json")
+            write_json(filename, {"a": 1})
+            # Failed write keeps the old file and removes the temporary one
+            with self.assertRaises(TypeError):
+                write_json(filename, {"a": object()})
+            self.assertEqual(os.listdir(tempdir), ["data.json"])
+            with open(filename) as f:
+                self.assertEqual(json.load(f), {"a": 1})
+
+
+class TestParallelBuild(TestCase):
+    def test_convert_parallel(self):
+        with TemporaryDirectory() as tempdir:
+            templates_path = os.path.join(tempdir, "_templates")
+            os.mkdir(templates_path)
+            with open(os.path.join(templates_path, "default.html"), 'w') as f:
+                f.write("Default: {{ content }}")
+            paths = ["page%d.md" % i for i in range(4)] + ["broken.md"]
+            for i, path in enumerate(paths):
+                with open(os.path.join(tempdir, path), 'w') as f:
+                    f.write("# Page %d\n" % i)
+            with open(os.path.join(tempdir, "broken.md"), 'w') as f:
+                f.write("Template: missing\n\n# Broken\n")
+
+            results = list(convert_parallel(tempdir, paths, 2))
+
+            self.assertEqual([result[0] for result in results], paths)
+            for path, error, dependencies, digests, stats in results[:-1]:
+                self.assertIsNone(error)
+                self.assertIn("_templates/default.html", dependencies)
+                self.assertEqual(sorted(digests),
+                                 sorted([path, path[:-3] + ".html"]
+                                        + dependencies))
+                self.assertEqual(stats.size, len("Default: <h1>Page 0</h1>"))
+            with open(os.path.join(tempdir, "page3.html")) as f:
+                self.assertEqual(f.read(), "Default: <h1>Page 3</h1>")
+            __, error, __, __, __ = results[-1]
+            self.assertEqual(error.file, "broken.md")
+
+
+class TestBuildReport(TestCase):
+    def test_report(self):
+        report = BuildReport()
+        report.add("fast.md", ConversionStats(0.1, 0.1, 0.1, 0.1, 100))
+        report.add("slow.md", ConversionStats(0.1, 0.1, 2.0, 0.1, 100))
+        report.add("failed.md", None)
+        self.assertEqual([path for path, __ in report.slowest(1)],
+                         ["slow.md"])
+        with TemporaryDirectory() as tempdir:
+            filename = os.path.join(tempdir, "report.json")
+            report.save(filename)
+            with open(filename) as f:
+                data = json.load(f)
+        self.assertEqual(sorted(data['documents']), ["fast.md", "slow.md"])
+        self.assertAlmostEqual(data['documents']['slow.md']['total'], 2.3)
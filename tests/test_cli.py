@@ -0,0 +1,21 @@
+import os
+import subprocess
+import sys
+from unittest import TestCase
+
+from oxalis import cli, deploy
+
+
+class TestCommandLine(TestCase):
+    def test_lazy_imports(self):
+        """Upload modules are not needed for parsing of arguments."""
+        code = ("import sys, oxalis.cli; oxalis.cli.create_parser(); "
+                "print('oxalis.upload' in sys.modules, "
+                "'oxalis.deploy' in sys.modules)")
+        output = subprocess.check_output(
+            [sys.executable, '-c', code],
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        self.assertEqual(output.split(), [b'False', b'False'])
+
+    def test_archive_formats(self):
+        self.assertEqual(cli.ARCHIVE_FORMATS, sorted(deploy.ARCHIVE_FORMATS))
@@ -0,0 +1,134 @@
+import io
+import os
+import tarfile
+import zipfile
+
+from oxalis import deploy, upload
+from tests import SiteTestCase
+
+
+class DeployTestCase(SiteTestCase):
+    def setUp(self):
+        super().setUp()
+        self.write("test.css", "p { color: red }\n")
+        self.write(os.path.join("subdir", "test.jpeg"), "image")
+        self.add_file(os.path.join("media", "copy.jpeg"), "image")
+
+    def write(self, path, contents):
+        with open(os.path.join(self.site_path, path), 'w') as f:
+            f.write(contents)
+
+    def add_file(self, path, contents):
+        os.makedirs(os.path.join(self.site_path, os.path.dirname(path)),
+                    exist_ok=True)
+        self.write(path, contents)
+        self.site.add_path(os.path.dirname(path))
+        self.site.add_path(path)
+
+
+class TestDirectoryDeployer(DeployTestCase):
+    def setUp(self):
+        super().setUp()
+        self.target = os.path.join(self._tempdir.name, "target")
+
+    def deploy(self, **kwargs):
+        return deploy.DirectoryDeployer(self.site, self.target,
+                                        **kwargs).deploy()
+
+    def target_file(self, path):
+        return os.path.join(self.target, path)
+
+    def test_deploy(self):
+        files = upload.publishable_files(self.site)
+        self.assertEqual(self.deploy().added, files)
+        for path in files:
+            with open(os.path.join(self.site_path, path)) as f, \
+                    open(self.target_file(path)) as t:
+                self.assertEqual(f.read(), t.read())
+        self.assertFalse(os.path.exists(self.target_file("index.md")))
+        self.assertFalse(os.path.exists(self.target_file("_templates")))
+        self.assertFalse(os.path.exists(self.target_file("_oxalis")))
+
+        # Unchanged files are skipped, missing files are restored
+        self.assertEqual(self.deploy(), ([], [], [], files))
+        os.remove(self.target_file("test.css"))
+        self.write("index.html", "changed")
+        plan = self.deploy()
+        self.assertEqual(plan.added, ["test.css"])
+        self.assertEqual(plan.changed, ["index.html"])
+        with open(self.target_file("index.html")) as f:
+            self.assertEqual(f.read(), "changed")
+
+    def test_delete(self):
+        self.deploy()
+        os.remove(os.path.join(self.site_path, "media", "copy.jpeg"))
+        self.site.file_deleted(os.path.join("media", "copy.jpeg"))
+        plan = self.deploy()
+        self.assertEqual(plan.deleted, [os.path.join("media", "copy.jpeg")])
+        self.assertFalse(os.path.exists(self.target_file("media")))
+        self.assertTrue(os.path.exists(self.target_file("subdir")))
+
+    def test_deduplication(self):
+        self.deploy()
+        copy = os.stat(self.target_file(os.path.join("media", "copy.jpeg")))
+        original = os.stat(self.target_file(os.path.join("subdir",
+                                                         "test.jpeg")))
+        self.assertEqual(copy.st_ino, original.st_ino)
+        # Files are linked also to files deployed before
+        self.add_file(os.path.join("media", "new.jpeg"), "image")
+        self.deploy()
+        new = os.stat(self.target_file(os.path.join("media", "new.jpeg")))
+        self.assertEqual(new.st_ino, original.st_ino)
+        # Changed file is replaced, not modified through the link
+        self.write(os.path.join("subdir", "test.jpeg"), "other")
+        self.deploy()
+        with open(self.target_file(os.path.join("media", "copy.jpeg"))) as f:
+            self.assertEqual(f.read(), "image")
+
+    def test_hardlink(self):
+        self.deploy(hardlink=True)
+        self.assertEqual(os.stat(self.target_file("test.css")).st_ino,
+                         os.stat(os.path.join(self.site_path,
+                                              "test.css")).st_ino)
+
+    def test_dry_run(self):
+        plan = deploy.DirectoryDeployer(self.site, self.target).deploy(
+            dry_run=True)
+        self.assertEqual(plan.added, upload.publishable_files(self.site))
+        self.assertFalse(os.path.exists(self.target))
+
+    def test_target_in_site(self):
+        with self.assertRaises(upload.UploadError):
+            deploy.DirectoryDeployer(
+                self.site, os.path.join(self.site_path, "out")).deploy()
+
+
+class TestArchive(DeployTestCase):
+    def test_format(self):
+        self.assertEqual(deploy.archive_format("site.tar.gz"), 'tar.gz')
+        self.assertEqual(deploy.archive_format("site.zip"), 'zip')
+        self.assertIsNone(deploy.archive_format("site"))
+
+    def test_tar(self):
+        output = io.BytesIO()
+        files = deploy.write_archive(self.site, output, 'tar.gz')
+        self.assertEqual(files, upload.publishable_files(self.site))
+        output.seek(0)
+        with tarfile.open(fileobj=output) as tar:
+            self.assertEqual(sorted(tar.getnames()), files)
+            copy = tar.getmember("subdir/test.jpeg")
+            self.assertTrue(copy.islnk())
+            self.assertEqual(copy.linkname, "media/copy.jpeg")
+            self.assertEqual(tar.extractfile(copy).read(), b"image")
+            self.assertEqual(tar.extractfile("test.css").read(),
+                             b"p { color: red }\n")
+
+    def test_zip(self):
+        output = io.BytesIO()
+        deploy.write_archive(self.site, output, 'zip')
+        with zipfile.ZipFile(output) as archive:
+            self.assertEqual(sorted(archive.namelist()),
+                             upload.publishable_files(self.site))
+            self.assertEqual(archive.getinfo("media/copy.jpeg").compress_type,
+                             zipfile.ZIP_STORED)
+            self.assertEqual(archive.read("test.css"), b"p { color: red }\n")
@@ -1,8 +1,10 @@
 import os
+import threading
 from tempfile import TemporaryDirectory
 from unittest import TestCase
 
-from oxalis.converters.markdown import MarkdownConverter
+from oxalis.converters.base import write_output
+from oxalis.converters.markdown import MarkdownContext, MarkdownConverter
 
 
 class TestMarkdownConverter(TestCase):
@@ -19,6 +21,34 @@ class TestMarkdownConverter(TestCase):
         mc = MarkdownConverter("/tmp/site", "dir/test.md")
         self.assertEqual(mc.target(), "dir/test.html")
 
+    def test_shared_context(self):
+        self.assertIs(MarkdownContext.for_site("/tmp/site"),
+                      MarkdownContext.for_site("/tmp/site"))
+        self.assertIsNot(MarkdownContext.for_site("/tmp/site"),
+                         MarkdownContext.for_site("/tmp/other"))
+
+    def test_bytecode_cache(self):
+        with TemporaryDirectory() as tempdir:
+            os.mkdir(os.path.join(tempdir, "_oxalis"))
+            templates_path = os.path.join(tempdir, "_templates")
+            os.mkdir(templates_path)
+            template_path = os.path.join(templates_path, "default.html")
+            with open(template_path, 'w') as f:
+                f.write("Default: {{ content }}")
+
+            context = MarkdownContext(tempdir)
+            self.assertEqual(context.env.get_template("default.html").render(
+                content="x"), "Default: x")
+            cache_dir = os.path.join(tempdir, "_oxalis", "jinja-cache")
+            self.assertEqual(len(os.listdir(cache_dir)), 1)
+
+            # Changed template must not be loaded from the cache
+            with open(template_path, 'w') as f:
+                f.write("Changed: {{ content }}")
+            context = MarkdownContext(tempdir)
+            self.assertEqual(context.env.get_template("default.html").render(
+                content="x"), "Changed: x")
+
     def test_convert(self):
         with TemporaryDirectory() as tempdir:
             # Prepare test files
@@ -45,6 +75,79 @@ class TestMarkdownConverter(TestCase):
             with open(os.path.join(tempdir, "meta.html")) as f:
                 self.assertEqual(f.read(), "Other title: <h1>Hello</h1>")
 
+    def test_render(self):
+        with TemporaryDirectory() as tempdir:
+            with open(os.path.join(tempdir, "test.md"), 'w') as f:
+                f.write("Template: missing\n\n# Hello\n")
+            templates_path = os.path.join(tempdir, "_templates")
+            os.mkdir(templates_path)
+
+            mc = MarkdownConverter(tempdir, "test.md")
+            data, error = mc.render()
+            self.assertIsNone(data)
+            self.assertEqual(error.file, "test.md")
+
+            with open(os.path.join(templates_path, "missing.html"), 'w') as f:
+                f.write("Page: {{ content }}")
+            self.assertEqual(mc.render(), (b"Page: <h1>Hello</h1>", None))
+            self.assertEqual(mc.stats.size, len(b"Page: <h1>Hello</h1>"))
+            self.assertFalse(os.path.exists(os.path.join(tempdir,
+                                                         "test.html")))
+
+    def test_unchanged_output(self):
+        with TemporaryDirectory() as tempdir:
+            with open(os.path.join(tempdir, "test.md"), 'w') as f:
+                f.write("# Hello\n")
+            templates_path = os.path.join(tempdir, "_templates")
+            os.mkdir(templates_path)
+            with open(os.path.join(templates_path, "default.html"), 'w') as f:
+                f.write("Default: {{ content }}")
+            target = os.path.join(tempdir, "test.html")
+
+            mc = MarkdownConverter(tempdir, "test.md")
+            mc.convert()
+            os.chmod(target, 0o640)
+            os.utime(target, ns=(0, 0))
+            mc.convert()
+            self.assertEqual(os.stat(target).st_mtime_ns, 0)
+
+            with open(os.path.join(tempdir, "test.md"), 'w') as f:
+                f.write("# Changed\n")
+            mc.convert()
+            self.assertNotEqual(os.stat(target).st_mtime_ns, 0)
+            self.assertEqual(os.stat(target).st_mode & 0o777, 0o640)
+            with open(target) as f:
+                self.assertEqual(f.read(), "Default: <h1>Changed</h1>")
+            self.assertEqual(sorted(os.listdir(tempdir)),
+                             ["_templates", "test.html", "test.md"])
+
+    def test_concurrent_output(self):
+        with TemporaryDirectory() as tempdir:
+            target = os.path.join(tempdir, "test.html")
+            errors = []
+
+            def write(data):
+                try:
+                    for i in range(200):
+                        write_output(target, data + str(i).encode())
+                except OSError as e:
+                    errors.append(e)
+
+            threads = [threading.Thread(target=write, args=(data,))
+                       for data in (b"a" * 10000, b"b" * 10000)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(errors, [])
+            self.assertEqual(os.listdir(tempdir), ["test.html"])
+            # Mode is the same as of a file created in the usual way
+            plain = os.path.join(tempdir, "plain.html")
+            with open(plain, "wb"):
+                pass
+            self.assertEqual(os.stat(target).st_mode & 0o777,
+                             os.stat(plain).st_mode & 0o777)
+
     def test_empty_file(self):
         with TemporaryDirectory() as tempdir:
             # Prepare test files
@@ -59,3 +162,33 @@ class TestMarkdownConverter(TestCase):
             mc.convert()
             with open(os.path.join(tempdir, "test.html")) as f:
                 self.assertEqual(f.read(), "Default: ")
+
+    def test_dependencies(self):
+        with TemporaryDirectory() as tempdir:
+            with open(os.path.join(tempdir, "test.md"), 'w') as f:
+                f.write("Template: page\n\n# Hello\n")
+            templates_path = os.path.join(tempdir, "_templates")
+            os.mkdir(templates_path)
+            templates = {
+                "page.html": "{% extends 'base.html' %}"
+                             "{% block body %}{{ content }}{% endblock %}",
+                "base.html": "{% import 'macros.html' as m %}"
+                             "{% include 'header.html' %}"
+                             "{% block body %}{% endblock %}",
+                "macros.html": "{% macro link(url) %}{{ url }}{% endmacro %}",
+                "header.html": "Header",
+                "unused.html": "Unused",
+            }
+            for name, text in templates.items():
+                with open(os.path.join(templates_path, name), 'w') as f:
+                    f.write(text)
+
+            mc = MarkdownConverter(tempdir, "test.md")
+            self.assertCountEqual(mc.dependencies(),
+                                  ["_templates/page.html",
+                                   "_templates/base.html",
+                                   "_templates/macros.html",
+                                   "_templates/header.html"])
+            self.assertIsNone(mc.convert())
+            with open(os.path.join(tempdir, "test.html")) as f:
+                self.assertEqual(f.read(), "Header<h1>Hello</h1>")
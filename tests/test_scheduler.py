@@ -0,0 +1,120 @@
+import os
+
+from oxalis.scheduler import (CHANGED, CREATED, DELETED, MAX_DELAY,
+                              RebuildScheduler)
+from tests import SiteTestCase
+
+
+class FakeMainLoop:
+    """Records timeouts instead of running them."""
+    def __init__(self):
+        self.timeouts = {}
+        self.last_id = 0
+        self.time = 0.0
+
+    def add_timeout(self, interval, callback):
+        self.last_id += 1
+        self.timeouts[self.last_id] = callback
+        return self.last_id
+
+    def remove_timeout(self, timeout_id):
+        del self.timeouts[timeout_id]
+
+    def clock(self):
+        return self.time
+
+    def run_timeouts(self):
+        for timeout_id, callback in list(self.timeouts.items()):
+            del self.timeouts[timeout_id]
+            callback()
+
+
+class TestRebuildScheduler(SiteTestCase):
+    def setUp(self):
+        super().setUp()
+        self.site.generate()
+        self.loop = FakeMainLoop()
+        self.scheduler = RebuildScheduler(self.site, self.loop.add_timeout,
+                                          self.loop.remove_timeout,
+                                          self.loop.clock)
+
+    def write(self, path, text):
+        with open(os.path.join(self.site_path, path), 'w') as f:
+            f.write(text)
+
+    def test_events_are_coalesced(self):
+        self.write("index.md", "# Changed\n")
+        for __ in range(10):
+            self.scheduler.add("index.md", CHANGED)
+        self.assertEqual(len(self.loop.timeouts), 1)
+        self.assertEqual(self.scheduler.flush(), (1, 0))
+        self.assertEqual(self.loop.timeouts, {})
+        self.assertIsNone(self.scheduler.flush())
+
+    def test_timeout_processes_events(self):
+        self.write("index.md", "# Changed\n")
+        self.scheduler.add("index.md", CHANGED)
+        self.loop.run_timeouts()
+        with open(os.path.join(self.site_path, "index.html")) as f:
+            self.assertIn("<h1>Changed</h1>", f.read())
+
+    def test_maximal_delay(self):
+        self.scheduler.add("index.md", CHANGED)
+        first_timeout = self.loop.last_id
+        self.loop.time += MAX_DELAY / 1000 + 1
+        self.scheduler.add("index.md", CHANGED)
+        self.assertEqual(list(self.loop.timeouts), [first_timeout])
+
+    def test_generated_files_are_ignored(self):
+        self.scheduler.add(".index.html.x1y2.tmp", CREATED)
+        self.scheduler.add("index.html", CHANGED)
+        self.scheduler.add(os.path.join("subdir", "index.html"), CREATED)
+        self.assertEqual(self.loop.timeouts, {})
+        self.assertIsNone(self.scheduler.flush())
+
+    def test_render_on_request(self):
+        self.site.config.setboolean('preview', 'render_on_request', True)
+        changed = []
+        self.site.connect('changed', lambda site, path: changed.append(path))
+        self.write("index.md", "# Changed\n")
+        self.scheduler.add("index.md", CHANGED)
+        self.assertEqual(self.scheduler.flush(), (0, 0))
+        self.assertEqual(changed, ["index.md"])
+        with open(os.path.join(self.site_path, "index.html")) as f:
+            self.assertNotIn("<h1>Changed</h1>", f.read())
+
+    def test_pause(self):
+        self.scheduler.add("index.md", CHANGED)
+        self.scheduler.pause()
+        self.assertEqual(self.loop.timeouts, {})
+        self.write("index.md", "# Changed\n")
+        self.scheduler.add("index.md", CHANGED)
+        self.assertEqual(self.loop.timeouts, {})
+        self.scheduler.resume()
+        self.assertEqual(len(self.loop.timeouts), 1)
+        self.loop.run_timeouts()
+        with open(os.path.join(self.site_path, "index.html")) as f:
+            self.assertIn("<h1>Changed</h1>", f.read())
+        # Nothing to process
+        self.scheduler.pause()
+        self.scheduler.resume()
+        self.assertEqual(self.loop.timeouts, {})
+
+    def test_created_and_deleted(self):
+        os.mkdir(os.path.join(self.site_path, "new"))
+        self.write("new/page.md", "# New\n")
+        self.scheduler.add("new", CREATED)
+        self.scheduler.add("new/page.md", CREATED)
+        self.scheduler.add("new/page.md", CHANGED)
+        self.scheduler.add("test.css", DELETED)
+        os.remove(os.path.join(self.site_path, "test.css"))
+        self.assertEqual(self.scheduler.flush(), (1, 0))
+        self.assertTrue(self.site.store.contains_path("new/page.md"))
+        self.assertFalse(self.site.store.contains_path("test.css"))
+        self.assertTrue(os.path.exists(
+            os.path.join(self.site_path, "new", "page.html")))
+
+    def test_unchanged_file_is_skipped(self):
+        self.scheduler.add("index.md", CHANGED)
+        self.scheduler.add("_templates/default.html", CHANGED)
+        self.assertEqual(self.scheduler.flush(), (0, 2))
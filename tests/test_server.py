@@ -0,0 +1,383 @@
+import http.client
+import os
+import threading
+from unittest import TestCase
+
+from oxalis.server import (LIVE_RELOAD_PATH, LIVE_RELOAD_SCRIPT,
+                           CachedResponse, PreviewServer, RangeNotSatisfiable,
+                           ResponseCache, byte_range, inject_live_reload)
+from tests import SiteTestCase
+
+
+class TestPreviewServer(SiteTestCase):
+    def setUp(self):
+        super().setUp()
+        self.site.generate()
+        self.server = PreviewServer(self.site)
+        self.server.start()
+        self.connection = http.client.HTTPConnection('127.0.0.1',
+                                                     self.server.port)
+
+    def tearDown(self):
+        self.connection.close()
+        self.server.stop()
+
+    def request(self, path, method='GET', headers={}):
+        self.connection.request(method, path, headers=headers)
+        response = self.connection.getresponse()
+        return response, response.read()
+
+    def test_get(self):
+        response, body = self.request('/index.html')
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response.getheader('Content-Type'), 'text/html')
+        with open(os.path.join(self.site_path, 'index.html'), 'rb') as f:
+            self.assertEqual(body, inject_live_reload(f.read()))
+        self.assertEqual(int(response.getheader('Content-Length')), len(body))
+
+    def test_directory_index(self):
+        response, body = self.request('/subdir/')
+        self.assertEqual(response.status, 200)
+        with open(os.path.join(self.site_path, 'subdir', 'index.html'),
+                  'rb') as f:
+            self.assertEqual(body, inject_live_reload(f.read()))
+
+    def test_keep_alive(self):
+        for path in ['/index.html', '/subdir/index.html', '/missing.html',
+                     '/index.html']:
+            response, __ = self.request(path)
+            self.assertFalse(response.will_close)
+        self.assertEqual(response.status, 200)
+
+    def test_head(self):
+        response, body = self.request('/test.css', 'HEAD')
+        self.assertEqual(response.status, 200)
+        self.assertEqual(body, b'')
+        size = os.path.getsize(os.path.join(self.site_path, 'test.css'))
+        self.assertEqual(int(response.getheader('Content-Length')), size)
+
+    def test_not_found(self):
+        response, __ = self.request('/missing.html')
+        self.assertEqual(response.status, 404)
+
+    def test_outside_of_site(self):
+        response, __ = self.request('/../site/index.html')
+        self.assertEqual(response.status, 404)
+        response, __ = self.request('/_oxalis/upload')
+        self.assertEqual(response.status, 404)
+        response, __ = self.request('/%2e%2e/site/index.html')
+        self.assertEqual(response.status, 404)
+
+    def test_validators(self):
+        response, __ = self.request('/index.html')
+        etag = response.getheader('ETag')
+        last_modified = response.getheader('Last-Modified')
+        self.assertIsNotNone(etag)
+        self.assertIsNotNone(last_modified)
+
+        response, body = self.request('/index.html',
+                                      headers={'If-None-Match': etag})
+        self.assertEqual(response.status, 304)
+        self.assertEqual(body, b'')
+        self.assertEqual(response.getheader('ETag'), etag)
+        response, __ = self.request(
+            '/index.html', headers={'If-Modified-Since': last_modified})
+        self.assertEqual(response.status, 304)
+        # Connection is still usable
+        response, __ = self.request('/index.html')
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response.getheader('Cache-Control'), 'no-cache')
+
+    def test_fingerprinted_asset(self):
+        path = os.path.join(self.site_path, 'test.0123456789.css')
+        with open(path, 'w') as f:
+            f.write("p{}")
+        response, __ = self.request('/test.0123456789.css')
+        self.assertEqual(response.status, 200)
+        self.assertIn('immutable', response.getheader('Cache-Control'))
+
+    def test_modified(self):
+        response, __ = self.request('/index.html')
+        etag = response.getheader('ETag')
+        last_modified = response.getheader('Last-Modified')
+        full_path = os.path.join(self.site_path, 'index.html')
+        stat = os.stat(full_path)
+        os.utime(full_path, ns=(stat.st_atime_ns,
+                                stat.st_mtime_ns + 10 * 10**9))
+        self.site.file_changed('index.html')
+
+        response, __ = self.request('/index.html',
+                                    headers={'If-None-Match': etag})
+        self.assertEqual(response.status, 200)
+        self.assertNotEqual(response.getheader('ETag'), etag)
+        response, __ = self.request(
+            '/index.html', headers={'If-Modified-Since': last_modified})
+        self.assertEqual(response.status, 200)
+        # If-None-Match takes precedence over If-Modified-Since
+        response, __ = self.request(
+            '/index.html', headers={'If-None-Match': etag,
+                                    'If-Modified-Since': 'invalid'})
+        self.assertEqual(response.status, 200)
+
+    def test_cache_invalidation(self):
+        full_path = os.path.join(self.site_path, 'subdir', 'data.txt')
+        with open(full_path, 'wb') as f:
+            f.write(b'Original')
+        self.assertEqual(self.request('/subdir/data.txt')[1], b'Original')
+        self.assertEqual(len(self.server.cache), 1)
+        with open(full_path, 'wb') as f:
+            f.write(b'Changed')
+        # Without change notification the cached version is used
+        self.assertEqual(self.request('/subdir/data.txt')[1], b'Original')
+        self.site.file_changed('subdir')
+        self.assertEqual(len(self.server.cache), 0)
+        self.assertEqual(self.request('/subdir/data.txt')[1], b'Changed')
+
+    def test_generate_invalidates_cache(self):
+        self.request('/index.html')
+        with open(os.path.join(self.site_path, 'index.md'), 'a') as f:
+            f.write("\nChanged\n")
+        self.site.generate()
+        __, body = self.request('/index.html')
+        self.assertIn(b'Changed', body)
+
+    def check_ranges(self):
+        data = bytes(range(256)) * 40
+        with open(os.path.join(self.site_path, 'data.bin'), 'wb') as f:
+            f.write(data)
+        response, body = self.request('/data.bin')
+        self.assertEqual(body, data)
+        self.assertEqual(response.getheader('Accept-Ranges'), 'bytes')
+        etag = response.getheader('ETag')
+
+        response, body = self.request('/data.bin',
+                                      headers={'Range': 'bytes=100-199'})
+        self.assertEqual(response.status, 206)
+        self.assertEqual(body, data[100:200])
+        self.assertEqual(response.getheader('Content-Range'),
+                         'bytes 100-199/10240')
+        response, body = self.request('/data.bin',
+                                      headers={'Range': 'bytes=-10'})
+        self.assertEqual(body, data[-10:])
+        response, body = self.request('/data.bin', headers={
+            'Range': 'bytes=10240-'})
+        self.assertEqual(response.status, 416)
+        self.assertEqual(response.getheader('Content-Range'), 'bytes */10240')
+
+        response, body = self.request('/data.bin', headers={
+            'Range': 'bytes=10-', 'If-Range': etag})
+        self.assertEqual(body, data[10:])
+        response, body = self.request('/data.bin', headers={
+            'Range': 'bytes=10-', 'If-Range': '"outdated"'})
+        self.assertEqual(response.status, 200)
+        self.assertEqual(body, data)
+
+    def test_ranges_cached(self):
+        self.check_ranges()
+        self.assertEqual(len(self.server.cache), 1)
+
+    def test_ranges_sendfile(self):
+        self.server.cache.max_entry_size = 1000
+        self.check_ranges()
+        self.assertEqual(len(self.server.cache), 0)
+
+
+class TestLiveReload(SiteTestCase):
+    def setUp(self):
+        super().setUp()
+        self.server = PreviewServer(self.site)
+        self.server.start()
+        self.connection = http.client.HTTPConnection(
+            '127.0.0.1', self.server.port, timeout=5)
+        self.connection.request('GET', LIVE_RELOAD_PATH)
+        self.events = self.connection.getresponse()
+        self.assertEqual(self.events.getheader('Content-Type'),
+                         'text/event-stream')
+        self.assertEqual(self.read_event(), [b'retry: 1000'])
+
+    def tearDown(self):
+        self.connection.close()
+        self.server.stop()
+
+    def read_event(self):
+        lines = []
+        while True:
+            line = self.events.fp.readline().rstrip(b'\n')
+            if not line:
+                return lines
+            lines.append(line)
+
+    def test_reload(self):
+        with open(os.path.join(self.site_path, 'index.md'), 'a') as f:
+            f.write("\nChanged\n")
+        self.site.file_changed('index.md')
+        self.assertEqual(self.read_event(), [b'event: reload', b'data: '])
+
+    def test_css(self):
+        self.site.file_changed('test.css')
+        self.assertEqual(self.read_event(),
+                         [b'event: css', b'data: ["/test.css"]'])
+
+    def test_workers_not_blocked(self):
+        streams = []
+        for __ in range(20):
+            connection = http.client.HTTPConnection('127.0.0.1',
+                                                    self.server.port)
+            connection.request('GET', LIVE_RELOAD_PATH)
+            streams.append(connection.getresponse())
+            streams[-1].fp.readline()  # Wait until the stream is registered
+        response = self.request_file('/test.css')
+        self.assertEqual(response.status, 200)
+        self.assertEqual(len(self.server.live_reload), 21)
+
+    def test_stop(self):
+        """Stopped server does not leave any threads or connections."""
+        threads = threading.active_count()
+        server = PreviewServer(self.site)
+        server.start()
+        # Persistent connection keeps a worker waiting for the next request
+        connection = http.client.HTTPConnection('127.0.0.1', server.port,
+                                                timeout=5)
+        connection.request('GET', '/test.css')
+        connection.getresponse().read()
+        events = http.client.HTTPConnection('127.0.0.1', server.port,
+                                            timeout=5)
+        events.request('GET', LIVE_RELOAD_PATH)
+        stream = events.getresponse()
+        stream.fp.readline()  # Wait until the stream is registered
+        server.stop()
+        self.assertEqual(threading.active_count(), threads)
+        self.assertEqual(len(server.live_reload), 0)
+        self.assertEqual(stream.fp.read(), b'\n')  # Rest of the retry event
+        connection.close()
+        events.close()
+
+    def request_file(self, path):
+        connection = http.client.HTTPConnection('127.0.0.1', self.server.port,
+                                                timeout=5)
+        connection.request('GET', path)
+        response = connection.getresponse()
+        response.read()
+        connection.close()
+        return response
+
+    def test_inject(self):
+        self.assertEqual(inject_live_reload(b'<BODY>Text</BODY>'),
+                         b'<BODY>Text' + LIVE_RELOAD_SCRIPT + b'</BODY>')
+        self.assertEqual(inject_live_reload(b'Text'),
+                         b'Text' + LIVE_RELOAD_SCRIPT)
+
+
+class TestRenderOnRequest(SiteTestCase):
+    def setUp(self):
+        super().setUp()
+        self.site.config.setboolean('preview', 'render_on_request', True)
+        self.server = PreviewServer(self.site)
+        self.server.start()
+        self.connection = http.client.HTTPConnection('127.0.0.1',
+                                                     self.server.port)
+
+    def tearDown(self):
+        self.connection.close()
+        self.server.stop()
+
+    def request(self, path):
+        self.connection.request('GET', path)
+        response = self.connection.getresponse()
+        return response, response.read()
+
+    def write(self, path, text):
+        with open(os.path.join(self.site_path, path), 'w') as f:
+            f.write(text)
+
+    def test_render(self):
+        target = os.path.join(self.site_path, 'subdir', 'index.html')
+        with open(target, 'rb') as f:
+            generated = f.read()
+        self.write(os.path.join('subdir', 'index.md'),
+                   "Title: Rendered\n\nText\n")
+        response, body = self.request('/subdir/')
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response.getheader('Content-Type'), 'text/html')
+        self.assertIn(b'<title>Rendered</title>', body)
+        with open(target, 'rb') as f:
+            self.assertEqual(f.read(), generated)
+
+    def test_source_changed(self):
+        self.request('/index.html')
+        self.write('index.md', "Title: Changed\n\nChanged\n")
+        self.site.file_changed('index.md')
+        response, body = self.request('/index.html')
+        self.assertIn(b'<p>Changed</p>', body)
+
+    def test_template_changed(self):
+        self.request('/index.html')
+        self.write(os.path.join('_templates', 'default.html'),
+                   "Changed: {{ content }}")
+        self.site.file_changed(os.path.join('_templates', 'default.html'))
+        response, body = self.request('/index.html')
+        self.assertTrue(body.startswith(b'Changed: '))
+
+    def test_error(self):
+        self.write('index.md', "Template: missing\n\nText\n")
+        response, body = self.request('/index.html')
+        self.assertEqual(response.status, 500)
+        self.assertIn(b'missing', body)
+        self.assertEqual(len(self.server.cache), 0)
+
+
+class TestByteRange(TestCase):
+    def test_byte_range(self):
+        self.assertIsNone(byte_range(None, 100))
+        self.assertEqual(byte_range('bytes=0-9', 100), (0, 10))
+        self.assertEqual(byte_range('bytes=90-', 100), (90, 100))
+        self.assertEqual(byte_range('bytes=90-200', 100), (90, 100))
+        self.assertEqual(byte_range('bytes=-20', 100), (80, 100))
+        self.assertEqual(byte_range('bytes=-200', 100), (0, 100))
+
+    def test_ignored(self):
+        for header in ['items=0-9', 'bytes=0-9,20-29', 'bytes=9-0',
+                       'bytes=a-b', 'bytes=5']:
+            self.assertIsNone(byte_range(header, 100), header)
+
+    def test_not_satisfiable(self):
+        for header in ['bytes=100-', 'bytes=-0']:
+            with self.assertRaises(RangeNotSatisfiable):
+                byte_range(header, 100)
+        with self.assertRaises(RangeNotSatisfiable):
+            byte_range('bytes=-10', 0)
+
+
+class TestResponseCache(TestCase):
+    def response(self, path, size):
+        return CachedResponse(path, 'text/plain', '"1"', 0, b'x' * size)
+
+    def test_lru(self):
+        cache = ResponseCache(max_size=30, max_entry_size=20)
+        cache.put('a', self.response('a', 10), cache.generation)
+        cache.put('b', self.response('b', 10), cache.generation)
+        cache.put('c', self.response('c', 10), cache.generation)
+        cache.get('a')
+        cache.put('d', self.response('d', 10), cache.generation)
+        self.assertIsNone(cache.get('b'))
+        self.assertIsNotNone(cache.get('a'))
+        self.assertEqual(cache.size, 30)
+        cache.put('e', self.response('e', 25), cache.generation)
+        self.assertIsNone(cache.get('e'))
+
+    def test_invalidate(self):
+        cache = ResponseCache()
+        cache.put('/dir/', self.response(os.path.join('dir', 'index.html'),
+                                         10), cache.generation)
+        cache.put('/dir2', self.response('dir2', 10), cache.generation)
+        cache.invalidate('dir')
+        self.assertIsNone(cache.get('/dir/'))
+        self.assertIsNotNone(cache.get('/dir2'))
+        self.assertEqual(cache.size, 10)
+
+    def test_outdated_response(self):
+        cache = ResponseCache()
+        generation = cache.generation
+        cache.invalidate('a')  # File changed while the response was read
+        cache.put('a', self.response('a', 10), generation)
+        self.assertIsNone(cache.get('a'))
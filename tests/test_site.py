@@ -1,15 +1,14 @@
 import os
-from unittest import TestCase
+import shutil
 
-import oxalis.site
+from oxalis.build import BackgroundBuild
+from tests import SiteTestCase
 
-TESTDIR = os.path.join(os.path.dirname(__file__), "test-site")
 
-
-class TestSite(TestCase):
+class TestSite(SiteTestCase):
     def test_load(self):
         """Was site tree loaded properly?"""
-        site = oxalis.site.Site(TESTDIR)
+        site = self.site
         self.assertEqual(site.store.get_by_path("").name, "")  # root
         self.assertEqual(site.store.get_by_path("index.md").name, "index.md")
         with self.assertRaises(KeyError):
@@ -21,7 +20,7 @@ class TestSite(TestCase):
 
     def test_tree(self):
         """Does tree traversal works properly?"""
-        site = oxalis.site.Site(TESTDIR)
+        site = self.site
         root = site.store.get_by_path("")
         subdir = site.store.get_by_path("subdir")
         index = site.store.get_by_path("index.md")
@@ -33,3 +32,122 @@ class TestSite(TestCase):
         self.assertIn(subdir_index, site.store.get_children(subdir))
         self.assertEqual(site.store.get_parent(index), root)
         self.assertEqual(site.store.get_parent(subdir_index), subdir)
+
+    def test_children_order(self):
+        """Are directories listed first and files sorted by name?"""
+        site = self.site
+        root = site.store.get_by_path("")
+        self.assertEqual([doc.name for doc in site.store.get_children(root)],
+                         ["_templates", "subdir", "index.md", "test.css"])
+        test_css = site.store.get_by_path("test.css")
+        self.assertEqual(site.store.index_of(test_css), 3)
+
+    def test_document_for_target(self):
+        site = self.site
+        index = site.store.get_by_path("index.md")
+        self.assertEqual(site.document_for_target("index.html"), index)
+        self.assertEqual(site.document_for_target("subdir/index.html"),
+                         site.store.get_by_path("subdir/index.md"))
+        self.assertIsNone(site.document_for_target("test.css"))
+        site.store.remove(index)
+        self.assertIsNone(site.document_for_target("index.html"))
+        self.assertFalse(site.store.is_generated("index.html"))
+
+
+class TestSiteChanges(SiteTestCase):
+    def test_generate(self):
+        summary = self.site.generate()
+        self.assertEqual(summary, (2, 0))
+        self.assertTrue(os.path.exists(
+            os.path.join(self.site_path, "subdir", "index.html")))
+        self.assertEqual(self.site.generate(), (0, 2))
+        self.assertEqual(self.site.generate(force=True), (2, 0))
+
+    def test_file_created_and_deleted(self):
+        os.mkdir(os.path.join(self.site_path, "new"))
+        open(os.path.join(self.site_path, "new", "page.md"), 'w').close()
+        self.site.file_created("new")
+        self.assertTrue(self.site.store.contains_path("new/page.md"))
+
+        shutil.rmtree(os.path.join(self.site_path, "new"))
+        self.site.file_deleted("new")
+        self.assertFalse(self.site.store.contains_path("new"))
+        self.assertFalse(self.site.store.contains_path("new/page.md"))
+
+    def test_template_changed(self):
+        self.site.generate()
+        with open(os.path.join(self.site_path, "_templates", "default.html"),
+                  'w') as f:
+            f.write("Changed: {{ content }}")
+        self.site.file_changed("_templates/default.html")
+        with open(os.path.join(self.site_path, "index.html")) as f:
+            self.assertTrue(f.read().startswith("Changed: "))
+
+
+class TestBackgroundBuild(SiteTestCase):
+    def setUp(self):
+        super().setUp()
+        self.main_loop = []  # Callbacks scheduled to the main thread
+
+    def run_in_main(self, callback, *args):
+        self.main_loop.append((callback, args))
+
+    def run_build(self, build):
+        progress = []
+        finished = []
+        build.connect('progress', lambda b, done, total:
+                      progress.append((done, total)))
+        build.connect('finished', lambda b, summary: finished.append(summary))
+        build.start()
+        build.join()
+        for callback, args in self.main_loop:
+            callback(*args)
+        return progress, finished
+
+    def test_build(self):
+        build = BackgroundBuild(self.site, self.run_in_main)
+        progress, finished = self.run_build(build)
+        self.assertEqual(progress, [(1, 2), (2, 2)])
+        self.assertEqual(finished, [(2, 0)])
+        self.assertTrue(os.path.exists(
+            os.path.join(self.site_path, "subdir", "index.html")))
+        self.assertEqual(self.site.generate(), (0, 2))
+
+    def test_cancel(self):
+        build = BackgroundBuild(self.site, self.run_in_main)
+        build.cancel()
+        progress, finished = self.run_build(build)
+        self.assertEqual(progress, [])
+        self.assertEqual(finished, [(0, 0)])
+        self.assertTrue(build.cancelled)
+        self.assertEqual(self.site.generate(), (2, 0))
+
+    def test_document_added_during_build(self):
+        self.site.generate()
+        build = BackgroundBuild(self.site, self.run_in_main, force=True)
+        with open(os.path.join(self.site_path, "new.md"), 'w') as f:
+            f.write("# New\n")
+        self.site.file_created("new.md")
+        self.run_build(build)
+        # The new document is not pruned from the manifest by the build
+        self.assertTrue(self.site.manifest.is_current("new.md"))
+
+    def test_source_changed_before_results_are_stored(self):
+        build = BackgroundBuild(self.site, self.run_in_main)
+        build.start()
+        build.join()
+        # Edited after conversion, but before the result is recorded
+        with open(os.path.join(self.site_path, "index.md"), 'w') as f:
+            f.write("# Edited\n")
+        for callback, args in self.main_loop:
+            callback(*args)
+        self.assertEqual(self.site.rebuild(["index.md"]), (1, 0))
+        with open(os.path.join(self.site_path, "index.html")) as f:
+            self.assertIn("<h1>Edited</h1>", f.read())
+
+    def test_separate_converters(self):
+        document = self.site.store.get_by_path("index.md")
+        converter = document.converter
+        build = BackgroundBuild(self.site, self.run_in_main)
+        self.run_build(build)
+        self.assertIsNone(converter.stats)
@@ -38,14 +38,10 @@ class TestSiteCreation(TestCase):
         self.assertTrue(os.path.exists(upload_conf))
         self.assertEqual(perm(upload_conf), 0o600)
 
-    def test_sitecopy_config(self):
-        """Was Sitecopy configuration created with right permissions?"""
-        sc_dir = os.path.join(CONF_DIR, "sitecopy")
-        self.assertTrue(os.path.isdir(sc_dir))
-        self.assertEqual(perm(sc_dir), 0o700)
-        sc_conf = os.path.join(CONF_DIR, "sitecopyrc")
-        self.assertTrue(os.path.exists(sc_conf))
-        self.assertEqual(perm(sc_conf), 0o600)
+    def test_no_sitecopy_config(self):
+        """Sitecopy is not used for upload any more."""
+        self.assertFalse(os.path.exists(os.path.join(CONF_DIR, "sitecopy")))
+        self.assertFalse(os.path.exists(os.path.join(CONF_DIR, "sitecopyrc")))
 
     def test_index_templates(self):
         """Was index file and templates created?"""
@@ -0,0 +1,66 @@
+import json
+import os
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+
+from oxalis.snapshot import TreeSnapshot
+
+
+class TestTreeSnapshot(TestCase):
+    def setUp(self):
+        self._tempdir = TemporaryDirectory()
+        self.site_path = self._tempdir.name
+        for path in ["_oxalis", "subdir", "subdir/nested"]:
+            os.mkdir(os.path.join(self.site_path, path))
+        for path in ["index.md", "subdir/page.md", "_oxalis/config"]:
+            open(os.path.join(self.site_path, path), 'w').close()
+
+    def tearDown(self):
+        self._tempdir.cleanup()
+
+    def age_directories(self):
+        """Move modification times of directories to the past."""
+        for path in ["", "subdir", "subdir/nested"]:
+            os.utime(os.path.join(self.site_path, path), (1000, 1000))
+
+    def test_scan(self):
+        listings = TreeSnapshot(self.site_path).scan()
+        self.assertEqual(sorted(listings), ["", "subdir", "subdir/nested"])
+        self.assertCountEqual(listings[""], [["_oxalis", True],
+                                             ["index.md", False],
+                                             ["subdir", True]])
+        self.assertCountEqual(listings["subdir"], [["page.md", False],
+                                                   ["nested", True]])
+
+    def test_unchanged_directory_is_not_listed(self):
+        self.age_directories()
+        snapshot = TreeSnapshot(self.site_path)
+        snapshot.scan()
+        snapshot.save()
+        # Tamper the snapshot to see whether listing is taken from it
+        with open(snapshot.filename) as f:
+            data = json.load(f)
+        data['directories']['subdir'][1].append(["cached.md", False])
+        with open(snapshot.filename, 'w') as f:
+            json.dump(data, f)
+
+        listings = TreeSnapshot(self.site_path).scan()
+        self.assertIn(["cached.md", False], listings["subdir"])
+
+    def test_changed_directory_is_listed(self):
+        self.age_directories()
+        snapshot = TreeSnapshot(self.site_path)
+        snapshot.scan()
+        snapshot.save()
+        open(os.path.join(self.site_path, "subdir", "new.md"), 'w').close()
+
+        listings = TreeSnapshot(self.site_path).scan()
+        self.assertIn(["new.md", False], listings["subdir"])
+
+    def test_recent_directory_is_not_trusted(self):
+        snapshot = TreeSnapshot(self.site_path)
+        snapshot.scan()
+        snapshot.save()
+        with open(snapshot.filename) as f:
+            data = json.load(f)
+        self.assertIsNone(data['directories']['subdir'][0])
@@ -0,0 +1,259 @@
+import json
+import os
+import select
+import socket
+import sys
+import threading
+from tempfile import TemporaryDirectory
+from unittest import TestCase, skipUnless
+
+try:
+    from pyftpdlib.authorizers import DummyAuthorizer
+    from pyftpdlib.handlers import FTPHandler
+    from pyftpdlib.servers import ThreadedFTPServer
+except ImportError:
+    ThreadedFTPServer = None
+
+from oxalis import upload
+from tests import SiteTestCase
+
+
+class FakeConnection:
+    """Connection storing uploaded files into a dictionary."""
+    def __init__(self, server):
+        self.server = server
+        server.opened += 1
+
+    def make_directory(self, path):
+        self.server.directories.append(path)
+
+    def upload(self, path, full_path):
+        if path in self.server.failing:
+            raise OSError("Failed")
+        with open(full_path, 'rb') as f:
+            self.server.files[path] = f.read()
+
+    def delete(self, path):
+        self.server.files.pop(path, None)
+
+    def remove_directory(self, path):
+        self.server.removed_directories.append(path)
+
+    def close(self):
+        self.server.closed += 1
+
+
+class FakeServer:
+    def __init__(self):
+        self.files = {}
+        self.directories = []
+        self.removed_directories = []
+        self.failing = set()
+        self.opened = self.closed = 0
+
+    def connect(self):
+        return FakeConnection(self)
+
+
+class TestUploader(TestCase):
+    def setUp(self):
+        self._tempdir = TemporaryDirectory()
+        self.site_path = self._tempdir.name
+        self.files = []
+        for i in range(50):
+            path = os.path.join("dir%d" % (i % 3), "sub", "file%d" % i)
+            os.makedirs(os.path.join(self.site_path, os.path.dirname(path)),
+                        exist_ok=True)
+            with open(os.path.join(self.site_path, path), 'wb') as f:
+                f.write(b"x" * i * 3000)
+            self.files.append(path)
+
+    def tearDown(self):
+        self._tempdir.cleanup()
+
+    def test_upload(self):
+        server = FakeServer()
+        progress = []
+        upload.Uploader(server.connect, 3).upload(
+            self.site_path, self.files,
+            lambda path, size: progress.append(path))
+        self.assertEqual(sorted(server.files), sorted(self.files))
+        self.assertEqual(sorted(progress), sorted(self.files))
+        self.assertEqual(server.directories,
+                         ["dir0", os.path.join("dir0", "sub"),
+                          "dir1", os.path.join("dir1", "sub"),
+                          "dir2", os.path.join("dir2", "sub")])
+        # Connections are reused for many files
+        self.assertEqual(server.opened, 3)
+        self.assertEqual(server.closed, 3)
+
+    def test_error(self):
+        server = FakeServer()
+        server.failing.add(self.files[10])
+        with self.assertRaises(upload.UploadError):
+            upload.Uploader(server.connect, 3).upload(self.site_path,
+                                                      self.files)
+        self.assertEqual(server.opened, server.closed)
+
+    def test_delete(self):
+        server = FakeServer()
+        uploader = upload.Uploader(server.connect, 3)
+        uploader.upload(self.site_path, self.files)
+        deleted = [path for path in self.files if path.startswith("dir1")]
+        deleted.append(self.files[0])
+        kept = [path for path in self.files if path not in deleted]
+        uploader.delete(deleted, kept)
+        self.assertEqual(sorted(server.files), sorted(kept))
+        self.assertEqual(server.removed_directories,
+                         [os.path.join("dir1", "sub"), "dir1"])
+
+
+class TestProgress(TestCase):
+    def test_tracker(self):
+        now = [10.0]
+        tracker = upload.ProgressTracker(3, 3000, lambda: now[0])
+        self.assertEqual(tracker.status(), (0, 3, 0, 3000, None, None))
+        now[0] = 12.0
+        tracker.add(1000)
+        self.assertEqual(tracker.status(), (1, 3, 1000, 3000, 500.0, 4.0))
+        tracker.add()
+        self.assertEqual(tracker.status().files_done, 2)
+
+    def test_events(self):
+        status = upload.UploadStatus(1, 2, 10, 20, 5.0, 2.0)
+        event = upload.parse_event(
+            upload.progress_event('upload', 'a.html', status))
+        self.assertEqual(event, dict(status._asdict(), event='upload',
+                                     path='a.html'))
+        self.assertEqual(upload.parse_event('Traceback'),
+                         {'event': 'output', 'text': 'Traceback'})
+        self.assertEqual(upload.parse_event('[1]'),
+                         {'event': 'output', 'text': '[1]'})
+
+    def test_process(self):
+        script = ("import json, sys, time\n"
+                  "for i in range(3):\n"
+                  "    sys.stdout.write(json.dumps({'event': 'upload', "
+                  "'path': str(i)}))\n"
+                  "    sys.stdout.flush()\n"
+                  "    time.sleep(0.05)\n"
+                  "    sys.stdout.write('\\n')\n"
+                  "print('bye', end='')\n"
+                  "sys.exit(3)\n")
+        process = upload.UploadProcess((sys.executable, '-c', script))
+        events = []
+        while not process.finished:
+            select.select([process], [], [])
+            events.extend(process.read_events())
+        self.assertEqual(events,
+                         [{'event': 'upload', 'path': str(i)} for i in range(3)]
+                         + [{'event': 'output', 'text': 'bye'}])
+        self.assertEqual(process.returncode, 3)
+
+
+class TestSiteUpload(SiteTestCase):
+    def configure(self, host, remote_dir):
+        for key, value in [('host', host), ('user', 'user'),
+                           ('passwd', 'secret'), ('remotedir', remote_dir)]:
+            self.site.upload_config.set('upload', key, value)
+
+    def test_publishable_files(self):
+        self.assertEqual(upload.publishable_files(self.site),
+                         ["index.html", os.path.join("subdir", "index.html"),
+                          os.path.join("subdir", "test.jpeg"), "test.css"])
+
+    def test_target_name(self):
+        self.configure('example.com', '/www/')
+        self.assertEqual(upload.target_name(self.site), 'example.com/www')
+        self.configure('sftp://example.com:2222', 'www')
+        self.assertEqual(upload.target_name(self.site), 'example.com/www')
+
+    def test_plan(self):
+        manifest = upload.DeployManifest(self.site_path)
+        files = upload.publishable_files(self.site)
+        plan = manifest.plan('a', files)
+        self.assertEqual(plan, (files, [], [], []))
+        for path in files:
+            manifest.deployed('a', path)
+        manifest.save()
+
+        manifest = upload.DeployManifest(self.site_path)
+        with open(os.path.join(self.site_path, "test.css"), 'a') as f:
+            f.write("p {}\n")
+        plan = manifest.plan('a', files[1:] + ["new.html"])
+        self.assertEqual(plan.added, ["new.html"])
+        self.assertEqual(plan.changed, ["test.css"])
+        self.assertEqual(plan.deleted, [files[0]])
+        self.assertEqual(len(plan.unchanged), len(files) - 2)
+        # Other targets are independent
+        self.assertEqual(manifest.plan('b', files).added, files)
+
+    def test_dry_run(self):
+        self.configure('127.0.0.1:1', '/www')  # Nothing listens there
+        plan = upload.upload_site(self.site, dry_run=True)
+        self.assertEqual(plan.added, upload.publishable_files(self.site))
+        self.assertEqual(upload.upload_site(self.site, dry_run=True), plan)
+
+    def test_timeout(self):
+        # Connections are accepted by the system, but the server never
+        # sends its greeting
+        with socket.socket() as server:
+            server.bind(('127.0.0.1', 0))
+            server.listen()
+            self.configure('127.0.0.1:%d' % server.getsockname()[1], '/www')
+            self.site.upload_config.set('upload', 'timeout', '0.1')
+            connect = upload.connection_factory(self.site)
+            with self.assertRaises(upload.UploadError):
+                connect()
+
+    @skipUnless(ThreadedFTPServer, "pyftpdlib is not installed")
+    def test_ftp_upload(self):
+        remote = os.path.join(self._tempdir.name, "remote")
+        os.makedirs(os.path.join(remote, "www"))
+        authorizer = DummyAuthorizer()
+        authorizer.add_user('user', 'secret', remote, perm='elradfmw')
+        handler = type('Handler', (FTPHandler,), {'authorizer': authorizer})
+        server = ThreadedFTPServer(('127.0.0.1', 0), handler)
+        thread = threading.Thread(target=server.serve_forever,
+                                  kwargs={'timeout': 0.1})
+        thread.start()
+        try:
+            self.configure('127.0.0.1:%d' % server.address[1], '/www')
+            events = []
+            plan = upload.upload_site(
+                self.site,
+                progress=lambda *args: events.append(
+                    json.loads(upload.progress_event(*args))))
+            files = upload.publishable_files(self.site)
+            self.assertEqual(plan.added, files)
+            size = sum(os.path.getsize(os.path.join(self.site_path, path))
+                       for path in files)
+            self.assertEqual(events[0]['event'], 'start')
+            self.assertEqual((events[0]['files_total'],
+                              events[0]['bytes_total']), (len(files), size))
+            self.assertEqual(sorted(event['path'] for event in events[1:]),
+                             files)
+            self.assertEqual((events[-1]['files_done'],
+                              events[-1]['bytes_done']), (len(files), size))
+            for path in files:
+                with open(os.path.join(self.site_path, path), 'rb') as f, \
+                        open(os.path.join(remote, "www", path), 'rb') as r:
+                    self.assertEqual(f.read(), r.read())
+
+            # Only changes are uploaded next time
+            self.assertEqual(upload.upload_site(self.site),
+                             ([], [], [], files))
+            with open(os.path.join(self.site_path, "test.css"), 'a') as f:
+                f.write("p {}\n")
+            jpeg = os.path.join("subdir", "test.jpeg")
+            os.remove(os.path.join(self.site_path, jpeg))
+            self.site.file_deleted(jpeg)
+            plan = upload.upload_site(self.site)
+            self.assertEqual(plan.changed, ["test.css"])
+            self.assertEqual(plan.deleted, [jpeg])
+            self.assertFalse(os.path.exists(os.path.join(remote, "www", jpeg)))
+            self.assertTrue(os.path.exists(
+                os.path.join(remote, "www", "subdir", "index.html")))
+        finally:
+            server.close_all()
+            thread.join()